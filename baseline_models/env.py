@@ -92,7 +92,7 @@ class WebEnv:
                 if text == 'buy now' and self.ban_buy:
                     cur_options = len(self.session['options'])
                     all_options = len(
-                        self.env.server.product_item_dict[self.session["asin"]]['customization_options'])
+                        self.env.server.product_item_dict[self.session["asin"]]['options'])
                     if cur_options != all_options:
                         continue
                 if text != 'search':
@@ -0,0 +1,85 @@
+"""
+Benchmark the dense and hybrid search backends against BM25.
+
+Each product's instruction is searched, and the product counts as found if
+it is among the top k hits (recall@k). For the approximate searches of the
+dense index, the share of the exact top k hits they find is reported too.
+Latencies include encoding the query.
+
+Usage (from `search_engine/`, after building the `bm25` and `dense` indexes
+with `build_indexes.py`):
+  python benchmark_dense.py --num_products 1000 --nprobe 8 32 128
+"""
+import argparse
+import json
+import sys
+import time
+sys.path.insert(0, '../')
+
+from web_agent_site.utils import DEFAULT_ATTR_PATH
+from web_agent_site.engine.bm25 import BM25Searcher
+from web_agent_site.engine.dense import DEFAULT_ALPHA, DenseSearcher, HybridSearcher, import_faiss
+from web_agent_site.engine.engine import get_index_path
+
+
+def run_searches(searcher, queries, k):
+    """Hit docids of each query, and mean latency"""
+    old_time = time.time()
+    results = [[hit.docid for hit in searcher.search(query, k=k)] for query in queries]
+    return results, (time.time() - old_time) / len(queries)
+
+
+def report(name, results, latency, targets, exact=None):
+    recall = sum(target in docids for docids, target in zip(results, targets)) / len(targets)
+    result = f'{name}: {latency * 1000:.2f} ms/query, recall@k {recall:.3f}'
+    if exact is not None:
+        overlap = sum(
+            len(set(docids) & set(exact_docids)) / max(len(exact_docids), 1)
+            for docids, exact_docids in zip(results, exact)
+        ) / len(results)
+        result += f', exact top k found {overlap:.3f}'
+    print(result)
+
+
+if __name__ == '__main__':
+    def num_products_type(value):
+        return None if value == 'all' else int(value)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num_products', type=num_products_type, default=1000)
+    parser.add_argument('--attr_path', default=DEFAULT_ATTR_PATH)
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA)
+    args = parser.parse_args()
+
+    bm25 = BM25Searcher(get_index_path(args.num_products, 'bm25'))
+    dense = DenseSearcher(get_index_path(args.num_products, 'dense'), use_faiss=False)
+    indexed = set(docid.decode('utf-8') for docid in dense.docids)
+    with open(args.attr_path) as f:
+        attributes = json.load(f)
+    pairs = [
+        (a['instruction'].lower(), asin) for asin, a in attributes.items()
+        if a.get('instruction') and asin in indexed
+    ][:args.num_queries]
+    queries = [query for query, _ in pairs]
+    targets = [asin for _, asin in pairs]
+    print(f'{len(queries)} queries, top {args.k}, {dense.num_docs} products, {len(dense.centroids)} lists')
+    for searcher in (bm25, dense):
+        run_searches(searcher, queries[:10], args.k)  # warm up
+
+    report('bm25', *run_searches(bm25, queries, args.k), targets)
+    dense.nprobe = len(dense.centroids)
+    exact, latency = run_searches(dense, queries, args.k)
+    report('dense exact', exact, latency, targets)
+    for nprobe in args.nprobe:
+        dense.nprobe = nprobe
+        report(f'dense nprobe={nprobe}', *run_searches(dense, queries, args.k), targets, exact)
+    if import_faiss() is not None:
+        hnsw = DenseSearcher(dense.path, encoder=dense.encoder)
+        if hnsw.hnsw is not None:
+            report('dense hnsw', *run_searches(hnsw, queries, args.k), targets, exact)
+    dense.nprobe = args.nprobe[-1]
+    hybrid = HybridSearcher(bm25, dense, alpha=args.alpha)
+    report(f'hybrid alpha={args.alpha} nprobe={dense.nprobe}', *run_searches(hybrid, queries, args.k), targets)
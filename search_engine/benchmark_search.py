@@ -0,0 +1,74 @@
+"""
+Benchmark resolving search hits to ASINs, and the on-disk size of indexes.
+
+For each index, times the searches of a set of instructions two ways:
+  raw   -- read each hit's stored raw document and parse its JSON for `id`
+           (only for indexes built with --storeRaw)
+  docid -- use each hit's docid, which is the ASIN
+
+Usage (from `search_engine/`):
+  python benchmark_search.py --index indexes_1k_raw --index indexes_1k
+"""
+import argparse
+import json
+import os
+import sys
+import time
+sys.path.insert(0, '../')
+
+from pyserini.search.lucene import LuceneSearcher
+
+from web_agent_site.utils import DEFAULT_ATTR_PATH
+
+
+def get_index_size(index):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(index) for name in names
+    )
+
+
+def time_searches(searcher, queries, k, resolve):
+    old_time = time.time()
+    for query in queries:
+        hits = searcher.search(query, k=k)
+        if resolve == 'raw':
+            asins = [json.loads(searcher.doc(hit.docid).raw())['id'] for hit in hits]
+        else:
+            asins = [hit.docid for hit in hits]
+    return (time.time() - old_time) / len(queries)
+
+
+def has_raw(searcher, queries):
+    for query in queries:
+        hits = searcher.search(query, k=1)
+        if hits:
+            return searcher.doc(hits[0].docid).raw() is not None
+    return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index', action='append', required=True)
+    parser.add_argument('--attr_path', default=DEFAULT_ATTR_PATH)
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=50)
+    args = parser.parse_args()
+
+    with open(args.attr_path) as f:
+        attributes = json.load(f)
+    queries = [
+        a['instruction'].lower() for a in attributes.values()
+        if a.get('instruction')
+    ][:args.num_queries]
+    print(f'{len(queries)} queries, top {args.k}')
+
+    for index in args.index:
+        searcher = LuceneSearcher(index)
+        time_searches(searcher, queries[:10], args.k, 'docid')  # warm up
+        result = f'{index}: {get_index_size(index) / 2 ** 20:.1f} MiB'
+        modes = ['raw', 'docid'] if has_raw(searcher, queries) else ['docid']
+        for mode in modes:
+            latency = time_searches(searcher, queries, args.k, mode)
+            result += f', {mode} {latency * 1000:.2f} ms/query'
+        print(result)
@@ -0,0 +1,285 @@
+"""
+Build all search indexes of the product catalog in one pass, in parallel.
+
+Products are streamed from the product file once and their documents (see
+`get_product_document`) split into shards. A pool of processes writes each
+shard and analyzes it for the BM25 indexes; only a few shards are queued at
+a time, so the products read are not held in memory. The analyzed shards
+(`bm25.IndexPart`s) are, though: those of all products are kept until the
+BM25 indexes are merged from them in memory, so memory use grows with the
+catalog when building BM25 indexes. The subset collections (first 100, 1k
+and 100k products) hard-link the shards they contain instead of copying
+them. The BM25 and dense indexes of every collection are then built
+concurrently, alongside the Lucene (pyserini) indexes, which are built one
+after another so that a single JVM indexes with the `--workers` threads.
+Dense indexes (`--backends dense`, which needs torch and transformers) encode
+all products once; those of the subsets take the first vectors. With `--raw`,
+Lucene indexes that also store the raw documents (`indexes*_raw`, as they used
+to be built) are built too, for `benchmark_search.py` to compare against.
+
+An index is skipped when it was built from the same product file (size and
+modification time) by the same version of this script; `--force` rebuilds it.
+
+Usage (from `search_engine/`):
+  python build_indexes.py [--backends lucene bm25 dense] [--raw] [--workers N] [--force]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, basename, dirname, join
+sys.path.insert(0, '../')
+
+from web_agent_site.utils import DEFAULT_FILE_PATH
+from web_agent_site.engine import bm25, dense
+from web_agent_site.engine.bm25 import analyze_documents, read_collection, write_bm25_index
+from web_agent_site.engine.engine import get_index_path, iter_search_documents
+
+BUILD_VERSION = 1
+
+# Backends with indexes of their own, and those built by default
+INDEX_BACKENDS = ('lucene', 'bm25', 'dense')
+DEFAULT_BACKENDS = ('lucene', 'bm25')
+
+# Lucene indexes storing the raw documents (`--raw`), only to benchmark against
+RAW_LUCENE = 'lucene_raw'
+
+# Number of products of each collection (None for all of them)
+SUBSETS = [100, 1000, 100000, None]
+
+MANIFEST_NAME = 'build_manifest.json'
+
+def get_collection_path(num_products):
+    """Directory of the documents of the `num_products` collection, next to its indexes"""
+    index_path = get_index_path(num_products)
+    return join(dirname(index_path), basename(index_path).replace('indexes', 'resources'))
+
+
+def iter_shards(docs, shard_size):
+    """Split `docs` into shards of up to `shard_size` documents, cut at the end of each subset collection"""
+    bounds = set(n for n in SUBSETS if n is not None)
+    shard = []
+    num_docs = 0
+    for doc in docs:
+        shard.append(doc)
+        num_docs += 1
+        if len(shard) == shard_size or num_docs in bounds:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def get_target_path(backend, num_products):
+    """Directory of the `backend` index of the `num_products` collection, including `RAW_LUCENE` ones"""
+    if backend == RAW_LUCENE:
+        return get_index_path(num_products, 'lucene') + '_raw'
+    return get_index_path(num_products, backend)
+
+
+def get_fingerprint(file_path, backend, encoder=dense.DEFAULT_ENCODER):
+    stat = os.stat(file_path)
+    fingerprint = dict(
+        build_version=BUILD_VERSION,
+        index_version=dict(bm25=bm25.INDEX_VERSION, dense=dense.INDEX_VERSION).get(backend),
+        source=dict(path=abspath(file_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns),
+    )
+    if backend == 'dense':
+        fingerprint['encoder'] = encoder
+    return fingerprint
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_manifest(manifest, path):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _process_shard(shard, docs, collection_path, analyze):
+    """Write the documents of a shard, and analyze them if `analyze`"""
+    with open(join(collection_path, f'docs{shard:05d}.jsonl'), 'w') as f:
+        for doc in docs:
+            f.write(json.dumps(doc) + '\n')
+    if analyze:
+        return analyze_documents((doc['id'], doc['contents']) for doc in docs)
+    return None
+
+
+def write_collections(docs, shard_size, workers, analyze):
+    """
+    Write `docs` to every collection. Returns the number of documents up to
+    the end of each shard, and the analyzed shards (`bm25.IndexPart`s, or
+    Nones if not `analyze`).
+    """
+    full_path = get_collection_path(None)
+    for num_products in SUBSETS:
+        path = get_collection_path(num_products)
+        os.makedirs(path, exist_ok=True)
+        # Documents of earlier builds (including `convert_product_file_format.py`)
+        for filename in glob.glob(join(path, '*.jsonl')):
+            os.remove(filename)
+
+    shard_ends = []
+    parts = []
+    with multiprocessing.Pool(workers) as pool:
+        pending = []
+        for shard, shard_docs in enumerate(iter_shards(docs, shard_size)):
+            shard_ends.append((shard_ends[-1] if shard_ends else 0) + len(shard_docs))
+            pending.append(pool.apply_async(
+                _process_shard, (shard, shard_docs, full_path, analyze)
+            ))
+            # Stop reading products while every worker has a shard queued
+            if len(pending) >= 2 * workers:
+                parts.append(pending.pop(0).get())
+        parts.extend(result.get() for result in pending)
+
+    for num_products in SUBSETS:
+        if num_products is None:
+            continue
+        path = get_collection_path(num_products)
+        for shard, end in enumerate(shard_ends):
+            if end > num_products:
+                break
+            filename = f'docs{shard:05d}.jsonl'
+            try:
+                os.link(join(full_path, filename), join(path, filename))
+            except OSError:
+                shutil.copyfile(join(full_path, filename), join(path, filename))
+    return shard_ends, parts
+
+
+def get_num_subset_shards(shard_ends, num_products):
+    if num_products is None:
+        return len(shard_ends)
+    return sum(1 for end in shard_ends if end <= num_products)
+
+
+def build_lucene_index(num_products, threads, store_raw=False):
+    """
+    Run pyserini's indexer on the `num_products` collection, returns its exit
+    code. With `store_raw`, the raw documents are stored too, in the `_raw` index.
+    """
+    return subprocess.run([
+        sys.executable, '-m', 'pyserini.index.lucene',
+        '--collection', 'JsonCollection',
+        '--input', get_collection_path(num_products),
+        '--index', get_target_path(RAW_LUCENE if store_raw else 'lucene', num_products),
+        '--generator', 'DefaultLuceneDocumentGenerator',
+        '--threads', str(threads),
+        '--storePositions', '--storeDocvectors',
+    ] + (['--storeRaw'] if store_raw else []), stdout=subprocess.DEVNULL).returncode
+
+
+def report(name, num_docs, seconds):
+    print(f'{name}: {num_docs} documents in {seconds:.1f}s ({num_docs / max(seconds, 1e-9):.0f} docs/s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file_path', default=DEFAULT_FILE_PATH)
+    parser.add_argument('--backends', nargs='+', choices=INDEX_BACKENDS, default=list(DEFAULT_BACKENDS))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shard_size', type=int, default=10000)
+    parser.add_argument('--force', action='store_true', help='Rebuild indexes even if their inputs are unchanged')
+    parser.add_argument('--encoder', default=dense.DEFAULT_ENCODER, help='transformers model of the dense indexes')
+    parser.add_argument('--batch_size', type=int, default=dense.DEFAULT_BATCH_SIZE, help='Batch size of the encoder')
+    parser.add_argument('--raw', action='store_true', help='Also build Lucene indexes storing the raw documents')
+    args = parser.parse_args()
+
+    manifest_path = join(dirname(get_index_path(None)), MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    backends = args.backends + ([RAW_LUCENE] if args.raw else [])
+    stale = [
+        (backend, num_products)
+        for backend in backends for num_products in SUBSETS
+        if args.force
+        or manifest.get(basename(get_target_path(backend, num_products)))
+        != get_fingerprint(args.file_path, backend, args.encoder)
+        or not os.path.isdir(get_target_path(backend, num_products))
+    ]
+    if not stale:
+        print('All indexes are up to date.')
+        return
+    if any(backend == 'dense' for backend, _ in stale):
+        # Dense indexes all take their vectors from those of all products, which are encoded again
+        stale += [('dense', num_products) for num_products in SUBSETS if ('dense', num_products) not in stale]
+
+    old_time = time.time()
+    shard_ends, parts = write_collections(
+        iter_search_documents(args.file_path),
+        args.shard_size,
+        args.workers,
+        any(backend == 'bm25' for backend, _ in stale),
+    )
+    total_docs = shard_ends[-1] if shard_ends else 0
+    report('Documents', total_docs, time.time() - old_time)
+
+    dense_path = get_index_path(None, 'dense')
+    if any(backend == 'dense' for backend, _ in stale):
+        old_time = time.time()
+        encoder = dense.Encoder(args.encoder)
+        dense.encode_documents(
+            read_collection(get_collection_path(None)), dense_path, encoder, args.batch_size
+        )
+        report('Embeddings', total_docs, time.time() - old_time)
+
+    def build(target):
+        backend, num_products = target
+        start_time = time.time()
+        if backend in ('lucene', RAW_LUCENE):
+            if build_lucene_index(num_products, args.workers, backend == RAW_LUCENE) != 0:
+                return None
+            num_docs = total_docs if num_products is None else min(num_products, total_docs)
+        elif backend == 'bm25':
+            num_docs = write_bm25_index(
+                parts[:get_num_subset_shards(shard_ends, num_products)],
+                get_index_path(num_products, 'bm25'),
+            )
+        else:
+            num_docs = dense.write_dense_index(
+                get_index_path(num_products, 'dense'),
+                encoder.model_name,
+                encoder.dim,
+                source=dense_path,
+                num_docs=num_products,
+            )
+        return num_docs, time.time() - start_time
+
+    old_time = time.time()
+    lucene = [target for target in stale if target[0] in ('lucene', RAW_LUCENE)]
+    others = [target for target in stale if target[0] not in ('lucene', RAW_LUCENE)]
+    with ThreadPoolExecutor(1 + len(others)) as executor:
+        # Each Lucene build already runs `--workers` threads, so they run one at a time
+        lucene_results = executor.submit(lambda: [build(target) for target in lucene])
+        results = dict(zip(others, executor.map(build, others)))
+        results.update(zip(lucene, lucene_results.result()))
+    failed = []
+    for backend, num_products in stale:
+        result = results[backend, num_products]
+        name = basename(get_target_path(backend, num_products))
+        if result is None:
+            failed.append(name)
+            continue
+        report(name, *result)
+        manifest[name] = get_fingerprint(args.file_path, backend, args.encoder)
+    save_manifest(manifest, manifest_path)
+    print(f'Built {len(stale) - len(failed)} indexes in {time.time() - old_time:.1f}s')
+    if failed:
+        raise RuntimeError('Failed to build indexes: ' + ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,37 @@
+"""
+Convert the products to the documents pyserini indexes (`id` and `contents`),
+for the collections of the first 100, 1k and 100k products and of all of them.
+
+Products are streamed from the product file and each document is written to
+every collection it belongs to as soon as it is built, so memory use does not
+grow with the catalog. `build_indexes.py` does this and builds the indexes.
+"""
 import sys
 import json
 from tqdm import tqdm
 sys.path.insert(0, '../')
 
 from web_agent_site.utils import DEFAULT_FILE_PATH
-from web_agent_site.engine.engine import load_products
-
-all_products, *_ = load_products(filepath=DEFAULT_FILE_PATH)
-
-
-docs = []
-for p in tqdm(all_products, total=len(all_products)):
-    option_texts = []
-    options = p.get('options', {})
-    for option_name, option_contents in options.items():
-        option_contents_text = ', '.join(option_contents)
-        option_texts.append(f'{option_name}: {option_contents_text}')
-    option_text = ', and '.join(option_texts)
-
-    doc = dict()
-    doc['id'] = p['asin']
-    doc['contents'] = ' '.join([
-        p['Title'],
-        p['Description'],
-        p['BulletPoints'][0],
-        option_text,
-    ]).lower()
-    doc['product'] = p
-    docs.append(doc)
-
-
-with open('./resources_100/documents.jsonl', 'w+') as f:
-    for doc in docs[:100]:
-        f.write(json.dumps(doc) + '\n')
-
-with open('./resources/documents.jsonl', 'w+') as f:
-    for doc in docs:
-        f.write(json.dumps(doc) + '\n')
-
-with open('./resources_1k/documents.jsonl', 'w+') as f:
-    for doc in docs[:1000]:
-        f.write(json.dumps(doc) + '\n')
-
-with open('./resources_100k/documents.jsonl', 'w+') as f:
-    for doc in docs[:100000]:
-        f.write(json.dumps(doc) + '\n')
+from web_agent_site.engine.engine import iter_search_documents
+
+# Collection directory and number of products of each collection (None for all)
+COLLECTIONS = [
+    ('./resources_100', 100),
+    ('./resources', None),
+    ('./resources_1k', 1000),
+    ('./resources_100k', 100000),
+]
+
+files = [
+    (open(f'{path}/documents.jsonl', 'w+'), num_products)
+    for path, num_products in COLLECTIONS
+]
+try:
+    for i, doc in enumerate(tqdm(iter_search_documents(DEFAULT_FILE_PATH))):
+        line = json.dumps(doc) + '\n'
+        for f, num_products in files:
+            if num_products is None or i < num_products:
+                f.write(line)
+finally:
+    for f, _ in files:
+        f.close()
@@ -1,4 +1,3 @@
-import json
 from pyserini.search.lucene import LuceneSearcher
 from rich import print
 
@@ -7,9 +6,7 @@ searcher = LuceneSearcher('indexes')
 hits = searcher.search('rubber sole shoes', k=20)
 
 for hit in hits:
-    doc = searcher.doc(hit.docid)
-    print(doc)
-    obj = json.loads(doc.raw())['product']['Title']
-    print(obj)
+    # The docid of each hit is the product's ASIN
+    print(hit.docid, hit.score)
 
 print(len(hits))
@@ -1,31 +1,5 @@
-python -m pyserini.index.lucene \
-  --collection JsonCollection \
-  --input resources_100 \
-  --index indexes_100 \
-  --generator DefaultLuceneDocumentGenerator \
-  --threads 1 \
-  --storePositions --storeDocvectors --storeRaw
-
-python -m pyserini.index.lucene \
-  --collection JsonCollection \
-  --input resources \
-  --index indexes \
-  --generator DefaultLuceneDocumentGenerator \
-  --threads 1 \
-  --storePositions --storeDocvectors --storeRaw
-
-python -m pyserini.index.lucene \
-  --collection JsonCollection \
-  --input resources_1k \
-  --index indexes_1k \
-  --generator DefaultLuceneDocumentGenerator \
-  --threads 1 \
-  --storePositions --storeDocvectors --storeRaw
-
-python -m pyserini.index.lucene \
-  --collection JsonCollection \
-  --input resources_100k \
-  --index indexes_100k \
-  --generator DefaultLuceneDocumentGenerator \
-  --threads 1 \
-  --storePositions --storeDocvectors --storeRaw
+#!/bin/bash
+# Builds the Lucene and BM25 indexes of every collection (100, 1k, 100k and
+# all products) in one pass, skipping those that are up to date; see
+# `build_indexes.py` for its options (e.g. `--force`, `--workers N`)
+python build_indexes.py "$@"
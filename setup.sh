@@ -25,6 +25,7 @@ fi
 # pip install -r requirements.txt;
 
 # Install Environment Dependencies via `conda`
+# Optional: HNSW graphs of the dense indexes (`search_engine/build_indexes.py --backends dense`)
 # conda install -c pytorch faiss-cpu;
 conda install -c conda-forge openjdk=11;
 
@@ -49,12 +50,13 @@ python -m spacy download en_core_web_lg
 
 # Build search engine index
 cd search_engine
-mkdir -p resources resources_100 resources_1k resources_100k
-python convert_product_file_format.py # convert items.json => required doc format
-mkdir -p indexes
-./run_indexing.sh
+python build_indexes.py # convert items.json => required doc format, then index it
 cd ..
 
+# Build binary snapshots of the product catalog (human and synthetic goals) for fast startup
+python -m web_agent_site.engine.snapshot --human_goals
+python -m web_agent_site.engine.snapshot
+
 # Create logging folder + samples of log data
 get_human_trajs () {
   PYCMD=$(cat <<EOF
@@ -0,0 +1,58 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from web_agent_site.engine.analysis import *
+
+@pytest.mark.parametrize(
+    ['word', 'expected'],
+    [
+        ('caresses', 'caress'),
+        ('ponies', 'poni'),
+        ('cats', 'cat'),
+        ('agreed', 'agre'),
+        ('hopping', 'hop'),
+        ('filing', 'file'),
+        ('happy', 'happi'),
+        ('relational', 'relat'),
+        ('sensibility', 'sensibl'),
+        ('archaeology', 'archaeolog'),
+        ('electrical', 'electr'),
+        ('adjustable', 'adjust'),
+        ('controlling', 'control'),
+        ('shoes', 'shoe'),
+        ('as', 'as'),
+    ]
+)
+def test_porter_stemmer(word, expected):
+    assert PorterStemmer().stem(word) == expected
+
+@pytest.mark.parametrize(
+    ['text', 'expected'],
+    [
+        ("Women's Running Shoes", ['women', 'run', 'shoe']),
+        ('a pair of shoes for the beach', ['pair', 'shoe', 'beach']),
+        ('long-lasting, 3.5 oz', ['long', 'last', '3.5', 'oz']),
+        ('price: $1,000', ['price', '1,000']),
+        ("don't e.g.", ["don't", 'e.g']),
+        ('', []),
+    ]
+)
+def test_analyzer(text, expected):
+    assert Analyzer().analyze(text) == expected
+
+def test_porter_stemmer_threads():
+    # Switch threads often, so that concurrent stems interleave
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        words = ['caresses', 'relational', 'controlling', 'sensibility', 'hopping', 'archaeology'] * 500
+        stemmer = PorterStemmer()
+        expected = [stemmer.stem(word) for word in words]
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda i: [stemmer.stem(word) for word in words[i:] + words[:i]], range(8)))
+    finally:
+        sys.setswitchinterval(switch_interval)
+    for i, result in enumerate(results):
+        assert result == expected[i:] + expected[:i]
@@ -0,0 +1,170 @@
+import json
+import math
+import sys
+
+import pytest
+
+from web_agent_site.engine.analysis import stem
+from web_agent_site.engine.bm25 import *
+from web_agent_site.engine.search import (
+    CachedSearcher,
+    DocumentFields,
+    FieldSearcher,
+    FilteredSearcher,
+    SearchFilter,
+    search_asins,
+)
+
+DOCS = [
+    ('B3', 'red running shoes'),
+    ('B1', 'blue running shoes for men'),
+    ('B2', 'red dress with red buttons'),
+    ('B4', 'shoes'),
+    ('B5', 'blue shoes'),
+    ('B0', 'red shoes'),
+]
+
+@pytest.fixture
+def searcher(tmp_path):
+    assert build_bm25_index(iter(DOCS), tmp_path / 'index') == len(DOCS)
+    return BM25Searcher(tmp_path / 'index')
+
+def bm25(query_terms, doc_terms, all_doc_terms, k1=0.9, b=0.4):
+    avgdl = sum(len(terms) for terms in all_doc_terms) / len(all_doc_terms)
+    score = 0
+    for term in query_terms:
+        df = sum(term in terms for terms in all_doc_terms)
+        tf = doc_terms.count(term)
+        if tf:
+            idf = math.log(1 + (len(all_doc_terms) - df + 0.5) / (df + 0.5))
+            score += idf * tf / (tf + k1 * (1 - b + b * len(doc_terms) / avgdl))
+    return score
+
+def test_encode_length():
+    for length in range(24):
+        assert decode_length(encode_length(length)) == length
+    # Longer lengths lose precision, as Lucene's norms do
+    assert decode_length(encode_length(100)) == 96
+    assert all(0 <= encode_length(length) < 256 for length in (10 ** 3, 10 ** 6, 2 ** 31 - 1))
+
+def test_bm25_searcher(searcher):
+    all_doc_terms = [searcher.analyzer.analyze(contents) for _, contents in DOCS]
+    hits = searcher.search('red shoes', k=10)
+    expected = sorted(
+        (
+            (bm25(['red', 'shoe'], terms, all_doc_terms), docid)
+            for (docid, _), terms in zip(DOCS, all_doc_terms)
+        ),
+        key=lambda x: (-x[0], x[1])
+    )
+    assert [hit.docid for hit in hits] == [docid for _, docid in expected]
+    for hit, (score, _) in zip(hits, expected):
+        assert hit.score == pytest.approx(score, rel=1e-5)
+
+    assert searcher.search('red shoes', k=2) == hits[:2]
+    assert searcher.search('the purple', k=10) == []
+    assert searcher.search('', k=10) == []
+
+def test_bm25_searcher_ties(searcher):
+    # 'B0' and 'B5' tie and are ranked by docid, whatever their order in the collection
+    hits = searcher.search('shoes', k=3)
+    assert [hit.docid for hit in hits] == ['B4', 'B0', 'B5']
+    assert hits[1].score == hits[2].score
+
+def test_bm25_searcher_query_term_counts(searcher):
+    # Repeated query terms weigh more, as in Anserini's bag-of-words queries
+    once = {hit.docid: hit.score for hit in searcher.search('red shoes', k=10)}
+    twice = {hit.docid: hit.score for hit in searcher.search('red red shoes', k=10)}
+    assert twice['B4'] == pytest.approx(once['B4'])
+    assert twice['B2'] == pytest.approx(2 * once['B2'])
+
+def test_bm25_searcher_batch_search_threads(tmp_path):
+    # Words of many stems, most of which the stemmer changes
+    words = [
+        base + suffix
+        for base in ['relat', 'control', 'sensibl', 'adjust', 'electr', 'gener', 'condit', 'hop', 'run', 'form']
+        for suffix in ['ational', 'izations', 'fulness', 'iveness', 'ing', 'ed', 'ies', 'ably', 'ements', 'ousli']
+    ]
+    docs = [(f'B{i:03d}', ' '.join(words[i:i + 3])) for i in range(len(words))]
+    build_bm25_index(iter(docs), tmp_path / 'index')
+    searcher = BM25Searcher(tmp_path / 'index')
+    queries = [f'{a} {b}' for a in words for b in words[::7]]
+    qids = [str(i) for i in range(len(queries))]
+
+    # Stem the words of the queries on threads first, switching threads often
+    stem.cache_clear()
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        results = searcher.batch_search(queries, qids, k=10, threads=8)
+    finally:
+        sys.setswitchinterval(switch_interval)
+    stem.cache_clear()
+    assert results == searcher.batch_search(queries, qids, k=10, threads=1)
+
+def test_bm25_searcher_cached(searcher):
+    search_engine = CachedSearcher(searcher, cache_size=10)
+    assert search_asins(search_engine, ['Red', 'Dress'], 50) == ('B2', 'B0', 'B3')
+    assert search_engine.cache_info().misses == 1
+
+def test_bm25_index_version(tmp_path, searcher):
+    path = searcher.path
+    with open(path / 'meta.json') as f:
+        meta = json.load(f)
+    meta['version'] = INDEX_VERSION + 1
+    with open(path / 'meta.json', 'w') as f:
+        json.dump(meta, f)
+    with pytest.raises(ValueError):
+        BM25Searcher(path)
+
+def test_write_bm25_index_parts(tmp_path, searcher):
+    # Indexing the documents in parts gives the same index
+    parts = [analyze_documents(DOCS[:2]), analyze_documents(DOCS[2:])]
+    assert write_bm25_index(parts, tmp_path / 'parts') == len(DOCS)
+    parts_searcher = BM25Searcher(tmp_path / 'parts')
+    for query in ('red shoes', 'blue', 'running shoes for men'):
+        assert parts_searcher.search(query, k=10) == searcher.search(query, k=10)
+
+def test_bm25_searcher_doc_mask(searcher):
+    doc_mask = searcher.get_doc_mask(['B1', 'B3', 'B9'])
+    assert doc_mask.sum() == 2
+    hits = searcher.search('red shoes', k=10)
+    expected = [hit for hit in hits if hit.docid in ('B1', 'B3')]
+    assert searcher.search('red shoes', k=10, doc_mask=doc_mask) == expected
+
+    # The filter is pushed into the searcher rather than over-fetching
+    filtered = FilteredSearcher(searcher, ['B1', 'B3', 'B9'])
+    assert filtered.doc_mask is not None
+    assert filtered.search('red shoes', k=1) == expected[:1]
+
+def test_bm25_searcher_search_filter(searcher):
+    assert list(searcher.get_doc_positions(['B0', 'B9', 'B5'])) == [0, -1, 5]
+    fields = DocumentFields(
+        ['B0', 'B1', 'B2', 'B3', 'B4'],
+        [10.0, 25.0, 40.0, 5.0, 30.0],
+        ['fashion', 'sports', 'fashion', 'sports', 'fashion'],
+        ['red shoes', 'running shoes', 'red dress', 'running shoes', 'shoes'],
+        ['Clothing › Shoes', 'Sports › Shoes', 'Clothing › Dresses', 'Sports › Shoes', 'Clothing › Shoes'],
+    )
+    filtered = FieldSearcher(searcher, fields, restrict=True)
+    hits = searcher.search('red shoes', k=10)
+    for search_filter in [
+        SearchFilter(price_upper=25.0),
+        SearchFilter(price_lower=10.0, price_upper=30.0, category='fashion'),
+        SearchFilter(query='running shoes'),
+        SearchFilter(product_category='Shoes'),
+        SearchFilter(category='grocery'),
+        SearchFilter(),
+    ]:
+        # Filtered searches rank as a brute force filter of the full ranking
+        allowed = {asin for asin, mask in zip(fields.asins, fields.get_mask(search_filter)) if mask}
+        expected = [hit for hit in hits if hit.docid in allowed]
+        assert filtered.search('red shoes', k=10, search_filter=search_filter) == expected
+        assert filtered.search('red shoes', k=1, search_filter=search_filter) == expected[:1]
+    # B5 is not in the catalog of the fields
+    assert 'B5' not in [hit.docid for hit in filtered.search('blue shoes', k=10)]
+    assert FieldSearcher(searcher, fields).search('blue shoes', k=10) == searcher.search('blue shoes', k=10)
+
+    search_engine = CachedSearcher(filtered)
+    assert search_asins(search_engine, ['red', 'shoes'], 10, SearchFilter(category='sports')) == ('B3', 'B1')
+    assert search_asins(search_engine, ['red', 'shoes'], 10, SearchFilter()) == ('B0', 'B3', 'B2', 'B4', 'B1')
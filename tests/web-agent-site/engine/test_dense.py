@@ -0,0 +1,99 @@
+import zlib
+
+import numpy as np
+import pytest
+
+from web_agent_site.engine.bm25 import BM25Searcher, build_bm25_index
+from web_agent_site.engine.dense import *
+from web_agent_site.engine.search import FilteredSearcher
+
+WORDS = ['red', 'blue', 'green', 'shoes', 'dress', 'shirt', 'running', 'cotton', 'leather', 'men', 'women']
+
+class FakeEncoder:
+    """Normalized hashed bag of words"""
+    model_name = 'fake'
+    dim = 16
+
+    def encode(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.split():
+                vectors[i, zlib.crc32(word.encode()) % self.dim] += 1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+@pytest.fixture
+def docs():
+    rng = np.random.default_rng(0)
+    return [
+        (f'B{i:03d}', ' '.join(rng.choice(WORDS, size=rng.integers(1, 6))))
+        for i in range(300)
+    ]
+
+@pytest.fixture
+def index(tmp_path, docs):
+    assert build_dense_index(iter(docs), tmp_path / 'dense', FakeEncoder(), batch_size=7) == len(docs)
+    return tmp_path / 'dense'
+
+def exact_search(docs, query, k, allowed=None):
+    encoder = FakeEncoder()
+    vectors = encoder.encode([contents for _, contents in docs]).astype(np.float16).astype(np.float32)
+    scores = vectors @ encoder.encode([query])[0]
+    ranked = sorted(
+        (-score, i) for i, score in enumerate(scores)
+        if allowed is None or docs[i][0] in allowed
+    )
+    return [docs[i][0] for _, i in ranked[:k]]
+
+def test_dense_searcher_exact(index, docs):
+    searcher = DenseSearcher(index, encoder=FakeEncoder(), nprobe=1000, use_faiss=False)
+    assert searcher.num_docs == len(docs)
+    for query in ['red shoes', 'cotton shirt women', 'leather', 'unknown']:
+        assert [hit.docid for hit in searcher.search(query, k=20)] == exact_search(docs, query, 20)
+    results = searcher.batch_search(['red shoes', 'leather'], ['1', '2'], k=5)
+    assert results == {'1': searcher.search('red shoes', k=5), '2': searcher.search('leather', k=5)}
+
+    allowed = {docid for docid, _ in docs[::7]}
+    filtered = FilteredSearcher(searcher, allowed)
+    assert [hit.docid for hit in filtered.search('red shoes', k=10)] == exact_search(docs, 'red shoes', 10, allowed)
+
+def test_dense_searcher_lists(index, docs):
+    searcher = DenseSearcher(index, encoder=FakeEncoder(), nprobe=4, use_faiss=False)
+    assert len(searcher.centroids) == get_num_lists(len(docs))
+    assert sorted(searcher.list_docs) == list(range(len(docs)))
+    # Searching some of the lists finds most of the nearest documents
+    recall = np.mean([
+        len(set(hit.docid for hit in searcher.search(query, k=10)) & set(exact_search(docs, query, 10))) / 10
+        for query in ['red shoes', 'blue dress', 'cotton shirt', 'men running']
+    ])
+    assert recall >= 0.5
+    # Filtered searches return as many allowed documents as there are
+    allowed = {docid for docid, _ in docs[:3]}
+    assert len(FilteredSearcher(searcher, allowed).search('red', k=10)) == 3
+
+def test_write_dense_index_subset(tmp_path, index, docs):
+    assert write_dense_index(tmp_path / 'subset', 'fake', FakeEncoder.dim, source=index, num_docs=50) == 50
+    searcher = DenseSearcher(tmp_path / 'subset', encoder=FakeEncoder(), nprobe=1000, use_faiss=False)
+    assert [hit.docid for hit in searcher.search('red shoes', k=10)] == exact_search(docs[:50], 'red shoes', 10)
+
+def test_fuse_hits():
+    sparse = [SearchHit('B1', 10.0), SearchHit('B2', 5.0), SearchHit('B3', 0.0)]
+    dense = [SearchHit('B3', 0.9), SearchHit('B1', 0.5), SearchHit('B4', 0.1)]
+    hits = fuse_hits(sparse, dense, k=3, alpha=0.5)
+    assert [hit.docid for hit in hits] == ['B1', 'B3', 'B2']
+    assert hits[0].score == pytest.approx(0.5 + 0.5 * 0.5)
+    assert fuse_hits(sparse, [], k=2, alpha=0.5) == [SearchHit('B1', 0.5), SearchHit('B2', 0.25)]
+    assert [hit.docid for hit in fuse_hits(sparse, dense, k=4, alpha=1.0)][:2] == ['B3', 'B1']
+
+def test_hybrid_searcher(tmp_path, index, docs):
+    build_bm25_index(iter(docs), tmp_path / 'bm25')
+    sparse = BM25Searcher(tmp_path / 'bm25')
+    dense = DenseSearcher(index, encoder=FakeEncoder(), nprobe=1000, use_faiss=False)
+    hybrid = HybridSearcher(sparse, dense, alpha=0.3, depth=50)
+    expected = fuse_hits(sparse.search('red shoes', k=50), dense.search('red shoes', k=50), 10, 0.3)
+    assert hybrid.search('red shoes', k=10) == expected
+    assert hybrid.batch_search(['red shoes'], ['q'], k=10) == {'q': expected}
+
+    allowed = {docid for docid, _ in docs[::5]}
+    hits = FilteredSearcher(hybrid, allowed).search('red shoes', k=10)
+    assert len(hits) == 10 and all(hit.docid in allowed for hit in hits)
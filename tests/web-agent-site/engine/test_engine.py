@@ -0,0 +1,79 @@
+import pytest
+from types import SimpleNamespace
+from web_agent_site.engine.engine import *
+
+@pytest.fixture
+def all_products():
+    return [
+        {'asin': 'B1', 'category': 'beauty', 'query': 'lipstick', 'Attributes': ['matte', 'vegan']},
+        {'asin': 'B2', 'category': 'fashion', 'query': 'red dress', 'Attributes': ['cotton']},
+        {'asin': 'B3', 'category': 'beauty', 'query': 'red dress', 'Attributes': ['vegan', 'vegan']},
+        {'asin': 'B4', 'category': 'fashion', 'query': 'lipstick', 'Attributes': ['DUMMY_ATTR']},
+    ]
+
+@pytest.mark.parametrize(
+    'keywords',
+    [
+        ['<c>', 'beauty'],
+        ['<c>', 'grocery'],
+        ['<q>', 'red', 'dress'],
+        ['<q>', 'shoes'],
+        ['<a>', 'vegan'],
+        ['<a>', 'cotton'],
+        ['<a>', 'waterproof'],
+    ]
+)
+def test_get_top_n_product_from_keywords_index(all_products, keywords):
+    attribute_to_asins = defaultdict(set)
+    for p in all_products:
+        for a in p['Attributes']:
+            attribute_to_asins[a].add(p['asin'])
+    product_item_dict = {p['asin']: p for p in all_products}
+    product_index = build_product_index(all_products)
+
+    scanned = get_top_n_product_from_keywords(
+        keywords, None, all_products, product_item_dict, attribute_to_asins
+    )
+    indexed = get_top_n_product_from_keywords(
+        keywords, None, all_products, product_item_dict, product_index=product_index
+    )
+    assert list(indexed) == scanned
+    assert get_product_per_page(indexed, 1) == tuple(scanned[:PRODUCT_WINDOW])
+
+def test_get_top_n_product_from_keywords_batch(all_products):
+    class FakeSearcher:
+        def search(self, query, k=10):
+            return [SimpleNamespace(docid=asin) for asin in ('B3', 'X', 'B1') if query][:k]
+
+    keywords_list = [['red', 'dress'], ['<c>', 'beauty'], ['<q>', 'lipstick'], ['red', 'dress'], ['lipstick']]
+    product_item_dict = {p['asin']: p for p in all_products}
+    product_index = build_product_index(all_products)
+    results = get_top_n_product_from_keywords_batch(
+        keywords_list, FakeSearcher(), all_products, product_item_dict, product_index=product_index
+    )
+    assert results == [
+        get_top_n_product_from_keywords(
+            keywords, FakeSearcher(), all_products, product_item_dict, product_index=product_index
+        )
+        for keywords in keywords_list
+    ]
+    assert [p['asin'] for p in results[0]] == ['B3', 'B1']
+
+def test_get_session_search_results():
+    searches = []
+    def search(keywords):
+        searches.append(keywords)
+        return [{'asin': ' '.join(keywords)}]
+
+    session = {}
+    first = get_session_search_results(session, ['red', 'dress'], search)
+    # Other pages of the same keywords are not searched again
+    assert get_session_search_results(session, ['red', 'dress'], search) is first
+    assert len(searches) == 1
+    get_session_search_results(session, ['lipstick'], search)
+    get_session_search_results(session, ['red', 'dress'], search)
+    assert len(searches) == 3
+    # Random samples are drawn on every page
+    get_session_search_results(session, ['<r>'], search)
+    get_session_search_results(session, ['<r>'], search)
+    assert len(searches) == 5
@@ -1,6 +1,14 @@
 import pytest
 from math import isclose
 from web_agent_site.engine.goal import *
+import multiprocessing
+import random
+from collections import OrderedDict
+import numpy as np
+import spacy
+from thefuzz import fuzz
+import web_agent_site.engine.goal
+from web_agent_site.engine.goal import _fuzz_process
 
 def test_get_type_reward():
     # Exact Match
@@ -197,4 +205,147 @@ def test_get_reward():
     purchased['query'] = "Query 2"
     purchased['product_category'] = "a › d › e"
     total_reward = get_reward(purchased, goal, 35, purchased['goal_options'])
-    assert isclose(total_reward, 0.2857, abs_tol=1e-2)
\ No newline at end of file
+    assert isclose(total_reward, 0.2857, abs_tol=1e-2)
+
+@pytest.fixture
+def pos_nlp(monkeypatch):
+    # Tags a fixed list of nouns, through the same components as en_core_web_sm
+    pos_nlp = spacy.blank('en')
+    ruler = pos_nlp.add_pipe('attribute_ruler')
+    for noun in ['shoes', 'dress', 'shirt', 'Nike', 'nike']:
+        ruler.add([[{'ORTH': noun}]], {'POS': 'PROPN' if noun[0].isupper() else 'NOUN'})
+    pos_nlp.add_pipe('sentencizer')
+    monkeypatch.setattr('web_agent_site.engine.goal.nlp', pos_nlp)
+    monkeypatch.setattr('web_agent_site.engine.goal.name_nouns', NounCache())
+    return pos_nlp
+
+def test_name_nouns(tmp_path, pos_nlp):
+    nouns = NounCache()
+    assert nouns.get('Nike running shoes and dress shoes') == (frozenset(['nike', 'shoes', 'dress']), 4)
+    assert nouns.add(['red dress', 'blue shirt', 'red dress', 'Nike running shoes and dress shoes']) == 2
+    assert nouns.get('blue shirt') == (frozenset(['shirt']), 1)
+
+    nouns.save(str(tmp_path / 'nouns' / 'name_nouns.pkl'))
+    loaded = NounCache()
+    loaded.load(str(tmp_path / 'nouns' / 'name_nouns.pkl'))
+    assert loaded.nouns == nouns.nouns
+    loaded.load(str(tmp_path / 'missing.pkl'))
+    assert len(loaded) == 3
+
+def test_get_type_reward_precomputed(tmp_path, pos_nlp):
+    goal = {'query': 'q', 'product_category': 'a › b', 'name': 'Nike shoes and shoes'}
+    purchased = {'query': 'r', 'product_category': 'c', 'name': 'dress shoes'}
+    expected = get_type_reward(purchased, goal)
+    assert expected['title_score'] == 1 / 3
+
+    path = str(tmp_path / 'name_nouns.pkl')
+    precompute_name_nouns([purchased], [goal], path)
+    assert get_type_reward(purchased, goal) == expected
+    web_agent_site.engine.goal.name_nouns.nouns.clear()
+    precompute_name_nouns([], [], path)
+    assert len(web_agent_site.engine.goal.name_nouns) == 2
+
+def test_get_fuzzy_match_scores():
+    rng = random.Random(0)
+    words = ['tea', 'tree', 'teas', 'oil', 'oils', 'essential', 'natural', 'XL', 'x-large', 'café', 'Pack', 'of', '12', '1/2', '&']
+    strings = [' '.join(rng.choices(words, k=rng.randint(1, 5))) for _ in range(200)]
+    strings += ['', ' ', '---', 'grey', ('color', 'grey'), 'größe 38']
+    queries, choices = strings[:60], strings[60:]
+    scores = get_fuzzy_match_scores(queries, choices)
+    assert scores.shape == (len(queries), len(choices))
+    # Exactly the scores of thefuzz, one pair at a time
+    for i, query in enumerate(queries):
+        for j, choice in enumerate(choices):
+            assert scores[i, j] == fuzz.token_set_ratio(choice, query)
+    assert get_fuzzy_match_scores(queries, []).shape == (len(queries), 0)
+    # Rewards score with a cutoff, matching the same pairs
+    matches = web_agent_site.engine.goal._get_processed_matches(
+        [_fuzz_process(query) for query in queries],
+        [_fuzz_process(choice) for choice in choices],
+    )
+    assert (matches == (scores > 85)).all()
+
+# `fuzz.token_set_ratio` of pairs around the reward cutoff (85), and of pairs later
+# versions score differently, computed with thefuzz 0.19.0 and python-Levenshtein 0.12.2
+@pytest.mark.parametrize(
+    'query, choice, score',
+    [
+        ('allocated', 'allocotejd', 84),
+        ('sky two-piece', 'skg two-piefc', 85),
+        ('hashlib.sha1', 'hkyashlibasha1', 85),
+        ('ips', 'ipxs', 86),
+        ('punjabi', 'gunjabi', 86),
+        ('necessary. yaml', 'necessary.qiyahl', 87),
+        ('non slip rubber sole', 'non_slip rubber sole', 95),
+        ('long_lasting', 'long lasting', 58),
+        ('machine wash', 'machine_washable', 79),
+        ('café latte', 'cafe latte', 95),
+        ('größe 38 schwarz', 'grosse 38 schwarz', 90),
+        ('x-large', 'x large', 100),
+        ('1/2 inch', '1 2 inch', 100),
+        # Ratios of exactly a half (57.49999999999999 and 85.5 in floating point)
+        ('purchase ethylene opt.get b000000181 creast', 'PURCHASÈGÈTHYLÈNÈ OPT.GÈTBN000000181 CRÈAST', 57),
+        ('x' * 200, 'x' * 171 + 'y' * 29, 86),
+    ]
+)
+def test_get_fuzzy_match_scores_pinned(query, choice, score):
+    assert get_fuzzy_match_scores([query], [choice])[0, 0] == score
+    matches = web_agent_site.engine.goal._get_processed_matches([_fuzz_process(query)], [_fuzz_process(choice)])
+    assert matches[0, 0] == (score > 85)
+
+def test_get_attribute_reward_cached():
+    product = {
+        'asin': 'B1',
+        'Attributes': ['tea tree', 'oil'],
+        'Title': 'Shampoo',
+        'BulletPoints': ['With Essential Oils'],
+        'Description': '',
+    }
+    goal = {'attributes': ['tea tree', 'essential oils', 'natural ingredients']}
+    assert get_attribute_reward(product, goal) == (2 / 3, 2)
+    assert product_match_texts.get('B1').product is product
+    assert get_attribute_reward(product, goal) == (2 / 3, 2)
+
+def test_get_product_match_text(monkeypatch):
+    monkeypatch.setattr('web_agent_site.engine.goal.PRODUCT_MATCH_TEXT_CACHE_SIZE', 2)
+    monkeypatch.setattr('web_agent_site.engine.goal.product_match_texts', OrderedDict())
+    products = [{'asin': f'B{i}', 'Attributes': []} for i in range(3)]
+    match_texts = [get_product_match_text(product) for product in products[:2]]
+    assert get_product_match_text(products[0]) is match_texts[0]
+    # The least recently used product is evicted
+    get_product_match_text(products[2])
+    assert list(web_agent_site.engine.goal.product_match_texts) == ['B0', 'B2']
+    # Another product with the same ASIN replaces the cached one
+    other = {'asin': 'B0', 'Attributes': []}
+    assert get_product_match_text(other).product is other
+
+@pytest.mark.parametrize('processes, start_methods', [(1, None), (2, None), (2, ['spawn'])])
+def test_get_rewards_batch(pos_nlp, monkeypatch, processes, start_methods):
+    if start_methods is not None:
+        # Workers not forked are passed the nouns parsed by `pos_nlp`
+        monkeypatch.setattr('multiprocessing.get_all_start_methods', lambda: start_methods)
+        monkeypatch.setattr('multiprocessing.Pool', multiprocessing.get_context('spawn').Pool)
+    products = [
+        {'asin': 'B1', 'query': 'shoes', 'product_category': 'a › b › c', 'name': 'Nike running shoes',
+         'Attributes': ['leather', 'non slip'], 'Title': 'Nike running shoes', 'BulletPoints': ['Rubber sole'], 'Description': ''},
+        {'asin': 'B2', 'query': 'dress', 'product_category': 'a › d', 'name': 'red dress',
+         'Attributes': ['cotton'], 'Title': 'Red dress', 'BulletPoints': [], 'Description': 'Machine wash'},
+    ]
+    goals = [
+        {'query': 'shoes', 'product_category': 'a › b', 'name': 'running shoes', 'attributes': ['non-slip', 'rubber sole'],
+         'goal_options': {'color': 'black', 'size': '10'}, 'price_upper': 50.0},
+        {'query': 'dress', 'product_category': 'a › d', 'name': 'dress shirt', 'attributes': ['machine wash'],
+         'goal_options': [], 'price_upper': 40.0},
+    ]
+    rows = [(p, g, price, o) for p in products for g in goals for price in (30.0, 60.0)
+            for o in ({'color': 'black'}, {'color': 'Jet Black', 'size': '10'})]
+    rewards = get_rewards_batch(*map(list, zip(*rows)), processes=processes, chunk_size=3)
+    assert set(rewards) == {'reward', 'r_type', 'r_att', 'r_option', 'r_price'}
+    for i, (product, goal, price, options) in enumerate(rows):
+        reward, info = get_reward(product, goal, price, options, verbose=True)
+        assert rewards['reward'][i] == reward
+        for key in ('r_type', 'r_att', 'r_option', 'r_price'):
+            assert rewards[key][i] == info[key] if key in info else np.isnan(rewards[key][i])
+
+    with pytest.raises(ValueError):
+        get_rewards_batch(products, goals[:1], [10.0], [{}])
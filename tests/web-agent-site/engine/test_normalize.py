@@ -1,3 +1,6 @@
+import random
+import re
+
 import pytest
 from web_agent_site.engine.normalize import *
 
@@ -51,3 +54,23 @@ def test_normalize_color_size():
     assert type(size_mapping)  == dict
     assert color_mapping == color_mapping_expected
     assert size_mapping  == size_mapping_expected
+
+def test_normalize_matches_scan():
+    rng = random.Random(0)
+    words = COLOR_SET + SIZE_SET + ['stonewash', 'sky', '32w x 30l', '10"', '5mm', '7.5', '|', 'us women 8 | us men 6', 'neck 34 sleeve']
+    values = [''.join(rng.choices([' ', '', '-'], k=1)).join(rng.choices(words, k=rng.randint(1, 3))) for _ in range(2000)]
+    # The first color and size pattern in order are kept, as a scan of each in turn finds them
+    for value in values:
+        expected_color = None
+        for color in COLOR_SET:
+            if color in value:
+                expected_color = color
+                break
+        assert normalize_color(value) == (expected_color or value)
+        expected_size = next((p.pattern for p in SIZE_PATTERNS if re.search(p, value)), None)
+        if expected_size is None:
+            expected_size = 'numeric_size' if value.replace('.', '', 1).isdigit() else 'not_matched'
+        assert normalize_size(value) == expected_size
+    # Other sequences match colors whole
+    assert normalize_color(('color', 'grey')) == 'grey'
+    assert normalize_color(('color', 'greyish')) == ('color', 'greyish')
@@ -0,0 +1,62 @@
+import pickle
+import sys
+import pytest
+from web_agent_site.engine.product import *
+
+@pytest.fixture
+def product_dict():
+    return {
+        'asin': 'B000000001',
+        'name': 'Red Running Shoes',
+        'Title': 'Red Running Shoes',
+        'full_description': 'Lightweight shoes.',
+        'Description': 'Lightweight shoes.',
+        'small_description': ['Breathable'],
+        'BulletPoints': ['Breathable'],
+        'customization_options': {'Size': [{'value': '10', 'image': None}]},
+        'options': {'size': ['10']},
+        'option_to_image': {'10': None},
+        'images': ['http://img/1.jpg'],
+        'MainImage': 'http://img/1.jpg',
+        'Price': '$19.99',
+        'pricing': [19.99],
+        'Rating': 'N.A.',
+        'Reviews': [],
+        'Attributes': ['lightweight'],
+        'category': 'fashion',
+        'query': 'running shoes',
+        'product_category': 'Shoes',
+        'instruction_text': 'i need red running shoes',
+        'instruction_attributes': ['lightweight'],
+    }
+
+def test_product_from_dict(product_dict):
+    product = Product.from_dict(product_dict)
+    assert dict(product) == {k: v for k, v in product_dict.items() if k in FIELDS}
+    assert product == dict(product)
+    assert product == Product.from_dict(product_dict)
+    assert product != Product.from_dict(dict(product_dict, Price='$1.00'))
+    assert product != Product.from_dict(dict(product_dict, instructions=[]))
+    assert product['name'] == product['Title'] == 'Red Running Shoes'
+    assert product['full_description'] == 'Lightweight shoes.'
+    assert product.get('Title') == 'Red Running Shoes'
+    assert product.options == {'size': ['10']}
+    assert product['category'] is sys.intern('fashion')
+
+    # Fields the product does not have are missing, as from a dict
+    assert 'instructions' not in product
+    assert 'customization_options' not in product
+    assert product.get('instructions') is None
+    with pytest.raises(KeyError):
+        product['images']
+    assert not hasattr(product, '__dict__')
+
+    # Other keys can still be set
+    product['goal_instruction'] = 'i need shoes'
+    assert product['goal_instruction'] == 'i need shoes'
+    assert list(product)[-1] == 'goal_instruction'
+
+def test_product_pickle(product_dict):
+    product = Product.from_dict(product_dict)
+    product['goal_instruction'] = 'i need shoes'
+    assert pickle.loads(pickle.dumps(product)) == product
@@ -0,0 +1,153 @@
+import pytest
+from types import SimpleNamespace
+from web_agent_site.engine.search import *
+
+class FakeSearcher:
+    """Returns documents whose contents contain every query term"""
+    def __init__(self, docs):
+        self.docs = docs
+        self.num_searches = 0
+
+    def search(self, query, k=10):
+        self.num_searches += 1
+        terms = query.lower().split()
+        return [
+            SimpleNamespace(docid=asin)
+            for asin, contents in self.docs.items()
+            if all(t in contents.split() for t in terms)
+        ][:k]
+
+def test_search_cache():
+    cache = SearchCache(maxsize=2)
+    assert cache.get('a') is None
+    cache.put('a', (1,))
+    cache.put('b', (2,))
+    assert cache.get('a') == (1,)
+    cache.put('c', (3,))  # evicts 'b', the least recently used
+    assert 'b' not in cache
+    assert cache.get('c') == (3,)
+    assert cache.cache_info() == CacheInfo(hits=2, misses=1, evictions=1, maxsize=2, currsize=2)
+
+    cache.clear()
+    assert cache.cache_info() == CacheInfo(0, 0, 0, 2, 0)
+
+    disabled = SearchCache(maxsize=0)
+    disabled.put('a', (1,))
+    assert disabled.get('a') is None
+
+def test_cached_searcher():
+    searcher = FakeSearcher({'B1': 'red shoes', 'B2': 'blue shoes', 'B3': 'red dress'})
+    search_engine = CachedSearcher(searcher, cache_size=10)
+    assert search_engine.search_asins(['red', 'shoes'], 50) == ('B1',)
+    assert search_engine.search_asins(['Red', '', 'Shoes'], 50) == ('B1',)
+    assert search_engine.search_asins(['shoes'], 50) == ('B1', 'B2')
+    assert search_engine.search_asins(['shoes'], 1) == ('B1',)
+    assert searcher.num_searches == 3
+    assert search_engine.cache_info().hits == 1
+    assert search_asins(searcher, ['shoes'], 50) == ['B1', 'B2']
+
+    # Wrapped searcher's attributes are still available
+    assert search_engine.docs is searcher.docs
+
+def test_warm_up_search_cache():
+    goals = [
+        {'query': 'shoes', 'attributes': ['red'], 'instruction_text': 'I need Red shoes'},
+        {'query': 'shoes', 'attributes': ['blue', 'red'], 'instruction_text': 'I need blue shoes'},
+    ]
+    queries = get_goal_queries(goals)
+    assert queries == ['shoes', 'red shoes', 'i need red shoes', 'blue shoes', 'i need blue shoes']
+
+    searcher = FakeSearcher({'B1': 'red shoes', 'B2': 'blue shoes'})
+    search_engine = CachedSearcher(searcher, cache_size=3)
+    assert warm_up_search_cache(search_engine, queries, 50) == 3
+    assert search_engine.cache_info() == CacheInfo(0, 0, 0, 3, 3)
+    assert search_engine.search_asins(['red', 'shoes'], 50) == ('B1',)
+    assert searcher.num_searches == 3
+
+def test_get_product_document():
+    product = {
+        'asin': 'B1',
+        'Title': 'Red Shoes',
+        'Description': 'Comfortable.',
+        'BulletPoints': ['Rubber sole', 'Cotton'],
+        'options': {'size': ['7', '8'], 'color': ['red']},
+    }
+    assert get_product_document(product) == {
+        'id': 'B1',
+        'contents': 'red shoes comfortable. rubber sole size: 7, 8, and color: red',
+    }
+
+def test_filtered_searcher():
+    searcher = FakeSearcher({f'B{i}': 'shoes' for i in range(10)})
+    filtered = FilteredSearcher(searcher, ['B2', 'B7', 'B9', 'X'])
+    assert [hit.docid for hit in filtered.search('shoes', k=2)] == ['B2', 'B7']
+    # Over-fetches until enough allowed hits are found, or none are left
+    assert [hit.docid for hit in filtered.search('shoes', k=5)] == ['B2', 'B7', 'B9']
+    assert filtered.search('boots', k=5) == []
+    assert FilteredSearcher(searcher, []).search('shoes', k=5) == []
+
+    # Starts from as many hits as the share of allowed documents requires
+    searcher.num_docs = 10
+    filtered = FilteredSearcher(searcher, ['B2', 'B7', 'B9'])
+    searcher.num_searches = 0
+    assert [hit.docid for hit in filtered.search('shoes', k=2)] == ['B2', 'B7']
+    assert searcher.num_searches == 1
+
+class FakeBatchSearcher(FakeSearcher, SearchBackend):
+    def __init__(self, docs):
+        super().__init__(docs)
+        self.num_batches = 0
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        self.num_batches += 1
+        return super().batch_search(queries, qids, k=k, threads=threads)
+
+def test_search_asins_batch():
+    docs = {'B1': 'red shoes', 'B2': 'blue shoes', 'B3': 'red dress'}
+    keywords_list = [['red'], ['shoes'], ['Red'], ['boots'], ['red', 'shoes']]
+    expected = [search_asins(FakeSearcher(docs), keywords, 50) for keywords in keywords_list]
+    for threads in (1, 4):
+        assert search_asins_batch(FakeBatchSearcher(docs), keywords_list, 50, threads) == expected
+
+    searcher = FakeBatchSearcher(docs)
+    search_engine = CachedSearcher(searcher, cache_size=10)
+    assert search_engine.search_asins(['shoes'], 50) == ('B1', 'B2')
+    results = search_asins_batch(search_engine, keywords_list, 50)
+    assert [list(asins) for asins in results] == expected
+    # One batch, of the distinct queries missing from the cache
+    assert searcher.num_batches == 1
+    assert searcher.num_searches == 4
+    assert search_asins_batch(search_engine, keywords_list, 50) == results
+    assert searcher.num_batches == 1
+
+    # Searchers without `batch_search` search one query at a time
+    assert search_asins_batch(FakeSearcher(docs), keywords_list, 50) == expected
+
+def test_filtered_searcher_batch_search():
+    searcher = FakeBatchSearcher({f'B{i}': 'shoes' if i % 2 else 'red shoes' for i in range(10)})
+    searcher.num_docs = 10
+    filtered = FilteredSearcher(searcher, ['B2', 'B7', 'B9'])
+    queries = ['shoes', 'red', 'boots']
+    results = filtered.batch_search(queries, ['1', '2', '3'], k=2)
+    assert results == {qid: filtered.search(query, k=2) for qid, query in zip(['1', '2', '3'], queries)}
+    assert [hit.docid for hit in results['2']] == ['B2']
+
+def test_field_searcher_over_fetch():
+    # Backends that cannot filter while ranking are over-fetched
+    searcher = FakeSearcher({f'B{i}': 'shoes' for i in range(20)})
+    searcher.num_docs = 20
+    fields = DocumentFields(
+        [f'B{i}' for i in range(10)],
+        [float(i) for i in range(10)],
+        ['fashion'] * 10,
+        ['shoes'] * 10,
+        ['Clothing › Shoes › Men' if i % 3 else 'Clothing › Shoes' for i in range(10)],
+    )
+    filtered = FieldSearcher(searcher, fields)
+    hits = filtered.search('shoes', k=3, search_filter=SearchFilter(price_lower=4, product_category='Men'))
+    assert [hit.docid for hit in hits] == ['B4', 'B5', 'B7']
+    assert filtered.search('shoes', k=3, search_filter=SearchFilter(category='beauty')) == []
+    assert len(filtered.search('shoes', k=15)) == 15
+    assert len(FieldSearcher(searcher, fields, restrict=True).search('shoes', k=15)) == 10
+    with pytest.raises(ValueError):
+        search_asins(searcher, ['shoes'], 3, SearchFilter(price_upper=5))
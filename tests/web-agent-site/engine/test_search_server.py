@@ -0,0 +1,104 @@
+import json
+import pickle
+import socket
+import threading
+
+import pytest
+
+from web_agent_site.engine.bm25 import BM25Searcher, build_bm25_index
+from web_agent_site.engine.search import FilteredSearcher, SearchHit
+from web_agent_site.engine.search_server import *
+
+DOCS = [
+    ('B3', 'red running shoes'),
+    ('B1', 'blue running shoes for men'),
+    ('B2', 'red dress with red buttons'),
+    ('B4', 'shoes'),
+    ('B5', 'blue shoes'),
+    ('B0', 'red shoes'),
+]
+
+@pytest.fixture
+def searcher(tmp_path):
+    build_bm25_index(iter(DOCS), tmp_path / 'index')
+    return BM25Searcher(tmp_path / 'index')
+
+@pytest.fixture
+def server(tmp_path, searcher):
+    server = SearchServer(searcher, str(tmp_path / 'search.sock'), info=dict(backend='bm25', num_products=None))
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(poll_interval=0.05))
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+def test_search_request_roundtrip():
+    queries = ['red shoes', '', 'sofá ünïcode']
+    assert decode_search_request(encode_search_request(queries, 50)) == (queries, 50)
+    results = [[SearchHit('B1', 1.5), SearchHit('B2', 0.25)], [], [SearchHit('Bé', -2.0)]]
+    assert decode_search_response(encode_search_response(results), 3) == results
+
+def test_search_client(server, searcher):
+    client = SearchClient(server.path, pool_size=2)
+    assert (client.backend, client.num_products, client.num_docs) == ('bm25', None, len(DOCS))
+    for query in ['red shoes', 'blue running', 'nothing matches', '']:
+        expected = [(hit.docid, hit.score) for hit in searcher.search(query, k=3)]
+        assert [(hit.docid, hit.score) for hit in client.search(query, k=3)] == expected
+    results = client.batch_search(['red', 'blue'], ['q1', 'q2'], k=10)
+    assert results['q1'] == client.search('red', k=10)
+    assert results['q2'] == client.search('blue', k=10)
+
+    filtered = FilteredSearcher(client, ['B1', 'B4'])
+    assert [hit.docid for hit in filtered.search('shoes', k=10)] == ['B4', 'B1']
+
+    # Clients are passed to other processes without their connections
+    clone = pickle.loads(pickle.dumps(client))
+    assert clone.search('red', k=10) == client.search('red', k=10)
+
+def test_search_client_concurrent(server, searcher):
+    client = SearchClient(server.path, pool_size=2)
+    queries = ['red shoes', 'blue', 'running', 'dress'] * 10
+    expected = {query: client.search(query, k=5) for query in queries}
+    errors = []
+    def run():
+        for query in queries:
+            if client.search(query, k=5) != expected[query]:
+                errors.append(query)
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+def test_search_client_reconnects(server):
+    client = SearchClient(server.path)
+    expected = client.search('red', k=10)
+    # Connections the server has dropped are replaced
+    for conn in list(server._buffers):
+        conn.shutdown(2)
+    assert client.search('red', k=10) == expected
+
+def test_search_server_errors(tmp_path, server):
+    with pytest.raises(ValueError):
+        SearchServer(None, server.path)
+    client = SearchClient(server.path)
+    with pytest.raises(RuntimeError):
+        client._request(bytes([255]))
+    assert client.search('red', k=1)
+
+def test_search_server_slow_client(server):
+    client = SearchClient(server.path, timeout=5)
+    expected = client.search('red', k=10)
+    # A client that sends requests and does not read their responses
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stalled.connect(server.path)
+    num_requests = 20000
+    stalled.sendall(encode_frame(bytes([INFO])) * num_requests)
+    # does not keep the server from answering others
+    for _ in range(10):
+        assert client.search('red', k=10) == expected
+    info = client.get_info()
+    for _ in range(num_requests):
+        assert json.loads(recv_frame(stalled)[1:]) == info
+    stalled.close()
@@ -0,0 +1,56 @@
+import random
+import pytest
+from web_agent_site.engine.snapshot import *
+
+@pytest.fixture
+def catalog(tmp_path):
+    source = tmp_path / 'items.json'
+    source.write_text('[]')
+    all_products = [
+        {'asin': 'B000000001', 'pricing': [10.0]},
+        {'asin': 'B000000002', 'pricing': [5.0, 7.5]},
+        {'asin': 'B000000003', 'pricing': []},
+        {'asin': 'B000000004', 'pricing': [1.25, 3.0]},
+    ]
+    attribute_to_asins = {'cotton': {'B000000001', 'B000000004'}}
+    return str(source), all_products, attribute_to_asins
+
+def test_snapshot_round_trip(tmp_path, catalog):
+    source, all_products, attribute_to_asins = catalog
+    path = get_snapshot_path(source, 100, False, str(tmp_path / 'snapshots'))
+    assert path.endswith('items-100-synthetic')
+    assert not is_snapshot_fresh(path, [source], 100, False)
+
+    write_snapshot(path, all_products, attribute_to_asins, [source], 100, False)
+    assert is_snapshot_fresh(path, [source], 100, False)
+    assert not is_snapshot_fresh(path, [source], None, False)
+    assert not is_snapshot_fresh(path, [source], 100, True)
+
+    products, attributes, price_ranges = read_snapshot(path)
+    assert products == all_products
+    assert attributes == attribute_to_asins
+    assert price_ranges.shape == (4, 2)
+
+    # Changing a source file makes the snapshot stale
+    with open(source, 'w') as f:
+        f.write('[{}]')
+    assert not is_snapshot_fresh(path, [source], 100, False)
+
+def test_generate_product_prices_from_ranges(catalog):
+    _, all_products, _ = catalog
+    random.seed(0)
+    expected = dict()
+    for product in all_products:
+        pricing = product['pricing']
+        if not pricing:
+            expected[product['asin']] = 100.0
+        elif len(pricing) == 1:
+            expected[product['asin']] = pricing[0]
+        else:
+            expected[product['asin']] = random.uniform(*pricing[:2])
+    expected_state = random.getstate()
+
+    random.seed(0)
+    prices = generate_product_prices_from_ranges(all_products, get_price_ranges(all_products))
+    assert prices == expected
+    assert random.getstate() == expected_state
@@ -0,0 +1,22 @@
+import pytest
+from flask import Flask
+from web_agent_site.engine.templates import *
+
+def test_template_registry_compiles_once():
+    registry = TemplateRegistry('classic', auto_reload=False)
+    template = registry.get_template('search_page.html')
+    assert registry.get_template('search_page.html') is template
+    assert get_template_registry('classic') is get_template_registry('classic')
+
+def test_template_registry_render_stats():
+    app = Flask(__name__)
+    app.add_url_rule('/<session_id>', 'index')
+    registry = TemplateRegistry('classic', auto_reload=False)
+    with app.test_request_context():
+        html = registry.render('search_page.html', session_id='abc')
+        registry.render('search_page.html', session_id='abc')
+    assert 'action="/abc"' in html
+    assert registry.render_count['search_page.html'] == 2
+    assert registry.render_time['search_page.html'] > 0
+    registry.reset_stats()
+    assert registry.render_count['search_page.html'] == 0
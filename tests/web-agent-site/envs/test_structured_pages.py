@@ -0,0 +1,117 @@
+import json
+import pytest
+from web_agent_site.engine.engine import map_action_to_html, END_BUTTON
+from web_agent_site.envs.structured_pages import *
+from web_agent_site.envs.web_agent_text_env import (
+    ParsedPage,
+    convert_visible_texts_to_text,
+    sim_url_for,
+)
+
+def make_product(asin, **fields):
+    product = {
+        'asin': asin,
+        'Title': 'Men\'s Running Shoe & Sock "Combo" <2-Pack>',
+        'Price': '$12.99 to $19.5',
+        'Rating': 'N.A.',
+        'MainImage': 'https://images/shoe.jpg?size=1&crop=0',
+        'Description': 'Light & breathable.\nMade of <mesh>   ',
+        'BulletPoints': ['Rubber sole', '  Machine wash  ', 'Ünïcode bullet'],
+        'Reviews': [],
+        'Attributes': ['rubber sole', 'machine wash', ''],
+        'category': 'fashion',
+        'query': 'men\'s shoes',
+        'product_category': 'Clothing › Men › Shoes',
+        'options': {
+            'color': ['black | white', 'red & blue', '"navy"'],
+            'size': ['7', '7.5', 'x-large'],
+        },
+        'option_to_image': {'black | white': 'https://images/black.jpg'},
+    }
+    product.update(fields)
+    return product
+
+PRODUCTS = [
+    make_product('B000000001'),
+    make_product('B000000002', Title='   ', Price='$5.0', options={}),
+    make_product('B000000003', Title='', MainImage=None, options={'size': ['one size']}),
+    make_product(
+        'B000000004',
+        BulletPoints=['plain', 'with <b>markup</b>'],
+        Reviews=[
+            {'title': 'Great', 'score': 5, 'body': 'Love these & more'},
+            {'title': '', 'score': 2, 'body': ' '},
+        ],
+        Attributes=['\n'],
+    ),
+]
+
+def page_kwargs(product, options):
+    return dict(
+        session_id='abc',
+        product_info=product,
+        keywords=['running', 'shoes'],
+        page=1,
+        asin=product['asin'],
+        options=options,
+        instruction_text='Find shoes',
+    )
+
+def suite():
+    yield 'start', dict(session_id='abc', instruction_text='Find shoes')
+    for page, products in [(1, PRODUCTS), (2, PRODUCTS[2:]), (3, [])]:
+        yield 'search', dict(
+            session_id='abc',
+            products=products,
+            keywords=['running', 'shoes'],
+            page=page,
+            total=len(PRODUCTS),
+            instruction_text='Find shoes',
+        )
+    for product in PRODUCTS:
+        for options in [{}, {'color': 'red & blue', 'size': '7.5'}]:
+            for show_attrs in [False, True]:
+                yield 'click', dict(page_kwargs(product, options), show_attrs=show_attrs)
+            for sub_page in ['Description', 'Features', 'Reviews', 'Attributes']:
+                yield f'click[{sub_page}]', page_kwargs(product, options)
+    yield f'click[{END_BUTTON}]', dict(
+        session_id='abc',
+        reward=0.5,
+        asin='B000000001',
+        options={'color': 'red & blue'},
+        instruction_text='Find shoes',
+    )
+
+def clickable_kind(clickable):
+    if clickable.get('class') is not None and clickable.get('class')[0] == 'product-link':
+        return 'product-link'
+    return clickable.get('name')
+
+@pytest.mark.parametrize('action,kwargs', list(suite()))
+def test_structured_page_matches_html(action, kwargs):
+    html = map_action_to_html(action, url_for=sim_url_for, **kwargs)
+    expected = ParsedPage(html)
+    page = map_action_to_page(action, url_for=sim_url_for, **kwargs)
+    if isinstance(page, str):
+        # Pages that are not built structurally fall back to the same HTML
+        assert page == html
+        return
+    url = json.dumps(kwargs.get('options', {}))
+    clicked_asins = {'B000000002'}
+    for simple in [True, False]:
+        assert (
+            convert_visible_texts_to_text(page.visible_texts, simple, url, clicked_asins) ==
+            convert_visible_texts_to_text(expected.visible_texts, simple, url, clicked_asins)
+        )
+    assert list(page.text_to_clickable) == list(expected.text_to_clickable)
+    for text, clickable in page.text_to_clickable.items():
+        assert clickable_kind(clickable) == clickable_kind(expected.text_to_clickable[text])
+    assert page.has_search_bar == expected.has_search_bar
+    assert page.instruction_text == expected.instruction_text
+    assert page.image_url == expected.image_url
+
+def test_structured_page_fallbacks():
+    kwargs = page_kwargs(PRODUCTS[3], {})
+    assert isinstance(map_action_to_page('click[Features]', url_for=sim_url_for, **kwargs), str)
+    kwargs = page_kwargs(PRODUCTS[0], {})
+    assert isinstance(map_action_to_page('click[Features]', url_for=sim_url_for, **kwargs), StructuredPage)
@@ -0,0 +1,52 @@
+import pytest
+from flask import Flask, url_for
+from web_agent_site.envs.web_agent_text_env import *
+
+def test_sim_url_for_matches_flask():
+    app = Flask(__name__)
+    for endpoint in ['index', 'search_results', 'item_page', 'item_sub_page', 'done']:
+        app.add_url_rule('/', endpoint)
+    suite = [
+        ('static', dict(filename='style.css')),
+        ('index', dict(session_id='abc')),
+        ('search_results', dict(session_id='abc', keywords=['red', 'shoes'], page=2)),
+        ('item_page', dict(
+            session_id='abc', asin='B000TEST', keywords=['red', 'shoes'],
+            page=1, options={'color': 'red | black', 'size': 'x-large'}
+        )),
+        ('item_sub_page', dict(
+            session_id='abc', asin='B000TEST', keywords=['a&b'],
+            page=1, sub_page='Description', options={}
+        )),
+        ('done', dict(session_id='abc', asin='B000TEST', options={"size": "10\""})),
+    ]
+    with app.test_request_context():
+        for endpoint, values in suite:
+            assert sim_url_for(endpoint, **values) == url_for(endpoint, **values)
+
+def test_parsed_page():
+    html = (
+        '<html><head><title>t</title></head><body>'
+        '<div id="instruction-text"><h4>Find red shoes</h4></div>'
+        '<input id="search_input" name="search_query">'
+        '<button class="btn">Back to Search</button>'
+        '<a class="product-link" href="#">B000TEST</a>'
+        '<img id="product-image" src="http://img/1.jpg">'
+        '<input type="radio" name="color" value="red | black">'
+        '<label>red | black</label><!-- hidden -->'
+        '</body></html>'
+    )
+    page = ParsedPage(html)
+    assert page.has_search_bar
+    assert list(page.text_to_clickable) == ['back to search', 'b000test', 'red | black']
+    assert page.instruction_text == 'Find red shoes'
+    assert page.image_url == 'http://img/1.jpg'
+    assert [t.text for t in page.visible_texts] == [
+        'Find red shoes', 'Back to Search', 'B000TEST', 'red | black'
+    ]
+
+    page = ParsedPage('<html><body><p>empty</p></body></html>')
+    assert not page.has_search_bar
+    assert page.text_to_clickable == {}
+    assert page.instruction_text is None
+    assert page.image_url is None
@@ -0,0 +1,197 @@
+import json
+import numpy as np
+import pytest
+from web_agent_site.engine import engine
+from web_agent_site.engine.bm25 import build_bm25_index
+from web_agent_site.envs import web_agent_text_vec_env
+from web_agent_site.envs.web_agent_text_env import SimServer, WebAgentTextEnv, load_catalog
+from web_agent_site.envs.web_agent_text_vec_env import *
+
+PRODUCTS = [
+    ('B000000001', 'red running shoes', '$25.99', ['red', 'white'], ['lightweight']),
+    ('B000000002', 'blue running shoes for men', '$40.00', ['blue'], ['lace closure']),
+    ('B000000003', 'red cotton dress', '$15.00 - $30.00', ['red', 'black'], ['cotton']),
+    ('B000000004', 'blue denim jacket', '$60.00', ['blue'], ['machine wash']),
+    ('B000000005', 'wool winter hat', '$12.50', ['grey', 'black'], ['wool']),
+    ('B000000006', 'leather shoes', '$80.00', ['brown'], ['leather sole']),
+]
+
+@pytest.fixture
+def catalog_path(tmp_path, monkeypatch):
+    """File of a tiny catalog with synthetic goals, searched in a BM25 index of its own"""
+    products, attributes = [], dict()
+    for asin, name, price, colors, product_attributes in PRODUCTS:
+        products.append(dict(
+            asin=asin,
+            name=name,
+            full_description=f'A {name}.',
+            small_description=[f'{name} in {", ".join(colors)}'],
+            pricing=price,
+            customization_options=dict(color=[dict(value=color, image=None) for color in colors]),
+            images=[f'https://example.com/{asin}.jpg'],
+            category='fashion',
+            query=name.split()[-1],
+            product_category='Clothing, Shoes & Jewelry › Fashion',
+        ))
+        attributes[asin] = dict(
+            attributes=product_attributes,
+            instruction=f'i need {name}',
+            instruction_attributes=product_attributes,
+        )
+    path = tmp_path / 'vec_env_catalog.json'
+    path.write_text(json.dumps(products))
+    (tmp_path / 'attributes.json').write_text(json.dumps(attributes))
+    (tmp_path / 'human_attributes.json').write_text('{}')
+    monkeypatch.setattr(engine, 'DEFAULT_ATTR_PATH', str(tmp_path / 'attributes.json'))
+    monkeypatch.setattr(engine, 'HUMAN_ATTR_PATH', str(tmp_path / 'human_attributes.json'))
+
+    index = tmp_path / 'bm25_index'
+    build_bm25_index(((doc['id'], doc['contents']) for doc in engine.iter_search_documents(str(path))), index)
+    monkeypatch.setattr(engine, 'get_index_path', lambda num_products=None, backend=None: str(index))
+    return str(path)
+
+@pytest.fixture
+def catalog(catalog_path, monkeypatch):
+    """Catalog of `catalog_path`, loaded once and returned by every `load_catalog`"""
+    catalog = load_catalog(catalog_path)
+    monkeypatch.setattr(web_agent_text_vec_env, 'load_catalog', lambda *args, **kwargs: catalog)
+    return catalog
+
+def make_server(catalog_path, catalog, **kwargs):
+    return SimServer(
+        'http://127.0.0.1:3000', catalog_path, catalog=catalog, search_backend='bm25', **kwargs
+    )
+
+class SingleEnv:
+    """`WebAgentTextEnv` with the batched API of `WebAgentTextVecEnv`, as a batch of one"""
+    def __init__(self, env):
+        self.env = env
+
+    def reset(self, idxs, sessions):
+        return [self.env.reset(sessions[0])[0]], [self.env.get_available_actions()]
+
+    def step(self, actions):
+        ob, reward, done, _ = self.env.step(actions[0])
+        return [ob], np.array([reward]), np.array([done]), [self.env.get_available_actions()]
+
+SEARCHES = ['search[red shoes]', 'search[blue jacket]', 'search[red shoes]']
+
+def run_episode(env, idxs, sessions, searches=SEARCHES):
+    """
+    Trajectory of searching for `searches`, opening the first result and
+    buying it in every environment
+    """
+    trajectory = [env.reset(idxs, sessions)]
+    for actions in [searches, None, ['click[buy now]'] * len(searches)]:
+        if actions is None:
+            # Open the first result of every search
+            actions = [
+                f'click[{next(c for c in available["clickables"] if c.startswith("b0"))}]'
+                for available in trajectory[-1][-1]
+            ]
+        obs, rewards, dones, available_actions = env.step(actions)
+        trajectory.append((obs, rewards.tolist(), dones.tolist(), available_actions))
+    return trajectory
+
+@pytest.mark.parametrize(
+    'action, keywords',
+    [
+        ('search[Red Shoes]', ['red', 'shoes']),
+        ('search[<c> beauty]', ['<c>', 'beauty']),
+        ('search[]', None),
+        ('click[Buy Now]', None),
+        ('red shoes', None),
+    ]
+)
+def test_get_search_keywords(action, keywords):
+    assert get_search_keywords(action) == keywords
+
+class CountingSearcher:
+    """Search backend recording the queries searched by another"""
+    def __init__(self, searcher):
+        self.searcher = searcher
+        self.queries = []
+
+    def search(self, query, k=10):
+        self.queries.append(query)
+        return self.searcher.search(query, k=k)
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        self.queries.extend(queries)
+        return self.searcher.batch_search(queries, qids, k=k, threads=threads)
+
+def test_vec_env_matches_single_envs(catalog_path, catalog):
+    server = make_server(catalog_path, catalog)
+    vec_env = WebAgentTextVecEnv(3, 'text', catalog_path, server=server)
+    trajectory = run_episode(vec_env, [0, 1, 2], [2, 4, 1])
+    for i, session in enumerate([2, 4, 1]):
+        env = WebAgentTextEnv('text', catalog_path, server=server, session_prefix=f'single{i}_')
+        single = run_episode(SingleEnv(env), [0], [session], [SEARCHES[i]])
+        assert single[0][0] == [trajectory[0][0][i]]
+        for step, single_step in zip(trajectory[1:], single[1:]):
+            assert [values[i] for values in step] == [values[0] for values in single_step]
+
+def test_vec_env_session_prefixes(catalog_path, catalog):
+    server = make_server(catalog_path, catalog)
+    env = WebAgentTextVecEnv(3, 'text', catalog_path, server=server, session_prefix='p')
+    # Environments reset to the same goal have sessions of their own
+    env.reset([0, 2], [2, 2])
+    assert {'p0_2', 'p2_2'} <= set(server.user_sessions)
+    obs, _, _, _ = env.step(['search[red shoes]', 'search[blue jacket]', 'search[wool hat]'])
+    assert server.user_sessions['p0_2']['keywords'] == ['red', 'shoes']
+    assert server.user_sessions['p2_2']['keywords'] == ['wool', 'hat']
+    assert obs[0] != obs[2]
+
+def test_vec_env_prefetches_searches(catalog_path, catalog):
+    # Without a cache, every search reaches the backend
+    server = make_server(catalog_path, catalog, search_cache_size=0)
+    server.search_engine.searcher = searcher = CountingSearcher(server.search_engine.searcher)
+    env = WebAgentTextVecEnv(4, 'text', catalog_path, server=server)
+    env.reset()
+    obs, _, _, _ = env.step(['search[Red Shoes]', 'search[blue jacket]', 'search[red shoes]', 'click[search]'])
+    # Searches repeated across environments run once per step
+    assert sorted(searcher.queries) == ['blue jacket', 'red shoes']
+    assert obs[0] == obs[2]
+    assert not server.prefetched_search_results
+    env.step(['search[red shoes]'] * 4)
+    assert sorted(searcher.queries) == ['blue jacket', 'red shoes', 'red shoes']
+
+def test_subproc_vec_env(catalog_path, catalog):
+    expected = run_episode(
+        WebAgentTextVecEnv(3, 'text', catalog_path, server=make_server(catalog_path, catalog)),
+        [0, 1, 2], [2, 4, 1],
+    )
+    # Purchases are rewarded by the goals of their sessions
+    assert len(set(expected[-1][1])) == 3
+    env = WebAgentTextSubprocVecEnv(3, 2, 'text', catalog_path, seed=0, search_backend='bm25')
+    try:
+        assert env.worker_sizes == [2, 1]
+        assert run_episode(env, [0, 1, 2], [2, 4, 1]) == expected
+        # Environments reset out of order, across workers, get their own sessions
+        assert run_episode(env, [2, 0, 1], [1, 2, 4]) == expected
+
+        # Errors in a worker are raised in the parent, which can go on
+        with pytest.raises(RuntimeError, match='IndexError'):
+            env.reset([2], [len(catalog.goals)])
+        with pytest.raises(ValueError):
+            env.step(['search[shoes]'])
+        assert run_episode(env, [0, 1, 2], [2, 4, 1]) == expected
+    finally:
+        env.close()
+    assert not any(process.is_alive() for process in env.processes)
+
+def test_subproc_vec_env_reset_order(catalog_path, catalog):
+    env = WebAgentTextSubprocVecEnv(
+        3, 2, 'url', catalog_path, search_backend='bm25', session_prefix='p',
+    )
+    try:
+        # Results come back in the order of `idxs`; session names are prefixed
+        # by worker and environment
+        obs, _ = env.reset([2, 0, 1], [1, 2, 4])
+        assert obs == [
+            'http://127.0.0.1:3000/p1-0_1',
+            'http://127.0.0.1:3000/p0-0_2',
+            'http://127.0.0.1:3000/p0-1_4',
+        ]
+    finally:
+        env.close()
@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Seconds importing each core module may take, in a fresh interpreter
+IMPORT_TIME_BUDGET = 2.0
+
+# Modules that take seconds to import or load, and are only imported when needed
+LAZY_MODULES = ['spacy', 'torch', 'transformers', 'pyserini', 'faiss', 'nltk', 'cleantext']
+
+CODE = '''
+import json, sys
+before = set(sys.modules)
+import {module}
+print(json.dumps(sorted(set(sys.modules) - before)))
+'''
+
+def get_import_time(stderr, module):
+    """Cumulative seconds of importing `module`, from the report of `-X importtime`"""
+    for line in stderr.splitlines():
+        if line.startswith('import time:'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if name.strip() == module and cumulative.strip().isdigit():
+                return int(cumulative) / 1e6
+    raise ValueError(f'{module} not in the import time report.')
+
+@pytest.mark.parametrize(
+    'module',
+    ['web_agent_site.engine.engine', 'web_agent_site.engine.goal', 'web_agent_site.envs', 'web_agent_site.app'],
+)
+def test_import_time(module, tmp_path):
+    # Stubs of the optional lazy modules, so that eager imports of them are caught
+    # even where they are not installed
+    (tmp_path / 'faiss.py').write_text('')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(tmp_path), env.get('PYTHONPATH')]))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CODE.format(module=module)],
+        capture_output=True, text=True, check=True, env=env,
+    )
+    imported = json.loads(result.stdout.splitlines()[-1])
+    assert not [name for name in imported if name.split('.')[0] in LAZY_MODULES]
+    assert get_import_time(result.stderr, module) < IMPORT_TIME_BUDGET
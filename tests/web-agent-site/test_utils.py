@@ -80,3 +80,25 @@ def test_generate_order_code():
     assert isinstance(code1a, str)
     assert code1a.isupper()
     assert len(code1a) == 10
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 1 << 20])
+def test_iter_json_array(tmp_path, monkeypatch, chunk_size):
+    import web_agent_site.utils as utils
+    monkeypatch.setattr(utils, 'ijson', None)
+    items = [
+        {'asin': 'B01', 'name': 'Shoes "x", [y]', 'pricing': 12.5, 'options': {}},
+        [1, 2.0, -3e2, None, True],
+        'a, ] string',
+        12345,
+        {},
+    ]
+    path = tmp_path / 'items.json'
+    path.write_text(' [\n' + ' ,\n  '.join(json.dumps(item) for item in items) + '\n]\n')
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == items
+
+    path.write_text('[]')
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == []
+
+    path.write_text('[1, 2')
+    with pytest.raises(ValueError):
+        list(iter_json_array(path, chunk_size=chunk_size))
@@ -15,14 +15,23 @@ from rich import print
 from web_agent_site.engine.engine import (
     load_products,
     init_search_engine,
+    build_product_index,
     convert_web_app_string_to_var,
     get_top_n_product_from_keywords,
     get_product_per_page,
+    get_session_search_results,
     map_action_to_html,
     set_theme,
-    END_BUTTON
+    END_BUTTON,
+    INDEX_SIZES,
 )
-from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.goal import get_reward, get_goals, precompute_name_nouns
+from web_agent_site.engine.search import (
+    DEFAULT_SEARCH_BACKEND,
+    DEFAULT_SEARCH_CACHE_SIZE,
+    SEARCH_BACKENDS,
+)
+from web_agent_site.engine.snapshot import get_name_nouns_path
 from web_agent_site.utils import (
     generate_order_code,
     setup_logger,
@@ -88,12 +97,16 @@ all_products = None
 product_item_dict = None
 product_prices = None
 attribute_to_asins = None
+product_index = None
 goals = None
 weights = None
 
 user_sessions = dict()
 user_log_dir = None
 SHOW_ATTRS_TAB = False
+SEARCH_CACHE_SIZE = DEFAULT_SEARCH_CACHE_SIZE
+SEARCH_BACKEND = DEFAULT_SEARCH_BACKEND
+SEARCH_SOCKET = None
 
 @app.route('/')
 def home():
@@ -104,7 +117,7 @@ def index(session_id):
     global user_log_dir
     global all_products, product_item_dict, \
            product_prices, attribute_to_asins, \
-           search_engine, \
+           product_index, search_engine, \
            goals, weights, user_sessions
 
     if search_engine is None:
@@ -113,8 +126,18 @@ def index(session_id):
                 filepath=DEFAULT_FILE_PATH,
                 num_products=DEBUG_PROD_SIZE
             )
-        search_engine = init_search_engine(num_products=DEBUG_PROD_SIZE)
+        product_index = build_product_index(all_products)
+        search_engine = init_search_engine(
+            num_products=DEBUG_PROD_SIZE,
+            cache_size=SEARCH_CACHE_SIZE,
+            backend=SEARCH_BACKEND,
+            asins=list(product_item_dict) if DEBUG_PROD_SIZE not in INDEX_SIZES else None,
+            search_socket=SEARCH_SOCKET,
+        )
         goals = get_goals(all_products, product_prices)
+        precompute_name_nouns(
+            all_products, goals, get_name_nouns_path(DEFAULT_FILE_PATH, DEBUG_PROD_SIZE)
+        )
         random.seed(233)
         random.shuffle(goals)
         weights = [goal['weight'] for goal in goals]
@@ -181,6 +204,7 @@ def index(session_id):
                 all_products,
                 product_item_dict,
                 attribute_to_asins,
+                product_index=product_index,
             )
             if not top_dress_asins:
                 continue
@@ -208,6 +232,7 @@ def index(session_id):
                     all_products,
                     product_item_dict,
                     attribute_to_asins,
+                    product_index=product_index,
                 )
                 if top_dress_asins:
                     candidates = get_product_per_page(top_dress_asins, 1) or []
@@ -263,6 +288,7 @@ def index(session_id):
                 all_products,
                 product_item_dict,
                 attribute_to_asins,
+                product_index=product_index,
             )
             if not electronics_products:
                 continue
@@ -317,12 +343,18 @@ def search_results(session_id, keywords, page):
     instruction_text = user_sessions[session_id]['goal']['instruction_text']
     page = convert_web_app_string_to_var('page', page)
     keywords = convert_web_app_string_to_var('keywords', keywords)
-    top_n_products = get_top_n_product_from_keywords(
+    # Pages of the same keywords reuse the session's results
+    top_n_products = get_session_search_results(
+        user_sessions[session_id],
         keywords,
-        search_engine,
-        all_products,
-        product_item_dict,
-        attribute_to_asins,
+        lambda keywords: get_top_n_product_from_keywords(
+            keywords,
+            search_engine,
+            all_products,
+            product_item_dict,
+            attribute_to_asins,
+            product_index=product_index,
+        ),
     )
     products = get_product_per_page(top_n_products, page)
     
@@ -551,6 +583,14 @@ if __name__ == "__main__":
     )
     parser.add_argument("--log", action='store_true', help="Log actions on WebShop in trajectory file")
     parser.add_argument("--attrs", action='store_true', help="Show attributes tab in item page")
+    parser.add_argument("--search_cache_size", type=int, default=DEFAULT_SEARCH_CACHE_SIZE,
+                        help="Number of search queries whose results are cached (0 disables caching)")
+    parser.add_argument("--search_backend", choices=SEARCH_BACKENDS, default=DEFAULT_SEARCH_BACKEND,
+                        help="Search engine: lucene (pyserini, needs Java), bm25 (in-process), "
+                             "dense (embeddings) or hybrid (bm25 and dense)")
+    parser.add_argument("--search_socket", default=None,
+                        help="Search through the search server on this Unix socket "
+                             "(see web_agent_site/engine/search_server.py) instead of opening the index")
     
     # parse_known_args will return (args, unknown) where unknown contains theme args
     args, unknown = parser.parse_known_args()
@@ -558,6 +598,9 @@ if __name__ == "__main__":
         user_log_dir = Path('user_session_logs/mturk')
         user_log_dir.mkdir(parents=True, exist_ok=True)
     SHOW_ATTRS_TAB = args.attrs
+    SEARCH_CACHE_SIZE = args.search_cache_size
+    SEARCH_BACKEND = args.search_backend
+    SEARCH_SOCKET = args.search_socket
 
     # If -all provided, spawn six servers (1-6) on successive ports
     if RUN_ALL:
@@ -582,6 +625,10 @@ if __name__ == "__main__":
                 cmd.append("--log")
             if args.attrs:
                 cmd.append("--attrs")
+            cmd.append(f"--search_cache_size={args.search_cache_size}")
+            cmd.append(f"--search_backend={args.search_backend}")
+            if args.search_socket:
+                cmd.append(f"--search_socket={args.search_socket}")
             try:
                 p = subprocess.Popen(cmd, cwd=str(parent_dir))
                 procs.append((num, port, p.pid))
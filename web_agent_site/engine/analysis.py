@@ -0,0 +1,262 @@
+"""
+Text analysis matching the index built by pyserini (Anserini's default
+English analyzer), so that other search backends tokenize documents and
+queries the way the Lucene index does:
+
+    standard tokenizer -> possessive removal -> lowercase -> stopwords -> Porter stemmer
+"""
+import functools
+import re
+
+# Lucene's `EnglishAnalyzer.ENGLISH_STOP_WORDS_SET`
+STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if',
+    'in', 'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that',
+    'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was',
+    'will', 'with',
+])
+
+# Approximates Lucene's `StandardTokenizer` (Unicode word boundaries): runs of
+# letters, digits and underscores, joined across `.`, `'` and `:` between
+# letters (e.g. "e.g", "don't") and across `.`, `,`, `'` and `;` between
+# digits (e.g. "1,000.50")
+TOKEN_PATTERN = re.compile(
+    r"\w+(?:(?:(?<=[^\W\d_])[.'’:](?=[^\W\d_])|(?<=\d)[.,'’;](?=\d))\w+)*"
+)
+
+POSSESSIVE_PATTERN = re.compile(r"['’＇][sS]$")
+
+
+class PorterStemmer:
+    """
+    Porter stemmer, as implemented by Lucene's `PorterStemmer` (Martin
+    Porter's reference implementation, including its departures from the
+    paper such as "bli" -> "ble" and "logi" -> "log"). Stemmers hold no
+    state, so one can be shared across threads.
+    """
+    def stem(self, word):
+        if len(word) <= 2:
+            return word
+        return _PorterStemming(word).stem()
+
+
+class _PorterStemming:
+    """State of the stemming of one word: its letters `b`, end `k` and stem end `j`"""
+    def __init__(self, word):
+        self.b = list(word)
+        self.k = len(word) - 1
+        self.j = 0
+
+    def stem(self):
+        self._step1()
+        self._step2()
+        self._step3()
+        self._step4()
+        self._step5()
+        self._step6()
+        return ''.join(self.b[:self.k + 1])
+
+    def _cons(self, i):
+        ch = self.b[i]
+        if ch in 'aeiou':
+            return False
+        if ch == 'y':
+            return i == 0 or not self._cons(i - 1)
+        return True
+
+    def _m(self):
+        """Number of consonant-vowel sequences between the start and `j`"""
+        n = 0
+        i = 0
+        j = self.j
+        while True:
+            if i > j:
+                return n
+            if not self._cons(i):
+                break
+            i += 1
+        i += 1
+        while True:
+            while True:
+                if i > j:
+                    return n
+                if self._cons(i):
+                    break
+                i += 1
+            i += 1
+            n += 1
+            while True:
+                if i > j:
+                    return n
+                if not self._cons(i):
+                    break
+                i += 1
+            i += 1
+
+    def _vowel_in_stem(self):
+        return any(not self._cons(i) for i in range(self.j + 1))
+
+    def _double_cons(self, j):
+        if j < 1 or self.b[j] != self.b[j - 1]:
+            return False
+        return self._cons(j)
+
+    def _cvc(self, i):
+        if i < 2 or not self._cons(i) or self._cons(i - 1) or not self._cons(i - 2):
+            return False
+        return self.b[i] not in 'wxy'
+
+    def _ends(self, s):
+        length = len(s)
+        o = self.k - length + 1
+        if o < 0 or ''.join(self.b[o:self.k + 1]) != s:
+            return False
+        self.j = self.k - length
+        return True
+
+    def _set_to(self, s):
+        o = self.j + 1
+        self.b[o:o + len(s)] = s
+        self.k = self.j + len(s)
+
+    def _r(self, s):
+        if self._m() > 0:
+            self._set_to(s)
+
+    def _step1(self):
+        """Plurals and -ed or -ing"""
+        if self.b[self.k] == 's':
+            if self._ends('sses'):
+                self.k -= 2
+            elif self._ends('ies'):
+                self._set_to('i')
+            elif self.b[self.k - 1] != 's':
+                self.k -= 1
+        if self._ends('eed'):
+            if self._m() > 0:
+                self.k -= 1
+        elif (self._ends('ed') or self._ends('ing')) and self._vowel_in_stem():
+            self.k = self.j
+            if self._ends('at'):
+                self._set_to('ate')
+            elif self._ends('bl'):
+                self._set_to('ble')
+            elif self._ends('iz'):
+                self._set_to('ize')
+            elif self._double_cons(self.k):
+                ch = self.b[self.k]
+                self.k -= 1
+                if ch in 'lsz':
+                    self.k += 1
+            elif self._m() == 1 and self._cvc(self.k):
+                self._set_to('e')
+
+    def _step2(self):
+        """Terminal y to i when there is another vowel in the stem"""
+        if self._ends('y') and self._vowel_in_stem():
+            self.b[self.k] = 'i'
+
+    def _replace_first(self, rules):
+        for suffix, replacement in rules:
+            if self._ends(suffix):
+                self._r(replacement)
+                return
+
+    def _step3(self):
+        """Double suffixes to single ones"""
+        if self.k == 0:
+            return
+        self._replace_first(STEP3_RULES.get(self.b[self.k - 1], ()))
+
+    def _step4(self):
+        """-ic-, -full, -ness etc."""
+        self._replace_first(STEP4_RULES.get(self.b[self.k], ()))
+
+    def _step5(self):
+        """-ant, -ence etc. in context <c>vcvc<v>"""
+        if self.k == 0:
+            return
+        ch = self.b[self.k - 1]
+        if ch == 'o':
+            if not (
+                (self._ends('ion') and self.j >= 0 and self.b[self.j] in 'st')
+                or self._ends('ou')
+            ):
+                return
+        elif not any(self._ends(suffix) for suffix in STEP5_SUFFIXES.get(ch, ())):
+            return
+        if self._m() > 1:
+            self.k = self.j
+
+    def _step6(self):
+        """Final -e, and -ll to -l"""
+        self.j = self.k
+        if self.b[self.k] == 'e':
+            a = self._m()
+            if a > 1 or a == 1 and not self._cvc(self.k - 1):
+                self.k -= 1
+        if self.b[self.k] == 'l' and self._double_cons(self.k) and self._m() > 1:
+            self.k -= 1
+
+
+# Suffix replacements of steps 3 and 4, by penultimate and last letter
+STEP3_RULES = {
+    'a': [('ational', 'ate'), ('tional', 'tion')],
+    'c': [('enci', 'ence'), ('anci', 'ance')],
+    'e': [('izer', 'ize')],
+    'l': [('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'), ('ousli', 'ous')],
+    'o': [('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')],
+    's': [('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous')],
+    't': [('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')],
+    'g': [('logi', 'log')],
+}
+
+STEP4_RULES = {
+    'e': [('icate', 'ic'), ('ative', ''), ('alize', 'al')],
+    'i': [('iciti', 'ic')],
+    'l': [('ical', 'ic'), ('ful', '')],
+    's': [('ness', '')],
+}
+
+# Suffixes removed by step 5, by penultimate letter (`o` is handled apart)
+STEP5_SUFFIXES = {
+    'a': ['al'],
+    'c': ['ance', 'ence'],
+    'e': ['er'],
+    'i': ['ic'],
+    'l': ['able', 'ible'],
+    'n': ['ant', 'ement', 'ment', 'ent'],
+    's': ['ism'],
+    't': ['ate', 'iti'],
+    'u': ['ous'],
+    'v': ['ive'],
+    'z': ['ize'],
+}
+
+
+# Number of stemmed words memoized by `stem`
+STEM_CACHE_SIZE = 2 ** 18
+
+
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    """Porter stem of `word`, memoized for the most recently stemmed words"""
+    return PorterStemmer().stem(word)
+
+
+class Analyzer:
+    """English analyzer, safe to share across threads"""
+    def __init__(self, stopwords=STOPWORDS):
+        self.stopwords = stopwords
+
+    def stem(self, word):
+        return stem(word)
+
+    def analyze(self, text):
+        """Terms of `text`, in order"""
+        terms = []
+        for token in TOKEN_PATTERN.findall(text):
+            token = POSSESSIVE_PATTERN.sub('', token).lower()
+            if token and token not in self.stopwords:
+                terms.append(stem(token))
+        return terms
@@ -0,0 +1,335 @@
+"""
+In-process BM25 search backend, an alternative to pyserini that needs no JVM.
+
+Indexes the same documents as the Lucene indexes (`search_engine/resources*`)
+and ranks them as Anserini does: the default English analyzer (see
+`analysis`), BM25 with k1=0.9 and b=0.4, Lucene's lossy encoding of document
+lengths, and ties broken by docid. Scores are computed in single precision
+like Lucene's, so rankings agree up to rare floating point near-ties.
+
+An index is a directory of NumPy arrays, memory-mapped when opened:
+
+    <index>/meta.json          -- format version, BM25 parameters and collection statistics
+    <index>/docids.npy         -- docid (ASIN) of every document, in docid order
+    <index>/norms.npy          -- encoded length of every document
+    <index>/terms.bin          -- vocabulary, sorted, UTF-8 encoded back to back
+    <index>/term_offsets.npy   -- start of every term in `terms.bin`
+    <index>/term_ptr.npy       -- start of every term's postings
+    <index>/postings_docs.npy  -- documents of each term's postings, in order
+    <index>/postings_freqs.npy -- frequency of the term in each of these documents
+
+Build an index from a pyserini `JsonCollection` with:
+
+    python -m web_agent_site.engine.bm25 --input search_engine/resources_1k --index search_engine/bm25_indexes_1k
+"""
+import glob
+import json
+import math
+import os
+from array import array
+from collections import Counter, namedtuple
+from os.path import join
+
+import numpy as np
+
+from web_agent_site.engine.analysis import Analyzer
+from web_agent_site.engine.search import SearchBackend, SearchHit
+
+INDEX_VERSION = 1
+DEFAULT_K1 = 0.9
+DEFAULT_B = 0.4
+
+
+def _int_to_int4(i):
+    # Lucene's `SmallFloat.longToInt4`: 4 significant bits and a shift
+    num_bits = i.bit_length()
+    if num_bits < 4:
+        return i
+    shift = num_bits - 4
+    return ((i >> shift) & 0x07) | ((shift + 1) << 3)
+
+
+def _int4_to_int(i):
+    bits = i & 0x07
+    shift = (i >> 3) - 1
+    return bits if shift == -1 else (bits | 0x08) << shift
+
+
+# Lengths below this are encoded exactly (Lucene's `SmallFloat.NUM_FREE_VALUES`)
+_NUM_FREE_VALUES = 255 - _int_to_int4(2 ** 31 - 1)
+
+
+def encode_length(length):
+    """Lucene's one-byte encoding of a document length (`SmallFloat.intToByte4`)"""
+    if length < _NUM_FREE_VALUES:
+        return length
+    return _NUM_FREE_VALUES + _int_to_int4(length - _NUM_FREE_VALUES)
+
+
+def decode_length(code):
+    """Document length of an encoded length (`SmallFloat.byte4ToInt`)"""
+    if code < _NUM_FREE_VALUES:
+        return code
+    return _NUM_FREE_VALUES + _int4_to_int(code - _NUM_FREE_VALUES)
+
+
+# Analyzed documents, see `analyze_documents`
+IndexPart = namedtuple(
+    'IndexPart', ['docids', 'lengths', 'terms', 'posting_terms', 'posting_docs', 'posting_freqs']
+)
+
+LENGTH_TABLE = np.array([decode_length(code) for code in range(256)], dtype=np.float32)
+
+
+def read_collection(path):
+    """(docid, contents) of every document of a pyserini `JsonCollection` directory"""
+    for filename in sorted(glob.glob(join(path, '*.jsonl'))):
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    doc = json.loads(line)
+                    yield doc['id'], doc['contents']
+
+
+def analyze_documents(docs, analyzer=None):
+    """
+    Analyze `docs`, an iterable of (docid, contents) pairs, into an
+    `IndexPart`: their docids and lengths, their vocabulary, and their
+    postings, with terms and documents numbered within the part
+    """
+    analyzer = Analyzer() if analyzer is None else analyzer
+    term_ids = dict()
+    docids = []
+    lengths = array('l')
+    posting_terms, posting_docs, posting_freqs = array('l'), array('l'), array('l')
+    for doc, (docid, contents) in enumerate(docs):
+        terms = analyzer.analyze(contents)
+        docids.append(docid)
+        lengths.append(len(terms))
+        for term, freq in Counter(terms).items():
+            posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+            posting_docs.append(doc)
+            posting_freqs.append(freq)
+
+    def to_array(values):
+        return np.frombuffer(values, dtype=np.int_).astype(np.int32)
+    return IndexPart(
+        docids,
+        to_array(lengths),
+        list(term_ids),
+        to_array(posting_terms),
+        to_array(posting_docs),
+        to_array(posting_freqs),
+    )
+
+
+def _concatenate(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+
+def write_bm25_index(parts, path):
+    """
+    Write the BM25 index of the documents of `parts` (see `analyze_documents`),
+    in order, to the directory `path`. Returns the number of documents indexed.
+    """
+    # Number terms and documents across parts
+    term_ids = dict()
+    docids = []
+    posting_terms, posting_docs = [], []
+    for part in parts:
+        part_term_ids = np.array(
+            [term_ids.setdefault(term, len(term_ids)) for term in part.terms], dtype=np.int64
+        )
+        posting_terms.append(part_term_ids[part.posting_terms])
+        posting_docs.append(part.posting_docs.astype(np.int64) + len(docids))
+        docids.extend(part.docids)
+    posting_terms = _concatenate(posting_terms, np.int64)
+    posting_docs = _concatenate(posting_docs, np.int64)
+    posting_freqs = _concatenate([part.posting_freqs for part in parts], np.int32)
+    lengths = _concatenate([part.lengths for part in parts], np.int64)
+
+    # Number documents in docid order, so that ties are broken by docid
+    docids = np.array([docid.encode('utf-8') for docid in docids], dtype=bytes)
+    doc_order = np.argsort(docids, kind='stable')
+    doc_rank = np.empty(len(docids), dtype=np.int64)
+    doc_rank[doc_order] = np.arange(len(docids))
+
+    # Number terms in the order of their UTF-8 encoding, so they can be bisected
+    terms = [term.encode('utf-8') for term in term_ids]
+    term_order = sorted(range(len(terms)), key=terms.__getitem__)
+    term_rank = np.empty(len(terms), dtype=np.int64)
+    term_rank[term_order] = np.arange(len(terms))
+
+    posting_terms = term_rank[posting_terms]
+    posting_docs = doc_rank[posting_docs]
+    posting_order = np.lexsort((posting_docs, posting_terms))
+    term_ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(posting_terms, minlength=len(terms)), out=term_ptr[1:])
+    sorted_terms = [terms[i] for i in term_order]
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(term) for term in sorted_terms], out=term_offsets[1:])
+
+    os.makedirs(path, exist_ok=True)
+    # `meta.json` is written last, so an interrupted build leaves no usable index
+    meta_path = join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    np.save(join(path, 'docids.npy'), docids[doc_order])
+    np.save(join(path, 'norms.npy'), np.array(
+        [encode_length(int(length)) for length in lengths[doc_order]], dtype=np.uint8
+    ))
+    with open(join(path, 'terms.bin'), 'wb') as f:
+        f.write(b''.join(sorted_terms))
+    np.save(join(path, 'term_offsets.npy'), term_offsets)
+    np.save(join(path, 'term_ptr.npy'), term_ptr)
+    np.save(join(path, 'postings_docs.npy'), posting_docs[posting_order].astype(np.int32))
+    np.save(join(path, 'postings_freqs.npy'), posting_freqs[posting_order])
+    with open(meta_path, 'w') as f:
+        json.dump(dict(
+            version=INDEX_VERSION,
+            num_docs=len(docids),
+            num_terms=len(terms),
+            sum_doc_lengths=int(lengths.sum()),
+            k1=DEFAULT_K1,
+            b=DEFAULT_B,
+        ), f, indent=2)
+    return len(docids)
+
+
+def build_bm25_index(docs, path, analyzer=None):
+    """
+    Write the BM25 index of `docs`, an iterable of (docid, contents) pairs,
+    to the directory `path`. Returns the number of documents indexed.
+    """
+    return write_bm25_index([analyze_documents(docs, analyzer)], path)
+
+
+class BM25Searcher(SearchBackend):
+    """Searcher over an index written by `build_bm25_index`"""
+    def __init__(self, path, k1=None, b=None, analyzer=None):
+        with open(join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != INDEX_VERSION:
+            raise ValueError(
+                f'BM25 index at {path} has version {meta["version"]}, expected {INDEX_VERSION}; rebuild it.'
+            )
+        self.path = path
+        self.num_docs = meta['num_docs']
+        self.k1 = np.float32(meta['k1'] if k1 is None else k1)
+        self.b = np.float32(meta['b'] if b is None else b)
+        self.analyzer = Analyzer() if analyzer is None else analyzer
+
+        def load(name):
+            return np.load(join(path, f'{name}.npy'), mmap_mode='r')
+        self.docids = load('docids')
+        self.norms = load('norms')
+        self.term_offsets = load('term_offsets')
+        self.term_ptr = load('term_ptr')
+        self.postings_docs = load('postings_docs')
+        self.postings_freqs = load('postings_freqs')
+        self.terms = (
+            np.memmap(join(path, 'terms.bin'), dtype=np.uint8, mode='r')
+            if self.term_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        )
+
+        # Inverse of the length normalization of every encoded length, as in
+        # Lucene's `BM25Similarity`
+        avgdl = np.float32(meta['sum_doc_lengths'] / max(self.num_docs, 1))
+        self.norm_inverses = np.float32(1) / (
+            self.k1 * ((np.float32(1) - self.b) + self.b * LENGTH_TABLE / avgdl)
+        )
+
+    def _get_term(self, i):
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]].tobytes()
+
+    def get_term_id(self, term):
+        """Index of `term` in the vocabulary, or -1 if no document has it"""
+        term = term.encode('utf-8')
+        lo, hi = 0, len(self.term_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.term_offsets) - 1 and self._get_term(lo) == term:
+            return lo
+        return -1
+
+    def idf(self, doc_freq):
+        return np.float32(math.log(1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5)))
+
+    def get_doc_positions(self, docids):
+        """Document of each of `docids` (-1 for those not indexed)"""
+        docids = np.array([docid.encode('utf-8') for docid in docids], dtype=bytes)
+        positions = np.full(len(docids), -1, dtype=np.int64)
+        if len(docids) and self.num_docs:
+            docs = np.searchsorted(self.docids, docids)
+            found = np.flatnonzero(docs < self.num_docs)
+            found = found[self.docids[docs[found]] == docids[found]]
+            positions[found] = docs[found]
+        return positions
+
+    def get_doc_mask(self, docids):
+        """Boolean mask of the documents whose docid is in `docids`, for `search`"""
+        positions = self.get_doc_positions(docids)
+        mask = np.zeros(self.num_docs, dtype=bool)
+        mask[positions[positions >= 0]] = True
+        return mask
+
+    def search(self, query, k=10, doc_mask=None):
+        """
+        Top `k` hits for `query`, best first, among the documents of
+        `doc_mask` if given (see `get_doc_mask`)
+        """
+        scores = None
+        for term, count in Counter(self.analyzer.analyze(query)).items():
+            i = self.get_term_id(term)
+            if i < 0:
+                continue
+            start, end = self.term_ptr[i], self.term_ptr[i + 1]
+            docs = self.postings_docs[start:end]
+            freqs = self.postings_freqs[start:end].astype(np.float32)
+            # Repeated query terms are weighted by their count, as in Anserini
+            weight = np.float32(count) * self.idf(end - start)
+            term_scores = weight - weight / (
+                np.float32(1) + freqs * self.norm_inverses[self.norms[docs]]
+            )
+            if scores is None:
+                scores = np.zeros(self.num_docs)
+            scores[docs] += term_scores
+        if scores is None:
+            return []
+        if doc_mask is not None:
+            scores[~doc_mask] = 0
+
+        docs = np.flatnonzero(scores)
+        doc_scores = scores[docs].astype(np.float32)
+        if len(docs) > k:
+            # Keep the top `k` scores, and all documents tied with the last one
+            threshold = np.partition(doc_scores, len(docs) - k)[len(docs) - k]
+            keep = doc_scores >= threshold
+            docs, doc_scores = docs[keep], doc_scores[keep]
+        order = np.lexsort((docs, -doc_scores))[:k]
+        return [
+            SearchHit(self.docids[doc].decode('utf-8'), float(doc_scores[i]))
+            for i, doc in zip(order, docs[order])
+        ]
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Build a BM25 index of a pyserini JsonCollection')
+    parser.add_argument('--input', required=True, help='Directory of JSONL documents with `id` and `contents`')
+    parser.add_argument('--index', required=True, help='Directory to write the index to')
+    args = parser.parse_args()
+
+    old_time = time.time()
+    num_docs = build_bm25_index(read_collection(args.input), args.index)
+    print(f'Indexed {num_docs} documents to {args.index} in {time.time() - old_time:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+"""
+Dense (embedding) search backend, and its fusion with BM25.
+
+Product documents (the `contents` of the Lucene and BM25 indexes) are encoded
+offline, in batches on CPU, by a sentence embedding model (`Encoder`: a
+transformers model's token embeddings mean-pooled and normalized, which needs
+torch and transformers). Queries are encoded the same way and documents
+ranked by the cosine similarity of their vectors.
+
+An index is a directory:
+
+    <index>/meta.json       -- format version, model, dimension and collection statistics
+    <index>/docids.npy      -- docid (ASIN) of every document, in collection order
+    <index>/vectors.bin     -- float16 matrix of the document vectors, memory-mapped
+    <index>/centroids.npy   -- centroids of the inverted lists (k-means of the vectors)
+    <index>/list_ptr.npy    -- start of every list in `list_docs`
+    <index>/list_docs.npy   -- documents of each list, in order
+    <index>/hnsw.faiss      -- HNSW graph of the vectors, only if faiss is installed
+
+Searches walk the HNSW graph when faiss is installed, and otherwise score the
+documents of the `nprobe` inverted lists whose centroids are nearest to the
+query (searches restricted to some documents always do the latter). Since
+documents keep the order of the collection, the index of the first products
+of a catalog is a prefix of the vectors of all of them (see
+`write_dense_index`).
+
+Build an index from a pyserini `JsonCollection` with:
+
+    python -m web_agent_site.engine.dense --input search_engine/resources_1k --index search_engine/dense_indexes_1k
+"""
+import json
+import math
+import os
+from collections import defaultdict
+from os.path import join
+
+import numpy as np
+
+from web_agent_site.engine.search import SearchBackend, SearchHit
+
+INDEX_VERSION = 1
+
+DEFAULT_ENCODER = 'sentence-transformers/all-MiniLM-L6-v2'
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_LENGTH = 256
+
+DEFAULT_NPROBE = 32
+# Neighbors of each node of the HNSW graph, and candidates of its searches
+HNSW_M = 32
+HNSW_EF_SEARCH = 128
+
+# Hybrid search: weight of the dense scores, and depth of both rankings
+DEFAULT_ALPHA = 0.5
+DEFAULT_DEPTH = 100
+
+# Rows of the vector matrix scored at once by exact searches
+_CHUNK_SIZE = 1 << 16
+
+
+def import_faiss():
+    """The faiss module, or None if it is not installed"""
+    # Imported here, as importing the engine should not load it
+    try:
+        import faiss
+    except ImportError:
+        return None
+    return faiss
+
+
+class Encoder:
+    """
+    Sentence embeddings of the transformers model `model_name`: its token
+    embeddings mean-pooled over the attention mask, L2-normalized
+    """
+    def __init__(self, model_name=DEFAULT_ENCODER, max_length=DEFAULT_MAX_LENGTH, device='cpu'):
+        # Imported here, as only dense search needs them
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.torch = torch
+        self.model_name = model_name
+        self.max_length = max_length
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).to(device).eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+        """float32 matrix of the vectors of `texts`"""
+        torch = self.torch
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        # Batches of texts of similar lengths need less padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        with torch.no_grad():
+            for start in range(0, len(texts), batch_size):
+                batch = order[start:start + batch_size]
+                inputs = self.tokenizer(
+                    [texts[i] for i in batch],
+                    padding=True,
+                    truncation=True,
+                    max_length=self.max_length,
+                    return_tensors='pt',
+                ).to(self.device)
+                embeddings = self.model(**inputs).last_hidden_state
+                mask = inputs['attention_mask'].unsqueeze(-1).to(embeddings.dtype)
+                pooled = (embeddings * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+                vectors[batch] = torch.nn.functional.normalize(pooled, dim=-1).cpu().numpy()
+        return vectors
+
+
+def _open_vectors(path, dim, mode='r'):
+    filename = join(path, 'vectors.bin')
+    num_docs = os.path.getsize(filename) // (2 * dim) if dim else 0
+    if num_docs == 0:
+        return np.zeros((0, dim), dtype=np.float16)
+    return np.memmap(filename, dtype=np.float16, mode=mode, shape=(num_docs, dim))
+
+
+def encode_documents(docs, path, encoder, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Encode `docs`, an iterable of (docid, contents) pairs, with `encoder` in
+    batches of `batch_size`, and write their docids and vectors to the
+    directory `path`. Returns the number of documents.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_path = join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    docids = []
+    with open(join(path, 'vectors.bin'), 'wb') as f:
+        batch = []
+        for docid, contents in docs:
+            docids.append(docid)
+            batch.append(contents)
+            if len(batch) == batch_size:
+                f.write(encoder.encode(batch, batch_size).astype(np.float16).tobytes())
+                batch = []
+        if batch:
+            f.write(encoder.encode(batch, batch_size).astype(np.float16).tobytes())
+    np.save(join(path, 'docids.npy'), np.array([docid.encode('utf-8') for docid in docids], dtype=bytes))
+    return len(docids)
+
+
+def get_num_lists(num_docs):
+    """Number of inverted lists of `num_docs` documents, as faiss suggests for IVF indexes"""
+    return max(1, min(num_docs, round(4 * math.sqrt(num_docs))))
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def train_centroids(vectors, num_lists, iterations=10, sample_size=64, seed=0):
+    """Spherical k-means of (a sample of up to `sample_size` vectors per list of) `vectors`"""
+    rng = np.random.default_rng(seed)
+    num_docs = len(vectors)
+    sample = np.sort(rng.choice(num_docs, min(num_docs, num_lists * sample_size), replace=False))
+    sample = vectors[sample].astype(np.float32)
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=num_lists)
+        # Lists left empty keep their centroid
+        centroids[counts > 0] = _normalize(sums[counts > 0])
+    return centroids
+
+
+def write_dense_index(path, model, dim, source=None, num_docs=None, num_lists=None):
+    """
+    Write the search structures (inverted lists, and HNSW graph if faiss is
+    installed) and metadata of the vectors encoded in `path` (see
+    `encode_documents`). If `source` is given, the first `num_docs` vectors
+    of the index or encoded documents there are copied to `path` first.
+    Returns the number of documents indexed.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_path = join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    if source is not None and os.path.abspath(source) != os.path.abspath(path):
+        docids = np.load(join(source, 'docids.npy'), mmap_mode='r')[:num_docs]
+        np.save(join(path, 'docids.npy'), docids)
+        with open(join(path, 'vectors.bin'), 'wb') as f:
+            f.write(np.ascontiguousarray(_open_vectors(source, dim)[:len(docids)]).tobytes())
+    vectors = _open_vectors(path, dim)
+    num_docs = len(vectors)
+    num_lists = get_num_lists(num_docs) if num_lists is None else num_lists
+    for filename in ('centroids.npy', 'list_ptr.npy', 'list_docs.npy', 'hnsw.faiss'):
+        if os.path.exists(join(path, filename)):
+            os.remove(join(path, filename))
+
+    if num_docs:
+        centroids = train_centroids(vectors, num_lists)
+        assignments = np.concatenate([
+            np.argmax(vectors[start:start + _CHUNK_SIZE].astype(np.float32) @ centroids.T, axis=1)
+            for start in range(0, num_docs, _CHUNK_SIZE)
+        ])
+        list_docs = np.argsort(assignments, kind='stable').astype(np.int32)
+        list_ptr = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=num_lists), out=list_ptr[1:])
+    else:
+        centroids = np.zeros((0, dim), dtype=np.float32)
+        list_docs = np.zeros(0, dtype=np.int32)
+        list_ptr = np.zeros(1, dtype=np.int64)
+    np.save(join(path, 'centroids.npy'), centroids)
+    np.save(join(path, 'list_ptr.npy'), list_ptr)
+    np.save(join(path, 'list_docs.npy'), list_docs)
+
+    faiss = import_faiss() if num_docs else None
+    if faiss is not None:
+        hnsw = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        for start in range(0, num_docs, _CHUNK_SIZE):
+            hnsw.add(np.ascontiguousarray(vectors[start:start + _CHUNK_SIZE], dtype=np.float32))
+        faiss.write_index(hnsw, join(path, 'hnsw.faiss'))
+
+    # `meta.json` is written last, so an interrupted build leaves no usable index
+    with open(meta_path, 'w') as f:
+        json.dump(dict(
+            version=INDEX_VERSION,
+            model=model,
+            dim=dim,
+            num_docs=num_docs,
+            num_lists=len(centroids),
+        ), f, indent=2)
+    return num_docs
+
+
+def build_dense_index(docs, path, encoder, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Write the dense index of `docs`, an iterable of (docid, contents) pairs,
+    to the directory `path`. Returns the number of documents indexed.
+    """
+    encode_documents(docs, path, encoder, batch_size)
+    return write_dense_index(path, encoder.model_name, encoder.dim)
+
+
+class DenseSearcher(SearchBackend):
+    """
+    Searcher over an index written by `build_dense_index`. Queries are
+    encoded by `encoder`, by default an `Encoder` of the index's model.
+    `nprobe` is the number of inverted lists searched without faiss (as
+    many as the index has for exact searches); `use_faiss` disables the
+    HNSW graph.
+    """
+    def __init__(self, path, encoder=None, nprobe=DEFAULT_NPROBE, use_faiss=True):
+        with open(join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != INDEX_VERSION:
+            raise ValueError(
+                f'Dense index at {path} has version {meta["version"]}, expected {INDEX_VERSION}; rebuild it.'
+            )
+        self.path = path
+        self.model = meta['model']
+        self.num_docs = meta['num_docs']
+        self.nprobe = nprobe
+        self.encoder = Encoder(self.model) if encoder is None else encoder
+
+        self.docids = np.load(join(path, 'docids.npy'), mmap_mode='r')
+        # Documents sorted by docid, for `get_doc_positions`
+        self._docid_order = None
+        self.vectors = _open_vectors(path, meta['dim'])
+        self.centroids = np.load(join(path, 'centroids.npy'))
+        self.list_ptr = np.load(join(path, 'list_ptr.npy'))
+        self.list_docs = np.load(join(path, 'list_docs.npy'), mmap_mode='r')
+        self.hnsw = None
+        faiss = import_faiss() if use_faiss and os.path.exists(join(path, 'hnsw.faiss')) else None
+        if faiss is not None:
+            self.hnsw = faiss.read_index(join(path, 'hnsw.faiss'))
+            self.hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+
+    def get_doc_positions(self, docids):
+        """Document of each of `docids` (-1 for those not indexed)"""
+        if self._docid_order is None:
+            self._docid_order = np.argsort(self.docids, kind='stable')
+        docids = np.array([docid.encode('utf-8') for docid in docids], dtype=bytes)
+        positions = np.full(len(docids), -1, dtype=np.int64)
+        if len(docids) and self.num_docs:
+            ranks = np.searchsorted(self.docids, docids, sorter=self._docid_order)
+            found = np.flatnonzero(ranks < self.num_docs)
+            docs = self._docid_order[ranks[found]]
+            matched = self.docids[docs] == docids[found]
+            positions[found[matched]] = docs[matched]
+        return positions
+
+    def get_doc_mask(self, docids):
+        """Boolean mask of the documents whose docid is in `docids`, for `search`"""
+        positions = self.get_doc_positions(docids)
+        mask = np.zeros(self.num_docs, dtype=bool)
+        mask[positions[positions >= 0]] = True
+        return mask
+
+    def search(self, query, k=10, doc_mask=None):
+        """
+        Top `k` hits for `query`, best first, among the documents of
+        `doc_mask` if given (see `get_doc_mask`)
+        """
+        return self.search_vectors(self.encoder.encode([query]), k, doc_mask)[0]
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        """Hits of each of `queries` by qid; the queries are encoded together"""
+        return dict(zip(qids, self.search_vectors(self.encoder.encode(list(queries)), k)))
+
+    def search_vectors(self, vectors, k, doc_mask=None):
+        """Top `k` hits of each of the query `vectors`"""
+        if not self.num_docs or not len(vectors):
+            return [[] for _ in vectors]
+        if self.hnsw is not None and doc_mask is None:
+            self.hnsw.hnsw.efSearch = max(HNSW_EF_SEARCH, k)
+            scores, docs = self.hnsw.search(np.ascontiguousarray(vectors, dtype=np.float32), k)
+            return [
+                [self._hit(doc, score) for doc, score in zip(row_docs, row_scores) if doc >= 0]
+                for row_docs, row_scores in zip(docs, scores)
+            ]
+        return [self._search_lists(vector, k, doc_mask) for vector in vectors]
+
+    def _hit(self, doc, score):
+        return SearchHit(self.docids[doc].decode('utf-8'), float(score))
+
+    def _search_lists(self, vector, k, doc_mask):
+        vector = vector.astype(np.float32)
+        if self.nprobe < len(self.centroids):
+            lists = np.argpartition(-(self.centroids @ vector), self.nprobe - 1)[:self.nprobe]
+            docs = np.sort(np.concatenate([
+                self.list_docs[self.list_ptr[i]:self.list_ptr[i + 1]] for i in lists
+            ]))
+            if doc_mask is not None:
+                docs = docs[doc_mask[docs]]
+                # Allowed documents too few to fill the lists searched are all scored
+                if len(docs) < k:
+                    docs = np.flatnonzero(doc_mask)
+            scores = self.vectors[docs].astype(np.float32) @ vector
+        elif doc_mask is not None:
+            docs = np.flatnonzero(doc_mask)
+            scores = self.vectors[docs].astype(np.float32) @ vector
+        else:
+            docs = np.arange(self.num_docs)
+            scores = np.concatenate([
+                self.vectors[start:start + _CHUNK_SIZE].astype(np.float32) @ vector
+                for start in range(0, self.num_docs, _CHUNK_SIZE)
+            ])
+        if len(docs) > k:
+            # Keep the top `k` scores, and all documents tied with the last one
+            threshold = np.partition(scores, len(docs) - k)[len(docs) - k]
+            keep = scores >= threshold
+            docs, scores = docs[keep], scores[keep]
+        order = np.lexsort((docs, -scores))[:k]
+        return [self._hit(docs[i], scores[i]) for i in order]
+
+
+def fuse_hits(sparse_hits, dense_hits, k, alpha=DEFAULT_ALPHA):
+    """
+    Top `k` of the fusion of two rankings: the scores of each are min-max
+    normalized, weighted by `1 - alpha` (sparse) and `alpha` (dense) and
+    summed, documents missing from a ranking scoring 0 in it; ties are
+    broken by docid
+    """
+    scores = defaultdict(float)
+    for hits, weight in ((sparse_hits, 1 - alpha), (dense_hits, alpha)):
+        if not hits:
+            continue
+        low = min(hit.score for hit in hits)
+        high = max(hit.score for hit in hits)
+        for hit in hits:
+            scores[hit.docid] += weight * ((hit.score - low) / (high - low) if high > low else 1.0)
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+    return [SearchHit(docid, score) for docid, score in ranked]
+
+
+class HybridSearcher(SearchBackend):
+    """
+    Fusion (see `fuse_hits`) of the top `depth` hits of a sparse searcher
+    (`bm25.BM25Searcher`) and of a `DenseSearcher` of the same documents.
+    Documents are numbered (for `get_doc_mask`) as in the sparse searcher.
+    """
+    def __init__(self, sparse, dense, alpha=DEFAULT_ALPHA, depth=DEFAULT_DEPTH):
+        self.sparse = sparse
+        self.dense = dense
+        self.alpha = alpha
+        self.depth = depth
+        self.num_docs = sparse.num_docs
+        # Dense document of each sparse document, to translate masks
+        self.dense_positions = dense.get_doc_positions(
+            [docid.decode('utf-8') for docid in sparse.docids]
+        )
+
+    def get_doc_positions(self, docids):
+        return self.sparse.get_doc_positions(docids)
+
+    def get_doc_mask(self, docids):
+        return self.sparse.get_doc_mask(docids)
+
+    def search(self, query, k=10, doc_mask=None):
+        depth = max(k, self.depth)
+        if doc_mask is None:
+            sparse_hits = self.sparse.search(query, k=depth)
+            dense_hits = self.dense.search(query, k=depth)
+        else:
+            dense_mask = np.zeros(self.dense.num_docs, dtype=bool)
+            positions = self.dense_positions[doc_mask]
+            dense_mask[positions[positions >= 0]] = True
+            sparse_hits = self.sparse.search(query, k=depth, doc_mask=doc_mask)
+            dense_hits = self.dense.search(query, k=depth, doc_mask=dense_mask)
+        return fuse_hits(sparse_hits, dense_hits, k, self.alpha)
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        depth = max(k, self.depth)
+        sparse_results = self.sparse.batch_search(queries, qids, k=depth, threads=threads)
+        dense_results = self.dense.batch_search(queries, qids, k=depth, threads=threads)
+        return {
+            qid: fuse_hits(sparse_results[qid], dense_results[qid], k, self.alpha)
+            for qid in qids
+        }
+
+
+def main():
+    import argparse
+    import time
+
+    from web_agent_site.engine.bm25 import read_collection
+
+    parser = argparse.ArgumentParser(description='Build a dense index of a pyserini JsonCollection')
+    parser.add_argument('--input', required=True, help='Directory of JSONL documents with `id` and `contents`')
+    parser.add_argument('--index', required=True, help='Directory to write the index to')
+    parser.add_argument('--encoder', default=DEFAULT_ENCODER, help='transformers model of the embeddings')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    old_time = time.time()
+    num_docs = build_dense_index(
+        read_collection(args.input), args.index, Encoder(args.encoder), args.batch_size
+    )
+    print(f'Indexed {num_docs} documents to {args.index} in {time.time() - old_time:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
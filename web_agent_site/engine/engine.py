@@ -3,24 +3,46 @@
 import os
 import re
 import json
+import math
 import random
+import time
 from collections import defaultdict
 from ast import literal_eval
 from decimal import Decimal
 
-import cleantext
 from tqdm import tqdm
-from rank_bm25 import BM25Okapi
-from flask import render_template_string
 from rich import print
-from pyserini.search.lucene import LuceneSearcher
 
 from web_agent_site.utils import (
     BASE_DIR,
     DEFAULT_FILE_PATH,
     DEFAULT_REVIEW_PATH,
     DEFAULT_ATTR_PATH,
-    HUMAN_ATTR_PATH
+    HUMAN_ATTR_PATH,
+    iter_json_array,
+)
+from web_agent_site.engine.bm25 import BM25Searcher
+from web_agent_site.engine.dense import DenseSearcher, HybridSearcher
+from web_agent_site.engine.product import Product
+from web_agent_site.engine.search import (
+    CachedSearcher,
+    DEFAULT_SEARCH_BACKEND,
+    DEFAULT_SEARCH_CACHE_SIZE,
+    DocumentFields,
+    FieldSearcher,
+    FilteredSearcher,
+    get_product_document,
+    search_asins,
+    search_asins_batch,
+)
+from web_agent_site.engine.search_server import SearchClient
+from web_agent_site.engine.templates import get_template_registry
+from web_agent_site.engine.snapshot import (
+    DEFAULT_SNAPSHOT_DIR,
+    get_snapshot_path,
+    is_snapshot_fresh,
+    read_snapshot,
+    generate_product_prices_from_ranges,
 )
 
 # Theme will be set by app.py
@@ -31,6 +53,10 @@ def set_theme(theme):
     global _current_theme
     _current_theme = theme
 
+def get_theme():
+    """Get the current theme."""
+    return _current_theme
+
 def get_template_dir():
     """Get the template directory for the current theme."""
     return os.path.join(BASE_DIR, 'themes', _current_theme, 'templates')
@@ -54,14 +80,19 @@ ACTION_TO_TEMPLATE = {
     'Attributes': 'attributes_page.html',
 }
 
-def map_action_to_html(action, **kwargs):
-    # Get current template directory (theme may have changed)
-    template_dir = get_template_dir()
+def map_action_to_html(action, url_for=None, **kwargs):
+    """
+    Render the page reached by `action` with the current theme's templates.
+
+    `url_for` overrides how templates build links; by default Flask's
+    `url_for` is used, which requires an app/request context.
+    """
+    # Get compiled templates of the current theme (theme may have changed)
+    templates = get_template_registry(_current_theme, url_for)
     action_name, action_arg = parse_action(action)
     if action_name == 'start':
-        path = os.path.join(template_dir, 'search_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = templates.render(
+            'search_page.html',
             session_id=kwargs['session_id'],
             instruction_text=kwargs['instruction_text'],
             featured_products=kwargs.get('featured_products'),
@@ -73,9 +104,8 @@ def map_action_to_html(action, **kwargs):
             featured_sidebar_products=kwargs.get('featured_sidebar_products'),
         )
     elif action_name == 'search':
-        path = os.path.join(template_dir, 'results_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = templates.render(
+            'results_page.html',
             session_id=kwargs['session_id'],
             products=kwargs['products'],
             keywords=kwargs['keywords'],
@@ -85,9 +115,8 @@ def map_action_to_html(action, **kwargs):
             featured_sidebar_products=kwargs.get('featured_sidebar_products'),
         )
     elif action_name == 'click' and action_arg == END_BUTTON:
-        path = os.path.join(template_dir, 'done_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = templates.render(
+            'done_page.html',
             session_id=kwargs['session_id'],
             reward=kwargs['reward'],
             asin=kwargs['asin'],
@@ -102,9 +131,8 @@ def map_action_to_html(action, **kwargs):
             product_category=kwargs.get('product_category'),
         )
     elif action_name == 'click' and action_arg in ACTION_TO_TEMPLATE:
-        path = os.path.join(template_dir, ACTION_TO_TEMPLATE[action_arg])
-        html = render_template_string(
-            read_html_template(path),
+        html = templates.render(
+            ACTION_TO_TEMPLATE[action_arg],
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -114,9 +142,8 @@ def map_action_to_html(action, **kwargs):
             instruction_text=kwargs.get('instruction_text')
         )
     elif action_name == 'click':
-        path = os.path.join(template_dir, 'item_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = templates.render(
+            'item_page.html',
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -131,12 +158,6 @@ def map_action_to_html(action, **kwargs):
     return html
 
 
-def read_html_template(path):
-    with open(path) as f:
-        template = f.read()
-    return template
-
-
 def parse_action(action):
     """
     Parse action string to action name and its arguments.
@@ -168,34 +189,147 @@ def convert_web_app_string_to_var(name, string):
     return var
 
 
+class ProductIndex:
+    """
+    Inverted indexes from category, query and attribute to the products that
+    have them, for the `<c>`, `<q>` and `<a>` searches. Each lookup returns a
+    shared, immutable tuple of products in catalog order, so answering one
+    costs nothing however many products match; pages are sliced from it.
+    """
+    def __init__(self, all_products):
+        category_to_products = defaultdict(list)
+        query_to_products = defaultdict(list)
+        attribute_to_products = defaultdict(list)
+        for p in all_products:
+            category_to_products[p['category']].append(p)
+            query_to_products[p['query']].append(p)
+            for a in dict.fromkeys(p['Attributes']):
+                attribute_to_products[a].append(p)
+        self.category_to_products = {k: tuple(v) for k, v in category_to_products.items()}
+        self.query_to_products = {k: tuple(v) for k, v in query_to_products.items()}
+        self.attribute_to_products = {k: tuple(v) for k, v in attribute_to_products.items()}
+
+    def get_category(self, category):
+        return self.category_to_products.get(category, ())
+
+    def get_query(self, query):
+        return self.query_to_products.get(query, ())
+
+    def get_attribute(self, attribute):
+        return self.attribute_to_products.get(attribute, ())
+
+
+def build_product_index(all_products):
+    """Build the `ProductIndex` of a catalog loaded by `load_products`"""
+    return ProductIndex(all_products)
+
+
+# Keywords prefixes of searches that are not run by the search engine (see
+# `get_top_n_product_from_keywords`)
+SPECIAL_KEYWORDS = ('<r>', '<a>', '<c>', '<q>')
+
+
 def get_top_n_product_from_keywords(
         keywords,
         search_engine,
         all_products,
         product_item_dict,
         attribute_to_asins=None,
+        product_index=None,
+        search_filter=None,
     ):
+    """
+    Products matching `keywords`: a search of `search_engine`, or for the special
+    prefixes a random sample (`<r>`) or all products with an attribute
+    (`<a>`), category (`<c>`) or query (`<q>`). The latter three are looked
+    up in `product_index` if given (see `ProductIndex`), and otherwise
+    found by scanning `all_products`.
+
+    Searches of `search_engine` only return products matching
+    `search_filter` if given (see `search.SearchFilter`); the search engine
+    must then have the fields of the products (see `init_search_engine`).
+    """
     if keywords[0] == '<r>':
+        # Sampling only touches `SEARCH_RETURN_N` products
         top_n_products = random.sample(all_products, k=SEARCH_RETURN_N)
     elif keywords[0] == '<a>':
         attribute = ' '.join(keywords[1:]).strip()
-        asins = attribute_to_asins[attribute]
-        top_n_products = [p for p in all_products if p['asin'] in asins]
+        if product_index is not None:
+            top_n_products = product_index.get_attribute(attribute)
+        else:
+            asins = attribute_to_asins[attribute]
+            top_n_products = [p for p in all_products if p['asin'] in asins]
     elif keywords[0] == '<c>':
         category = keywords[1].strip()
-        top_n_products = [p for p in all_products if p['category'] == category]
+        if product_index is not None:
+            top_n_products = product_index.get_category(category)
+        else:
+            top_n_products = [p for p in all_products if p['category'] == category]
     elif keywords[0] == '<q>':
         query = ' '.join(keywords[1:]).strip()
-        top_n_products = [p for p in all_products if p['query'] == query]
+        if product_index is not None:
+            top_n_products = product_index.get_query(query)
+        else:
+            top_n_products = [p for p in all_products if p['query'] == query]
     else:
-        keywords = ' '.join(keywords)
-        hits = search_engine.search(keywords, k=SEARCH_RETURN_N)
-        docs = [search_engine.doc(hit.docid) for hit in hits]
-        top_n_asins = [json.loads(doc.raw())['id'] for doc in docs]
+        top_n_asins = search_asins(search_engine, keywords, SEARCH_RETURN_N, search_filter)
         top_n_products = [product_item_dict[asin] for asin in top_n_asins if asin in product_item_dict]
     return top_n_products
 
 
+def get_top_n_product_from_keywords_batch(
+        keywords_list,
+        search_engine,
+        all_products,
+        product_item_dict,
+        attribute_to_asins=None,
+        product_index=None,
+        threads=1,
+    ):
+    """
+    Products matching each of `keywords_list`, in order, as
+    `get_top_n_product_from_keywords` finds them. The searches of
+    `search_engine` are run in one batch (see `search.search_asins_batch`),
+    on up to `threads` threads.
+    """
+    searches = [i for i, keywords in enumerate(keywords_list) if keywords[0] not in SPECIAL_KEYWORDS]
+    top_n_asins = search_asins_batch(
+        search_engine, [keywords_list[i] for i in searches], SEARCH_RETURN_N, threads
+    )
+    results = [None] * len(keywords_list)
+    for i, asins in zip(searches, top_n_asins):
+        results[i] = [product_item_dict[asin] for asin in asins if asin in product_item_dict]
+    for i, keywords in enumerate(keywords_list):
+        if results[i] is None:
+            results[i] = get_top_n_product_from_keywords(
+                keywords,
+                search_engine,
+                all_products,
+                product_item_dict,
+                attribute_to_asins,
+                product_index,
+            )
+    return results
+
+
+def get_session_search_results(session, keywords, search):
+    """
+    Ranked products of `keywords` for `session`: those of its last search if
+    its keywords were the same (e.g. when paging through the results, or
+    going back to them from an item page), otherwise `search(keywords)`,
+    which are kept in the session for the next pages. Random (`<r>`)
+    samples are not kept, so every page draws a new one as before.
+    """
+    key = tuple(keywords)
+    cached = session.get('search_results')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    top_n_products = search(keywords)
+    if keywords[0] != '<r>':
+        session['search_results'] = (key, top_n_products)
+    return top_n_products
+
+
 def get_product_per_page(top_n_products, page):
     """Return products for the given page, with per-theme page size.
 
@@ -232,7 +366,15 @@ def generate_product_prices(all_products):
     return product_prices
 
 
-def init_search_engine(num_products=None):
+# Catalog sizes with an index of their own (None: all products)
+INDEX_SIZES = (100, 1000, 100000, None)
+
+
+def get_index_path(num_products=None, backend=DEFAULT_SEARCH_BACKEND):
+    """
+    Directory of the `backend` index of the first `num_products` products
+    (`hybrid` searches use the `bm25` and `dense` indexes)
+    """
     if num_products == 100:
         indexes = 'indexes_100'
     elif num_products == 1000:
@@ -243,8 +385,94 @@ def init_search_engine(num_products=None):
         indexes = 'indexes'
     else:
         raise NotImplementedError(f'num_products being {num_products} is not supported yet.')
-    search_engine = LuceneSearcher(os.path.join(BASE_DIR, f'../search_engine/{indexes}'))
-    return search_engine
+    if backend in ('bm25', 'dense'):
+        indexes = f'{backend}_{indexes}'
+    elif backend != 'lucene':
+        raise ValueError(f'Search backend {backend} not recognized.')
+    return os.path.join(BASE_DIR, f'../search_engine/{indexes}')
+
+
+def open_search_index(num_products=None, backend=DEFAULT_SEARCH_BACKEND):
+    """Open the `backend` index of the first `num_products` products, without cache or filter"""
+    if backend == 'lucene':
+        # Imported here, as importing pyserini starts a JVM
+        from pyserini.search.lucene import LuceneSearcher
+        return LuceneSearcher(get_index_path(num_products, backend))
+    if backend == 'bm25':
+        return BM25Searcher(get_index_path(num_products, backend))
+    if backend == 'dense':
+        return DenseSearcher(get_index_path(num_products, backend))
+    if backend == 'hybrid':
+        return HybridSearcher(
+            BM25Searcher(get_index_path(num_products, 'bm25')),
+            DenseSearcher(get_index_path(num_products, 'dense')),
+        )
+    raise ValueError(f'Search backend {backend} not recognized.')
+
+
+def init_search_engine(
+        num_products=None,
+        cache_size=DEFAULT_SEARCH_CACHE_SIZE,
+        backend=DEFAULT_SEARCH_BACKEND,
+        asins=None,
+        search_socket=None,
+        fields=None,
+    ):
+    """
+    Open the `backend` index for `num_products`, behind an LRU cache of up to
+    `cache_size` queries (see `search.CachedSearcher`; 0 disables caching).
+    Backends are `lucene` (pyserini, needs Java), `bm25` (see `bm25`), and
+    `dense` and `hybrid` (embeddings, alone or fused with BM25; see `dense`).
+
+    If `asins` is given, searches are restricted to these products, in the
+    index of all products (see `search.FilteredSearcher`). This serves
+    catalogs without an index of their own (any other `num_products`, or an
+    allow-list of products); term statistics are then those of all products,
+    so rankings can differ from those of a dedicated index.
+
+    If `search_socket` is given, the index is searched through the search
+    server listening on this Unix socket (see `search_server`) instead of
+    being opened, and must be the one the server serves.
+
+    If `fields` is given (see `build_document_fields`), searches can be
+    filtered by price, category and query (see `search.FieldSearcher`),
+    with filters applied while ranking; `asins` then restricts searches to
+    the products of `fields`.
+    """
+    if asins is None and num_products not in INDEX_SIZES:
+        raise NotImplementedError(
+            f'num_products being {num_products} needs the ASINs of the catalog to search.'
+        )
+    index_num_products = None if asins is not None else num_products
+    if search_socket is not None:
+        search_engine = SearchClient(search_socket)
+        if (search_engine.backend, search_engine.num_products) != (backend, index_num_products):
+            raise ValueError(
+                f'Search server at {search_socket} serves the {search_engine.backend} index of '
+                f'{search_engine.num_products or "all"} products, not the {backend} index of '
+                f'{index_num_products or "all"} products.'
+            )
+    else:
+        search_engine = open_search_index(index_num_products, backend)
+    if fields is not None:
+        search_engine = FieldSearcher(search_engine, fields, restrict=asins is not None)
+    elif asins is not None:
+        search_engine = FilteredSearcher(search_engine, asins)
+    return CachedSearcher(search_engine, cache_size)
+
+
+def build_document_fields(all_products, product_prices):
+    """
+    Fields searches can be filtered on (see `search.DocumentFields`) of the
+    products of `load_products` and their `product_prices`
+    """
+    return DocumentFields(
+        [p['asin'] for p in all_products],
+        [product_prices.get(p['asin'], math.nan) for p in all_products],
+        [p['category'] for p in all_products],
+        [p['query'] for p in all_products],
+        [p.get('product_category') or '' for p in all_products],
+    )
 
 
 def clean_product_keys(products):
@@ -267,8 +495,79 @@ def clean_product_keys(products):
     return products
 
 
-def load_products(filepath, num_products=None, human_goals=True):
-    # TODO: move to preprocessing step -> enforce single source of truth
+def get_product_options(customization_options):
+    """Options (name to values) and images of option values of a scraped product"""
+    options = dict()
+    option_to_image = dict()
+    if customization_options:
+        for option_name, option_contents in customization_options.items():
+            if option_contents is None:
+                continue
+            option_name = option_name.lower()
+
+            option_values = []
+            for option_content in option_contents:
+                option_value = option_content['value'].strip().replace('/', ' | ').lower()
+                option_image = option_content.get('image', None)
+
+                option_values.append(option_value)
+                option_to_image[option_value] = option_image
+            options[option_name] = option_values
+    return options, option_to_image
+
+
+def iter_search_documents(filepath, num_products=None):
+    """
+    Search documents (see `search.get_product_document`) of the products
+    `load_products` loads from `filepath`, in the same order. Products are
+    streamed from the file one at a time, so memory use does not grow with
+    the catalog (except for the set of ASINs seen, to skip duplicates).
+    """
+    asins = set()
+    for i, p in enumerate(iter_json_array(filepath)):
+        if num_products is not None and i >= num_products:
+            break
+        asin = p['asin']
+        if asin == 'nan' or len(asin) > 10 or asin in asins:
+            continue
+        asins.add(asin)
+        yield get_product_document(dict(
+            asin=asin,
+            Title=p['name'],
+            Description=p['full_description'],
+            BulletPoints=p['small_description']
+                if isinstance(p['small_description'], list) else [p['small_description']],
+            options=get_product_options(p['customization_options'])[0],
+        ))
+
+
+def get_source_paths(filepath):
+    """Files `load_products` builds the catalog from"""
+    return [filepath, DEFAULT_ATTR_PATH, HUMAN_ATTR_PATH]
+
+
+def load_products(filepath, num_products=None, human_goals=True, compact=True, use_snapshot=True, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    Load and normalize the product catalog
+
+    If `compact`, products are returned as `Product` records (see `product.py`)
+    rather than the scraped dicts. If `use_snapshot`, the catalog is read from
+    its binary snapshot in `snapshot_dir` (see `snapshot.py`) when one was
+    built from the current source files.
+    """
+    snapshot_path = get_snapshot_path(filepath, num_products, human_goals, snapshot_dir)
+    if use_snapshot and compact and is_snapshot_fresh(
+            snapshot_path, get_source_paths(filepath), num_products, human_goals):
+        old_time = time.time()
+        all_products, attribute_to_asins, price_ranges = read_snapshot(snapshot_path)
+        product_item_dict = {p['asin']: p for p in all_products}
+        # Print before drawing prices: like when loading from JSON, the
+        # first `rich` print of the process consumes from `random`
+        print(f'Products loaded from snapshot in {time.time() - old_time:.2f}s.')
+        product_prices = generate_product_prices_from_ranges(all_products, price_ranges)
+        return all_products, product_item_dict, product_prices, attribute_to_asins
+
+    old_time = time.time()
     with open(filepath) as f:
         products = json.load(f)
     print('Products loaded.')
@@ -342,23 +641,7 @@ def load_products(filepath, num_products=None, human_goals=True):
         products[i]['pricing'] = pricing
         products[i]['Price'] = price_tag
 
-        options = dict()
-        customization_options = p['customization_options']
-        option_to_image = dict()
-        if customization_options:
-            for option_name, option_contents in customization_options.items():
-                if option_contents is None:
-                    continue
-                option_name = option_name.lower()
-
-                option_values = []
-                for option_content in option_contents:
-                    option_value = option_content['value'].strip().replace('/', ' | ').lower()
-                    option_image = option_content.get('image', None)
-
-                    option_values.append(option_value)
-                    option_to_image[option_value] = option_image
-                options[option_name] = option_values
+        options, option_to_image = get_product_options(p['customization_options'])
         products[i]['options'] = options
         products[i]['option_to_image'] = option_to_image
 
@@ -393,10 +676,13 @@ def load_products(filepath, num_products=None, human_goals=True):
 
         all_products.append(products[i])
 
+    if compact:
+        all_products = [Product.from_dict(p) for p in all_products]
     for p in all_products:
         for a in p['Attributes']:
             attribute_to_asins[a].add(p['asin'])
 
     product_item_dict = {p['asin']: p for p in all_products}
     product_prices = generate_product_prices(all_products)
+    print(f'Products loaded from JSON in {time.time() - old_time:.2f}s.')
     return all_products, product_item_dict, product_prices, attribute_to_asins
@@ -2,17 +2,137 @@
 Functions for specifying goals and reward calculations.
 """
 import itertools
+import multiprocessing
+import os
+import pickle
 import random
-import spacy
-from collections import defaultdict
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from importlib import metadata
+
+import numpy as np
+from rapidfuzz import fuzz as rapid_fuzz, process
+from rapidfuzz.distance import Indel
 from rich import print
-from thefuzz import fuzz
 from web_agent_site.engine.normalize import normalize_color
 
-nlp = spacy.load("en_core_web_sm")
+SPACY_MODEL = 'en_core_web_sm'
+
+# spaCy pipeline of `SPACY_MODEL`; loading it takes seconds, so it is only
+# loaded when first needed (see `get_nlp`)
+nlp = None
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """spaCy pipeline of `SPACY_MODEL`, loaded on first call"""
+    global nlp
+    with _nlp_lock:
+        if nlp is None:
+            import spacy
+            nlp = spacy.load(SPACY_MODEL)
+    return nlp
 
 PRICE_RANGE = [10.0 * i for i in range(1, 100)]
 
+# Parts of speech of the name tokens compared by `get_type_reward`, and the
+# components of `nlp` that tag them (the parser, NER and lemmatizer are skipped)
+TYPE_POS = ('PNOUN', 'NOUN', 'PROPN')
+POS_PIPES = ('tok2vec', 'tagger', 'attribute_ruler')
+NOUN_BATCH_SIZE = 1000
+
+
+def _get_name_nouns(doc):
+    # `get_type_reward` needs the distinct nouns and, for its title score, their
+    # number with repeats
+    nouns = [t.text.lower() for t in doc if t.pos_ in TYPE_POS]
+    return frozenset(nouns), len(nouns)
+
+
+class NounCache:
+    """
+    Nouns of product and goal names (see `get_type_reward`), parsed once per
+    name by the part-of-speech components of `nlp`. Names are parsed in
+    batches by `add`, and otherwise on their first `get`. `save` and `load`
+    keep the cache on disk, for the model it was parsed with.
+    """
+    def __init__(self):
+        self.nouns = dict()
+
+    @staticmethod
+    def _get_model():
+        # Read from the installed package, so that loading a cache does not load the model
+        try:
+            return SPACY_MODEL, metadata.version(SPACY_MODEL)
+        except metadata.PackageNotFoundError:
+            return SPACY_MODEL, None
+
+    @staticmethod
+    def _get_disabled(nlp):
+        return [name for name in nlp.pipe_names if name not in POS_PIPES]
+
+    def __len__(self):
+        return len(self.nouns)
+
+    def get(self, name):
+        nouns = self.nouns.get(name)
+        if nouns is None:
+            nlp = get_nlp()
+            nouns = _get_name_nouns(nlp(name, disable=self._get_disabled(nlp)))
+            self.nouns[name] = nouns
+        return nouns
+
+    def add(self, names, batch_size=NOUN_BATCH_SIZE):
+        """Parse the names not cached yet, in batches; returns their number"""
+        names = [name for name in dict.fromkeys(names) if name not in self.nouns]
+        if not names:
+            return 0
+        nlp = get_nlp()
+        docs = nlp.pipe(names, batch_size=batch_size, disable=self._get_disabled(nlp))
+        for name, doc in zip(names, docs):
+            self.nouns[name] = _get_name_nouns(doc)
+        return len(names)
+
+    def load(self, path):
+        """
+        Add the names cached at `path`, if parsed with the current model;
+        returns their number
+        """
+        try:
+            with open(path, 'rb') as f:
+                model, nouns = pickle.load(f)
+        except FileNotFoundError:
+            return 0
+        if model != self._get_model():
+            return 0
+        self.nouns.update(nouns)
+        return len(nouns)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump((self._get_model(), self.nouns), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+
+name_nouns = NounCache()
+
+
+def precompute_name_nouns(all_products, goals, path=None):
+    """
+    Parse the names of all products and goals into `name_nouns`, so that type
+    rewards only compare sets. If `path` is given, names cached there are
+    not parsed again, and new ones are saved to it.
+    """
+    num_saved = name_nouns.load(path) if path is not None else 0
+    name_nouns.add(itertools.chain(
+        (p['name'] for p in all_products),
+        (goal['name'] for goal in goals),
+    ))
+    if path is not None and len(name_nouns) > num_saved:
+        name_nouns.save(path)
+
 def get_goals(all_products, product_prices, human_goals=True):
     if human_goals:
         return get_human_goals(all_products, product_prices)
@@ -137,22 +257,14 @@ def get_type_reward(purchased_product, goal):
     category_match = len(set(purchased_product_category) & set(goal_product_category)) >= 2
 
     # Determine whether types align based on product name similarity
-    purchased_type = purchased_product['name']
-    desired_type = goal['name']
-
-    purchased_type_parse = nlp(purchased_type)
-    desired_type_parse = nlp(desired_type)
+    purchased_nouns, _ = name_nouns.get(purchased_product['name'])
+    desired_nouns, num_desired_nouns = name_nouns.get(goal['name'])
 
-    purchased_type_parse = [t.text.lower() for t in purchased_type_parse if t.pos_ in ('PNOUN', 'NOUN', 'PROPN')]
-    desired_type_parse = [t.text.lower() for t in desired_type_parse if t.pos_ in ('PNOUN', 'NOUN', 'PROPN')]
-
-    n_intersect_type = len(
-        set(purchased_type_parse) & set(desired_type_parse)
-    )
-    if len(desired_type_parse) == 0:
+    n_intersect_type = len(purchased_nouns & desired_nouns)
+    if num_desired_nouns == 0:
         title_score = 0.2
     else:
-        title_score = n_intersect_type / len(desired_type_parse)
+        title_score = n_intersect_type / num_desired_nouns
 
     r_type = 1.0
 
@@ -175,72 +287,227 @@ def get_type_reward(purchased_product, goal):
     )
 
 
+def get_fuzzy_match_scores(queries, choices):
+    """
+    `fuzz.token_set_ratio` of each of `queries` with each of `choices`, as an
+    int array of shape (len(queries), len(choices)), scored in one batch by
+    rapidfuzz's `process.cdist`. Strings are processed as thefuzz 0.19 (the
+    pinned version) does, and scores rounded alike, so scores are exactly
+    those of its `fuzz.token_set_ratio`.
+    """
+    return _get_processed_match_scores(
+        [_fuzz_process(query) for query in queries],
+        [_fuzz_process(choice) for choice in choices],
+    )
+
+
+# `full_process` of thefuzz 0.19, as its `token_set_ratio` applies it: characters
+# 128-255 dropped, others but letters, digits and underscores replaced by spaces,
+# lowercased. Later versions (and rapidfuzz) also replace underscores.
+_FUZZ_NON_ASCII = {i: None for i in range(128, 256)}
+_FUZZ_NON_WORD = re.compile(r'(?ui)\W')
+
+
+def _fuzz_process(s):
+    # Also converts non-strings, as thefuzz does
+    return _FUZZ_NON_WORD.sub(' ', str(s).translate(_FUZZ_NON_ASCII)).lower().strip()
+
+
+def _get_processed_match_scores(queries, choices):
+    if not queries or not choices:
+        return np.zeros((len(queries), len(choices)), dtype=np.int64)
+    scores = process.cdist(queries, choices, scorer=rapid_fuzz.token_set_ratio, dtype=np.float64)
+    # Same rounding (half to even) as thefuzz's `int(round(score))`
+    rounded = np.rint(scores).astype(np.int64)
+    for i, j in zip(*np.nonzero(np.abs(scores - np.floor(scores) - 0.5) < _FUZZ_TIE_TOLERANCE)):
+        rounded[i, j] = _token_set_ratio(queries[i], choices[j])
+    return rounded
+
+
+# rapidfuzz and thefuzz 0.19 can compute a score of exactly a half a rounding
+# error apart (e.g. 57.5 and 57.49999999999999), so they round it differently;
+# scores this close to a half are computed again as thefuzz 0.19 does
+_FUZZ_TIE_TOLERANCE = 1e-6
+
+
+def _token_set_ratio(s1, s2):
+    """`fuzz.token_set_ratio` of processed strings, as thefuzz 0.19 computes it"""
+    tokens1, tokens2 = set(s1.split()), set(s2.split())
+    if not tokens1 or not tokens2:
+        return 0
+    sorted_sect = ' '.join(sorted(tokens1 & tokens2))
+    combined_1to2 = (sorted_sect + ' ' + ' '.join(sorted(tokens1 - tokens2))).strip()
+    combined_2to1 = (sorted_sect + ' ' + ' '.join(sorted(tokens2 - tokens1))).strip()
+    return max(
+        _ratio(sorted_sect, combined_1to2),
+        _ratio(sorted_sect, combined_2to1),
+        _ratio(combined_1to2, combined_2to1),
+    )
+
+
+def _ratio(s1, s2):
+    # `fuzz.ratio` with python-Levenshtein, in the same floating-point operations
+    if s1 == s2:
+        return 100
+    if not s1 or not s2:
+        return 0
+    lensum = len(s1) + len(s2)
+    return int(round(100 * ((lensum - Indel.distance(s1, s2)) / lensum)))
+
+
+# Rewards count strings as matching if their `fuzz.token_set_ratio` is above
+# 85, i.e. if their unrounded score is at least 85.5 (which rounds to 86);
+# scoring with this cutoff lets rapidfuzz skip most dissimilar pairs early
+FUZZY_MATCH_CUTOFF = 85.5
+
+
+def _get_processed_matches(queries, choices):
+    if not queries or not choices:
+        return np.zeros((len(queries), len(choices)), dtype=bool)
+    scores = process.cdist(
+        queries, choices, scorer=rapid_fuzz.token_set_ratio, dtype=np.float64,
+        score_cutoff=FUZZY_MATCH_CUTOFF - _FUZZ_TIE_TOLERANCE,
+    )
+    matches = scores >= FUZZY_MATCH_CUTOFF + _FUZZ_TIE_TOLERANCE
+    for i, j in zip(*np.nonzero((scores >= FUZZY_MATCH_CUTOFF - _FUZZ_TIE_TOLERANCE) & ~matches)):
+        matches[i, j] = _token_set_ratio(queries[i], choices[j]) > 85
+    return matches
+
+
+class ProductMatchText:
+    """
+    Text of a purchased product that goal attributes are matched against (see
+    `get_attribute_reward`): its attributes processed for fuzzy matching,
+    and the lowercased title, bullet points and description, only built if
+    an attribute is not matched by the attributes
+    """
+    __slots__ = ('product', 'attributes', '_texts')
+
+    def __init__(self, product):
+        self.product = product
+        self.attributes = [_fuzz_process(attr) for attr in product['Attributes']]
+        self._texts = None
+
+    @property
+    def texts(self):
+        if self._texts is None:
+            self._texts = (
+                self.product['Title'].lower(),
+                ' '.join(self.product['BulletPoints']).lower(),
+                self.product['Description'].lower(),
+            )
+        return self._texts
+
+
+# `ProductMatchText` of recently purchased catalog products, by ASIN, least
+# recently used first
+PRODUCT_MATCH_TEXT_CACHE_SIZE = 10000
+product_match_texts = OrderedDict()
+_product_match_texts_lock = threading.Lock()
+
+
+def get_product_match_text(product):
+    """`ProductMatchText` of `product`, cached if it has an ASIN"""
+    asin = product.get('asin')
+    if asin is None:
+        return ProductMatchText(product)
+    with _product_match_texts_lock:
+        match_text = product_match_texts.get(asin)
+        if match_text is None or match_text.product is not product:
+            match_text = product_match_texts[asin] = ProductMatchText(product)
+            if len(product_match_texts) > PRODUCT_MATCH_TEXT_CACHE_SIZE:
+                product_match_texts.popitem(last=False)
+        product_match_texts.move_to_end(asin)
+    return match_text
+
+
 def get_attribute_reward(purchased_product, goal):
     """Determines whether purchased products shares same attributes as goal"""
-    purchased_attrs = purchased_product['Attributes']
     goal_attrs = goal['attributes']
+    num_attr_matches = _count_attribute_matches(
+        get_product_match_text(purchased_product),
+        goal_attrs,
+        [_fuzz_process(g_attr) for g_attr in goal_attrs],
+    )
+    r_attr = num_attr_matches / len(goal_attrs)
+    return r_attr, num_attr_matches
+
+
+def _count_attribute_matches(match_text, goal_attrs, processed_goal_attrs):
+    # Check whether goal attributes are found in purchased product attribute list
+    matches = _get_processed_matches(processed_goal_attrs, match_text.attributes)
+    return _count_text_matches(match_text, goal_attrs, matches.any(axis=1))
 
+
+def _count_text_matches(match_text, goal_attrs, matched):
+    # Goal attributes `matched` by the purchased product attributes, or else found
+    # in its Title, Bullet Points (Features) or Desc
     num_attr_matches = 0
-    for g_attr in goal_attrs:
-        matched = False
-        # Check whether goal attribute found in purchased product attribute list
-        for p_attr in purchased_attrs:
-            score = fuzz.token_set_ratio(p_attr, g_attr)
-            if score > 85:
-                num_attr_matches += 1
-                matched = True
-                break
-        # If not in purchased attrs, check Title, Bullet Points (Features), Desc
-        if (
-            not matched and
-            (
-                g_attr in purchased_product['Title'].lower() or
-                g_attr in ' '.join(purchased_product['BulletPoints']).lower() or
-                g_attr in purchased_product['Description'].lower()
-            )
-        ):
+    for g_attr, attr_matched in zip(goal_attrs, matched):
+        if attr_matched or any(g_attr in text for text in match_text.texts):
             num_attr_matches += 1
-            matched = True
-    
-    r_attr = num_attr_matches / len(goal_attrs)
-    return r_attr, num_attr_matches
+    return num_attr_matches
 
 
 def get_option_reward(purchased_options, goal_options):
     """Calculate reward for purchased product's options w.r.t. goal options"""
-    purchased_options = [normalize_color(o) for o in purchased_options]
-    goal_options = [normalize_color(o) for o in goal_options]
+    goal_options = [_fuzz_process(normalize_color(o)) for o in goal_options]
+    num_option_matches = _count_option_matches(purchased_options, goal_options)
 
-    # Perform fuzzy matching of each purchased option against each goal option
-    num_option_matches = 0
-    for g_option in goal_options:
-        for p_option in purchased_options:
-            score = fuzz.token_set_ratio(p_option, g_option)
-            if score > 85:
-                num_option_matches += 1
-                break
-    
     # Calculate option reward as fraction of goal options hit
     r_option = num_option_matches / len(goal_options) if len(goal_options) > 0 else None
     return r_option, num_option_matches
 
 
+def _count_option_matches(purchased_options, processed_goal_options):
+    # Perform fuzzy matching of each purchased option against each goal option
+    purchased_options = [_fuzz_process(normalize_color(o)) for o in purchased_options]
+    matches = _get_processed_matches(processed_goal_options, purchased_options)
+    return int(matches.any(axis=1).sum())
+
+
+class GoalMatchText:
+    """
+    Attributes and (color-normalized) options of a goal, processed for fuzzy
+    matching once for all the purchases scored against it
+    """
+    __slots__ = ('attributes', 'options')
+
+    def __init__(self, goal):
+        self.attributes = [_fuzz_process(g_attr) for g_attr in goal['attributes']]
+        self.options = [_fuzz_process(normalize_color(o)) for o in _get_goal_options(goal)]
+
+
+def _get_goal_options(goal):
+    goal_options = goal['goal_options']
+    return goal_options.items() if isinstance(goal_options, dict) else goal_options
+
+
 def get_reward(purchased_product, goal, price, options, **kwargs):
     """Get cumulative reward score for purchased product and goal"""
+    _, num_attr_matches = get_attribute_reward(purchased_product, goal)
+    _, num_option_matches = get_option_reward(list(options.values()), _get_goal_options(goal))
+    total_reward, info = _get_reward(
+        purchased_product, goal, price, num_attr_matches, num_option_matches
+    )
+    if kwargs.get('verbose', False):
+        return total_reward, info
+    return total_reward
+
+
+def _get_reward(purchased_product, goal, price, num_attr_matches, num_option_matches):
+    # Total reward and its score sub-components (see `get_reward`), given the
+    # numbers of goal attributes and options matched
     r_type_dict = get_type_reward(purchased_product, goal)
 
     r_price = (
         price <= goal['price_upper']
     ) if goal['price_upper'] > 0 else None
 
-    r_att, num_attr_matches = get_attribute_reward(purchased_product, goal)
+    r_att = num_attr_matches / len(goal['attributes'])
 
-    r_option, num_option_matches = get_option_reward(
-        list(options.values()),
-        goal['goal_options'].items()
-        if isinstance(goal['goal_options'], dict)
-        else goal['goal_options']
-    )
+    num_goal_options = len(goal['goal_options'])
+    r_option = num_option_matches / num_goal_options if num_goal_options > 0 else None
 
     total_reward = (
         (num_attr_matches + num_option_matches + r_price) \
@@ -249,21 +516,102 @@ def get_reward(purchased_product, goal, price, options, **kwargs):
 
     total_reward *= r_type_dict['r_type']
 
-    # If verbose flag enabled, store score sub-components into dictionary
-    if kwargs.get('verbose', False):
-        info =  {
-            'r_type': r_type_dict['r_type'],
-            'r_att': r_att,
-            'w_att': len(goal['attributes']) / (len(goal['attributes']) + len(goal['goal_options']) + 1),
-            'query_match': r_type_dict['query_match'],
-            'category_match': r_type_dict['category_match'],
-            'title_score': r_type_dict['title_score'],
-        }
-        if r_option is not None:
-            info['r_option'] = r_option
-            info['w_option'] = len(goal['goal_options']) / (len(goal['attributes']) + len(goal['goal_options']) + 1)
-        if r_price is not None:
-            info['r_price'] = r_price
-            info['w_price'] = 1 / (len(goal['attributes']) + len(goal['goal_options']) + 1)
-        return total_reward, info
-    return total_reward
+    # Score sub-components
+    info =  {
+        'r_type': r_type_dict['r_type'],
+        'r_att': r_att,
+        'w_att': len(goal['attributes']) / (len(goal['attributes']) + len(goal['goal_options']) + 1),
+        'query_match': r_type_dict['query_match'],
+        'category_match': r_type_dict['category_match'],
+        'title_score': r_type_dict['title_score'],
+    }
+    if r_option is not None:
+        info['r_option'] = r_option
+        info['w_option'] = len(goal['goal_options']) / (len(goal['attributes']) + len(goal['goal_options']) + 1)
+    if r_price is not None:
+        info['r_price'] = r_price
+        info['w_price'] = 1 / (len(goal['attributes']) + len(goal['goal_options']) + 1)
+    return total_reward, info
+
+
+# Sub-components of the rewards returned by `get_rewards_batch`
+REWARD_COMPONENTS = ('r_type', 'r_att', 'r_option', 'r_price')
+REWARD_CHUNK_SIZE = 1000
+
+
+def get_rewards_batch(purchased_products, goals, prices, options, processes=1, chunk_size=REWARD_CHUNK_SIZE):
+    """
+    Rewards of many purchases at once (e.g. to relabel logged trajectories):
+    purchase `i` is of `purchased_products[i]` with `options[i]` (as in
+    `get_reward`) at `prices[i]`, for `goals[i]`. Returns float arrays by
+    key: the total `reward` and its sub-components (`REWARD_COMPONENTS`),
+    NaN where `get_reward` leaves them out.
+
+    The names of all products and goals are parsed in one batch, and each
+    distinct goal and product is processed for fuzzy matching once. If
+    `processes` > 1, purchases are scored by a process pool, in chunks of
+    `chunk_size`.
+    """
+    if not len(purchased_products) == len(goals) == len(prices) == len(options):
+        raise ValueError(
+            'purchased_products, goals, prices and options must have the same length.'
+        )
+    precompute_name_nouns(purchased_products, goals)
+    chunks = [
+        (
+            purchased_products[i:i + chunk_size],
+            goals[i:i + chunk_size],
+            prices[i:i + chunk_size],
+            options[i:i + chunk_size],
+        )
+        for i in range(0, len(goals), chunk_size)
+    ]
+    if processes > 1 and len(chunks) > 1:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # Workers forked from this process share the names parsed above
+            pool = multiprocessing.get_context('fork').Pool(min(processes, len(chunks)))
+        else:
+            # Others are passed their nouns, rather than loading spaCy to parse them again
+            names = itertools.chain((p['name'] for p in purchased_products), (goal['name'] for goal in goals))
+            pool = multiprocessing.Pool(
+                min(processes, len(chunks)),
+                initializer=_set_name_nouns,
+                initargs=({name: name_nouns.get(name) for name in names},),
+            )
+        with pool:
+            results = pool.map(_get_rewards_chunk, chunks)
+    else:
+        results = [_get_rewards_chunk(chunk) for chunk in chunks]
+    keys = ('reward',) + REWARD_COMPONENTS
+    if not results:
+        return {key: np.zeros(0) for key in keys}
+    return {key: np.concatenate([result[key] for result in results]) for key in keys}
+
+
+def _set_name_nouns(nouns):
+    name_nouns.nouns.update(nouns)
+
+
+def _get_rewards_chunk(chunk):
+    purchased_products, goals, prices, options = chunk
+    rewards = {key: np.full(len(goals), np.nan) for key in ('reward',) + REWARD_COMPONENTS}
+    # Goals are processed once per chunk, as many purchases share a goal
+    goal_match_texts = dict()
+    for i, (purchased_product, goal, price, purchase_options) in enumerate(
+            zip(purchased_products, goals, prices, options)):
+        goal_match_text = goal_match_texts.get(id(goal))
+        if goal_match_text is None:
+            goal_match_text = goal_match_texts[id(goal)] = GoalMatchText(goal)
+        num_attr_matches = _count_attribute_matches(
+            get_product_match_text(purchased_product), goal['attributes'], goal_match_text.attributes
+        )
+        num_option_matches = _count_option_matches(
+            list(purchase_options.values()), goal_match_text.options
+        )
+        rewards['reward'][i], info = _get_reward(
+            purchased_product, goal, price, num_attr_matches, num_option_matches
+        )
+        for key in REWARD_COMPONENTS:
+            if key in info:
+                rewards[key][i] = info[key]
+    return rewards
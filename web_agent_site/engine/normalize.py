@@ -1,6 +1,10 @@
 import re
+from functools import lru_cache
 from typing import Tuple
 
+# Number of distinct option values whose normalized color and size are cached
+NORMALIZE_CACHE_SIZE = 1 << 16
+
 COLOR_SET = [
     'alabaster', 'apricot', 'aqua', 'ash', 'asphalt', 'azure',
     'banana', 'beige', 'black', 'blue', 'blush', 'bordeaux', 'bronze',
@@ -54,12 +58,109 @@ SIZE_PATTERNS = [
 ]
 SIZE_PATTERNS = [re.compile(s) for s in SIZE_SET] + SIZE_PATTERNS
 
-def normalize_color(color_string: str) -> str:
-    """Extracts the first color found if exists"""
+
+def _get_trie_pattern(words):
+    """Regex matching `words`, as a trie of alternatives (shorter words first)"""
+    trie = dict()
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, dict())
+        node[''] = None
+
+    def get_pattern(node):
+        alternatives = [''] if '' in node else []
+        alternatives += [re.escape(char) + get_pattern(child) for char, child in node.items() if char]
+        return alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+    return get_pattern(trie)
+
+
+# Colors of `COLOR_SET` are found in one pass of a regex built as a trie of
+# them, which skips positions where no color starts. At a position, it
+# matches the shortest color; the colors it is a prefix of, and the other
+# colors starting at later positions, are then checked to keep the first one
+# of `COLOR_SET`, as a scan of `COLOR_SET` would.
+COLOR_PATTERN = re.compile(_get_trie_pattern(COLOR_SET))
+COLOR_INDEX = {color: i for i, color in enumerate(COLOR_SET)}
+COLOR_EXTENSIONS = {
+    color: [other for other in COLOR_SET if other != color and other.startswith(color)]
+    for color in COLOR_SET
+}
+
+
+def _get_search_pattern(pattern):
+    # A pattern found by a search whenever the pattern is: `(.*)` at its ends
+    # can match nothing, so they only slow down the search
+    pattern = pattern.pattern
+    while pattern.startswith('(.*)'):
+        pattern = pattern[len('(.*)'):]
+    while pattern.endswith('(.*)') and not pattern.endswith('\\(.*)'):
+        pattern = pattern[:-len('(.*)')]
+    return pattern
+
+
+# `SIZE_PATTERNS` in one regex: its alternatives are tried in order from the
+# start of the string, and each looks for its pattern anywhere, so that the
+# first pattern found is that of a search of each pattern in turn
+SIZE_PATTERN = re.compile('|'.join(
+    f'(?P<size{i}>(?=[\\s\\S]*?(?:{_get_search_pattern(pattern)})))'
+    for i, pattern in enumerate(SIZE_PATTERNS)
+))
+
+
+def _scan_color(color_string):
+    # First color of `COLOR_SET` in `color_string` (or among its items, if not a string)
     for norm_color in COLOR_SET:
         if norm_color in color_string:
             return norm_color
-    return color_string
+    return None
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _match_color(color_string):
+    color_index = None
+    m = COLOR_PATTERN.search(color_string)
+    while m is not None:
+        color = m.group()
+        if color_index is None or COLOR_INDEX[color] < color_index:
+            color_index = COLOR_INDEX[color]
+        for longer_color in COLOR_EXTENSIONS[color]:
+            if COLOR_INDEX[longer_color] < color_index and color_string.startswith(longer_color, m.start()):
+                color_index = COLOR_INDEX[longer_color]
+        m = COLOR_PATTERN.search(color_string, m.start() + 1)
+    return None if color_index is None else COLOR_SET[color_index]
+
+
+def _scan_size(size_string):
+    # Pattern of the first of `SIZE_PATTERNS` found in `size_string`
+    for pattern in SIZE_PATTERNS:
+        if re.search(pattern, size_string) is not None:
+            return pattern.pattern
+    return None
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_size(size_string: str) -> str:
+    """
+    Pattern of the first of `SIZE_PATTERNS` found in a (lowercased) size,
+    else `numeric_size` for numbers and `not_matched` for other sizes
+    """
+    m = SIZE_PATTERN.match(size_string)
+    if m is not None:
+        return SIZE_PATTERNS[int(m.lastgroup[len('size'):])].pattern
+    if size_string.replace('.', '', 1).isdigit():
+        return 'numeric_size'
+    return 'not_matched'
+
+
+def normalize_color(color_string: str) -> str:
+    """Extracts the first color found if exists"""
+    if isinstance(color_string, str):
+        norm_color = _match_color(color_string)
+    else:
+        # Sequences such as (option name, value) pairs match whole items
+        norm_color = _scan_color(color_string)
+    return color_string if norm_color is None else norm_color
 
 def normalize_color_size(product_prices: dict) -> Tuple[dict, dict]:
     """Get mappings of all colors, sizes to corresponding values in COLOR_SET, SIZE_PATTERNS"""
@@ -73,31 +174,60 @@ def normalize_color_size(product_prices: dict) -> Tuple[dict, dict]:
     # Create mapping of each original color value to corresponding set value
     color_mapping = {'N.A.': 'not_matched'} 
     for c in all_colors:
-        matched = False
-        for base in COLOR_SET:
-            if base in c:
-                color_mapping[c] = base
-                matched = True
-                break
-        if not matched:
-            color_mapping[c] = 'not_matched'
+        color_mapping[c] = _match_color(c) or 'not_matched'
 
     # Create mapping of each original size value to corresponding set value
     size_mapping = {'N.A.': 'not_matched'}
     for s in all_sizes:
-        matched = False
-        for pattern in SIZE_PATTERNS:
-            m = re.search(pattern, s)
-            if m is not None:
-                matched = True
-                size_mapping[s] = pattern.pattern
-                break
-        if not matched:
-            if s.replace('.', '', 1).isdigit():
-                size_mapping[s] = 'numeric_size'
-                matched= True
-        if not matched:
-            size_mapping[s] = 'not_matched'
+        size_mapping[s] = normalize_size(s)
     
     return color_mapping, size_mapping
     
+
+def main():
+    import argparse
+    import time
+    from web_agent_site.engine.engine import get_product_options
+    from web_agent_site.utils import DEFAULT_FILE_PATH, iter_json_array
+
+    parser = argparse.ArgumentParser(
+        description='Time color and size normalization over all option values of the products'
+    )
+    parser.add_argument('--file_path', default=DEFAULT_FILE_PATH)
+    parser.add_argument('--num_products', type=int, default=None)
+    args = parser.parse_args()
+
+    option_values = set()
+    for i, product in enumerate(iter_json_array(args.file_path)):
+        if i == args.num_products:
+            break
+        options, _ = get_product_options(product.get('customization_options'))
+        for values in options.values():
+            option_values.update(values)
+    option_values = sorted(option_values)
+    print(f'{len(option_values)} distinct option values')
+
+    def run(name, normalize):
+        old_time = time.time()
+        results = [normalize(value) for value in option_values]
+        print(f'{name}: {(time.time() - old_time) / len(option_values) * 1e6:.2f} us/value')
+        return results
+
+    for name, scan, normalize in [
+        ('color', _scan_color, _match_color),
+        ('size', _scan_size, normalize_size),
+    ]:
+        normalize.cache_clear()
+        expected = run(f'{name} scan', scan)
+        results = run(f'{name} matcher', normalize)
+        run(f'{name} matcher (cached)', normalize)
+        if name == 'size':
+            expected = [
+                pattern or ('numeric_size' if value.replace('.', '', 1).isdigit() else 'not_matched')
+                for value, pattern in zip(option_values, expected)
+            ]
+        assert results == expected, f'{name} matcher differs from the scan'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Compact product records for the catalog loaded by `engine.load_products`.
+
+The scraped product dicts carry many fields nothing reads after loading
+(`customization_options`, `small_description`, `images`, ...), and every
+dict pays for its own hash table. `Product` keeps only the fields the
+engine, templates and reward use, in slots, and interns the strings that
+repeat across products (categories, queries, options, attributes, prices).
+
+Measure the memory saved with:
+
+    python -m web_agent_site.engine.product [--file_path ...] [--num_products ...]
+"""
+import sys
+from collections.abc import Mapping
+
+# Fields kept from the dicts built by `load_products`, in iteration order
+FIELDS = (
+    'asin',
+    'Title',
+    'Description',
+    'BulletPoints',
+    'Price',
+    'pricing',
+    'Rating',
+    'Reviews',
+    'MainImage',
+    'options',
+    'option_to_image',
+    'Attributes',
+    'category',
+    'query',
+    'product_category',
+    'instruction_text',
+    'instruction_attributes',
+    'instructions',
+)
+
+# Scraped field names that `load_products` copies to the fields above
+ALIASES = {
+    'name': 'Title',
+    'full_description': 'Description',
+}
+
+_SLOT_OF = dict({field: field for field in FIELDS}, **ALIASES)
+
+_MISSING = object()
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Product(Mapping):
+    """
+    Product record with the read-only `dict` interface of the scraped products.
+
+    Fields are accessed as `product['Title']` (or `product.Title` in templates);
+    fields a product does not have (e.g. `instructions` without human goals)
+    are missing, as they were from the dict. Keys outside `FIELDS` can still
+    be set and are kept in a small per-product dict.
+    """
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, **fields):
+        self._extra = None
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, product):
+        """Build a `Product` from a product dict of `load_products`"""
+        fields = {key: product[key] for key in FIELDS if key in product}
+        for key in ('category', 'query', 'product_category', 'Price'):
+            if key in fields:
+                fields[key] = _intern(fields[key])
+        if 'Attributes' in fields:
+            fields['Attributes'] = [_intern(a) for a in fields['Attributes']]
+        if 'options' in fields:
+            fields['options'] = {
+                _intern(name): [_intern(value) for value in values]
+                for name, values in fields['options'].items()
+            }
+        if 'option_to_image' in fields:
+            fields['option_to_image'] = {
+                _intern(value): image
+                for value, image in fields['option_to_image'].items()
+            }
+        return cls(**fields)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, _SLOT_OF[key])
+        except KeyError:
+            if self._extra is not None and key in self._extra:
+                return self._extra[key]
+        except AttributeError:
+            pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _SLOT_OF:
+            setattr(self, _SLOT_OF[key], value)
+        else:
+            if self._extra is None:
+                self._extra = dict()
+            self._extra[key] = value
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        # Compare slot by slot (asin first) rather than as two new dicts
+        if isinstance(other, Product):
+            return self is other or all(
+                getattr(self, key, _MISSING) == getattr(other, key, _MISSING)
+                for key in self.__slots__
+            )
+        return Mapping.__eq__(self, other)
+
+    def __repr__(self):
+        return f'Product({dict(self)!r})'
+
+
+def main():
+    import argparse
+    import gc
+    import tracemalloc
+    from web_agent_site.engine import engine
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Measure the memory held by the product catalog')
+    parser.add_argument('--file_path', default=DEFAULT_FILE_PATH)
+    parser.add_argument('--num_products', type=int, default=None)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    all_products = engine.load_products(
+        args.file_path, args.num_products, compact=False, use_snapshot=False
+    )[0]
+    gc.collect()
+    dict_size = tracemalloc.get_traced_memory()[0]
+
+    all_products = [Product.from_dict(p) for p in all_products]
+    gc.collect()
+    product_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'{len(all_products)} products')
+    print(f'Product dicts: {dict_size / 2 ** 20:.1f} MiB')
+    print(f'Product records: {product_size / 2 ** 20:.1f} MiB')
+    print(f'Saved: {(dict_size - product_size) / 2 ** 20:.1f} MiB ({1 - product_size / dict_size:.0%})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+"""
+Search layer between the engine and the search backends.
+
+A search backend (`SearchBackend`) ranks the indexed product documents for
+a query; pyserini's `LuceneSearcher` is one, `bm25.BM25Searcher` another
+that runs without Java, and `dense.DenseSearcher` and `dense.HybridSearcher`
+rank by embeddings. `CachedSearcher` wraps a backend and keeps the ranked
+ASINs of recent queries in a bounded LRU cache, so that repeated searches
+(paging through results, going back to them, agents re-issuing the same
+queries) skip the backend altogether.
+"""
+import math
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_SEARCH_CACHE_SIZE = 10000
+
+# Names of the search backends `engine.init_search_engine` can open
+SEARCH_BACKENDS = ('lucene', 'bm25', 'dense', 'hybrid')
+DEFAULT_SEARCH_BACKEND = 'lucene'
+
+SearchHit = namedtuple('SearchHit', ['docid', 'score'])
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+# Constraints of a filtered search (see `FieldSearcher`): a price range (bounds
+# included) and the `category`, `query` or a node of the `product_category` of
+# products; None for no constraint
+SearchFilter = namedtuple(
+    'SearchFilter',
+    ['price_lower', 'price_upper', 'category', 'query', 'product_category'],
+    defaults=(None, None, None, None, None),
+)
+
+# Number of filters whose masks `FieldSearcher` keeps
+DEFAULT_FILTER_CACHE_SIZE = 256
+
+
+def normalize_keywords(keywords):
+    """
+    Cache key of a search for `keywords`: the lowercased terms of the query,
+    which the analyzer of the index matches regardless of case and spacing
+    """
+    return tuple(' '.join(keywords).lower().split())
+
+
+class SearchCache:
+    """Bounded, thread-safe LRU cache with hit, miss and eviction counters"""
+    def __init__(self, maxsize=DEFAULT_SEARCH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the value cached for `key` (marking it as recently used), or None"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.evictions, self.maxsize, len(self._entries)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+class SearchBackend:
+    """
+    Interface of search backends, that of pyserini's `LuceneSearcher`:
+    `search(query, k)` returns the top `k` hits for `query`, best first,
+    each with the `docid` (the product's ASIN) and `score` of a document;
+    `batch_search(queries, qids, k, threads)` the hits of several queries,
+    by qid
+    """
+    def search(self, query, k=10):
+        raise NotImplementedError
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        """Hits of each of `queries` by qid, searched on up to `threads` threads"""
+        if threads > 1 and len(queries) > 1:
+            with ThreadPoolExecutor(min(threads, len(queries))) as executor:
+                results = list(executor.map(lambda query: self.search(query, k=k), queries))
+        else:
+            results = [self.search(query, k=k) for query in queries]
+        return dict(zip(qids, results))
+
+
+class FilteredSearcher(SearchBackend):
+    """
+    Search backend restricted to the documents of `docids` (e.g. the ASINs of
+    a catalog smaller than the index). Backends that can filter documents
+    while ranking (`get_doc_mask`, see `bm25.BM25Searcher`) are passed a mask
+    of the allowed documents; from others, hits are over-fetched (in
+    proportion to the share of allowed documents, then four times more each
+    time) until `k` allowed ones are found or the index is exhausted.
+    """
+    def __init__(self, searcher, docids):
+        self.searcher = searcher
+        self.docids = frozenset(docids)
+        self.num_docs = getattr(searcher, 'num_docs', None)
+        get_doc_mask = getattr(searcher, 'get_doc_mask', None)
+        self.doc_mask = None if get_doc_mask is None else get_doc_mask(self.docids)
+        if self.num_docs and self.docids:
+            self.fetch_factor = math.ceil(self.num_docs / len(self.docids))
+        else:
+            self.fetch_factor = 1
+
+    def search(self, query, k=10):
+        if not self.docids:
+            return []
+        if self.doc_mask is not None:
+            return self.searcher.search(query, k=k, doc_mask=self.doc_mask)
+        return _over_fetch(
+            self.searcher, query, k, self.docids.__contains__, k * self.fetch_factor, self.num_docs
+        )
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        if self.doc_mask is not None or not self.docids:
+            return super().batch_search(queries, qids, k=k, threads=threads)
+        # Over-fetch all queries at once; those short of allowed hits are searched again alone
+        fetch = k * self.fetch_factor
+        if self.num_docs:
+            fetch = min(fetch, self.num_docs)
+        results = _batch_search(self.searcher, queries, qids, fetch, threads)
+        for query, qid in zip(queries, qids):
+            hits = results.get(qid, [])
+            allowed = [hit for hit in hits if hit.docid in self.docids]
+            if len(allowed) >= k or len(hits) < fetch or fetch == self.num_docs:
+                results[qid] = allowed[:k]
+            else:
+                results[qid] = self.search(query, k=k)
+        return results
+
+    def __getattr__(self, name):
+        return getattr(self.searcher, name)
+
+
+def _over_fetch(searcher, query, k, is_allowed, fetch, num_docs):
+    """Top `k` allowed hits, fetching `fetch` hits then four times more until enough are allowed"""
+    while True:
+        if num_docs:
+            fetch = min(fetch, num_docs)
+        hits = searcher.search(query, k=fetch)
+        allowed = [hit for hit in hits if is_allowed(hit.docid)]
+        if len(allowed) >= k or len(hits) < fetch or fetch == num_docs:
+            return allowed[:k]
+        fetch *= 4
+
+
+def _index_terms(values):
+    """Positions of the documents having each term, for the terms (or lists of them) of each document"""
+    term_docs = defaultdict(list)
+    for doc, terms in enumerate(values):
+        for term in ([terms] if isinstance(terms, str) else terms):
+            term_docs[term].append(doc)
+    return {term: np.array(docs, dtype=np.int64) for term, docs in term_docs.items()}
+
+
+class DocumentFields:
+    """
+    Fields of the products of a catalog that searches can be filtered on
+    (see `SearchFilter`), as columns in the order of `asins`: the price of
+    each product, and the products having each category, query and
+    `product_category` node. `asin_positions` maps ASINs to their column.
+    """
+    TERM_FIELDS = ('category', 'query', 'product_category')
+
+    def __init__(self, asins, prices, categories, queries, product_categories):
+        self.asins = list(asins)
+        self.asin_positions = {asin: i for i, asin in enumerate(self.asins)}
+        self.prices = np.array(prices, dtype=np.float64)
+        self.term_docs = dict(
+            category=_index_terms(categories),
+            query=_index_terms(queries),
+            product_category=_index_terms(
+                [node.strip() for node in product_category.split('›')]
+                for product_category in product_categories
+            ),
+        )
+
+    def __len__(self):
+        return len(self.asins)
+
+    def get_mask(self, search_filter):
+        """Boolean mask of the products matching `search_filter`"""
+        mask = np.ones(len(self.asins), dtype=bool)
+        if search_filter.price_lower is not None:
+            mask &= self.prices >= search_filter.price_lower
+        if search_filter.price_upper is not None:
+            mask &= self.prices <= search_filter.price_upper
+        for field in self.TERM_FIELDS:
+            term = getattr(search_filter, field)
+            if term is not None:
+                term_mask = np.zeros(len(self.asins), dtype=bool)
+                term_mask[self.term_docs[field].get(term, [])] = True
+                mask &= term_mask
+        return mask
+
+
+class FieldSearcher(SearchBackend):
+    """
+    Search backend whose searches can be filtered by the fields of the
+    products of a catalog (`search(query, k, search_filter)`, see
+    `SearchFilter` and `DocumentFields`). Filtered searches only return
+    products of the catalog; if `restrict`, unfiltered ones too (as would a
+    `FilteredSearcher` of its ASINs).
+
+    Backends that can filter documents while ranking (`get_doc_positions`,
+    see `bm25.BM25Searcher`) are passed a mask of the matching documents,
+    built from the fields' columns and cached per filter, so that filtered
+    searches cost about as much as unfiltered ones. From others, hits are
+    over-fetched as by `FilteredSearcher`.
+    """
+    def __init__(self, searcher, fields, restrict=False, filter_cache_size=DEFAULT_FILTER_CACHE_SIZE):
+        self.searcher = searcher
+        self.fields = fields
+        self.restrict = restrict
+        self.num_docs = getattr(searcher, 'num_docs', None)
+        get_doc_positions = getattr(searcher, 'get_doc_positions', None)
+        self.positions = get_doc_positions(fields.asins) if get_doc_positions is not None else None
+        self.masks = SearchCache(filter_cache_size)
+
+    def get_doc_mask(self, search_filter):
+        """
+        Mask of the documents matching `search_filter`, over the documents of
+        the backend if it can filter them, and otherwise over the catalog
+        """
+        mask = self.masks.get(search_filter)
+        if mask is None:
+            mask = self.fields.get_mask(search_filter)
+            if self.positions is not None:
+                positions = self.positions[mask]
+                mask = np.zeros(self.num_docs, dtype=bool)
+                mask[positions[positions >= 0]] = True
+            self.masks.put(search_filter, mask)
+        return mask
+
+    def search(self, query, k=10, search_filter=None):
+        if search_filter is None:
+            if not self.restrict:
+                return self.searcher.search(query, k=k)
+            search_filter = SearchFilter()
+        mask = self.get_doc_mask(search_filter)
+        num_matches = int(np.count_nonzero(mask))
+        if num_matches == 0:
+            return []
+        if self.positions is not None:
+            return self.searcher.search(query, k=k, doc_mask=mask)
+
+        def is_allowed(docid):
+            i = self.fields.asin_positions.get(docid)
+            return i is not None and mask[i]
+        fetch = k * math.ceil(self.num_docs / num_matches) if self.num_docs else k
+        return _over_fetch(self.searcher, query, k, is_allowed, fetch, self.num_docs)
+
+    def batch_search(self, queries, qids, k=10, threads=1, search_filter=None):
+        if search_filter is None and not self.restrict:
+            return _batch_search(self.searcher, queries, qids, k, threads)
+        return {
+            qid: self.search(query, k=k, search_filter=search_filter)
+            for query, qid in zip(queries, qids)
+        }
+
+    def __getattr__(self, name):
+        return getattr(self.searcher, name)
+
+
+def _search_asins(searcher, query, k, search_filter=None):
+    # The docid of a hit is the `id` of the indexed document, i.e. the ASIN
+    # (see `convert_product_file_format.py`), so no stored document is read
+    if search_filter is None:
+        return [hit.docid for hit in searcher.search(query, k=k)]
+    if not isinstance(searcher, FieldSearcher):
+        raise ValueError(
+            'Filtered searches need the fields of the products (see `FieldSearcher`).'
+        )
+    return [hit.docid for hit in searcher.search(query, k=k, search_filter=search_filter)]
+
+
+def _batch_search(searcher, queries, qids, k, threads):
+    """`batch_search` of `searcher`, or its searches one by one if it has none"""
+    if hasattr(searcher, 'batch_search'):
+        return dict(searcher.batch_search(queries, qids, k=k, threads=threads))
+    return {qid: searcher.search(query, k=k) for query, qid in zip(queries, qids)}
+
+
+def _batch_search_asins(searcher, queries, k, threads):
+    qids = [str(i) for i in range(len(queries))]
+    results = _batch_search(searcher, queries, qids, k, threads)
+    return [[hit.docid for hit in results.get(qid, [])] for qid in qids]
+
+
+class CachedSearcher:
+    """
+    Search backend (see `SearchBackend`) with an LRU cache of the ranked ASINs
+    of each query. Other attributes are those of the wrapped searcher.
+    """
+    def __init__(self, searcher, cache_size=DEFAULT_SEARCH_CACHE_SIZE):
+        self.searcher = searcher
+        self.cache = SearchCache(cache_size)
+
+    def search_asins(self, keywords, k, search_filter=None):
+        """Top `k` ASINs for `keywords`, from the cache when possible"""
+        search_filter = _get_search_filter(search_filter)
+        key = (normalize_keywords(keywords), k)
+        if search_filter is not None:
+            key += (search_filter,)
+        asins = self.cache.get(key)
+        if asins is None:
+            asins = tuple(_search_asins(self.searcher, ' '.join(keywords), k, search_filter))
+            self.cache.put(key, asins)
+        return asins
+
+    def search_asins_batch(self, keywords_list, k, threads=1):
+        """
+        Top `k` ASINs for each of `keywords_list`, in order. Keywords missing
+        from the cache are searched in one batch, once per distinct query.
+        """
+        keys = [(normalize_keywords(keywords), k) for keywords in keywords_list]
+        results = [self.cache.get(key) for key in keys]
+        misses = dict()
+        for keywords, key, asins in zip(keywords_list, keys, results):
+            if asins is None:
+                misses.setdefault(key, ' '.join(keywords))
+        if misses:
+            found = _batch_search_asins(self.searcher, list(misses.values()), k, threads)
+            found = dict(zip(misses, (tuple(asins) for asins in found)))
+            for key, asins in found.items():
+                self.cache.put(key, asins)
+            results = [found[key] if asins is None else asins for key, asins in zip(keys, results)]
+        return results
+
+    def cache_info(self):
+        return self.cache.cache_info()
+
+    def __getattr__(self, name):
+        return getattr(self.searcher, name)
+
+
+def search_asins(search_engine, keywords, k, search_filter=None):
+    """
+    Top `k` ASINs for `keywords`, through the cache of a `CachedSearcher`,
+    among the products matching `search_filter` if any (see `SearchFilter`)
+    """
+    search_filter = _get_search_filter(search_filter)
+    if isinstance(search_engine, CachedSearcher):
+        return search_engine.search_asins(keywords, k, search_filter)
+    return _search_asins(search_engine, ' '.join(keywords), k, search_filter)
+
+
+def _get_search_filter(search_filter):
+    # A filter without any constraint is no filter
+    if search_filter is None or all(value is None for value in search_filter):
+        return None
+    return search_filter
+
+
+def search_asins_batch(search_engine, keywords_list, k, threads=1):
+    """
+    Top `k` ASINs for each of `keywords_list`, in order, searched in one
+    batch (the `batch_search` of the backend, e.g. pyserini's, which runs
+    the queries on `threads` threads)
+    """
+    if isinstance(search_engine, CachedSearcher):
+        return search_engine.search_asins_batch(keywords_list, k, threads)
+    return _batch_search_asins(
+        search_engine, [' '.join(keywords) for keywords in keywords_list], k, threads
+    )
+
+
+def get_product_document(product):
+    """
+    Document indexed for a product of `load_products`: its ASIN as `id`, and
+    as `contents` its title, description, first bullet point and options,
+    lowercased
+    """
+    option_texts = []
+    options = product.get('options', {})
+    for option_name, option_contents in options.items():
+        option_contents_text = ', '.join(option_contents)
+        option_texts.append(f'{option_name}: {option_contents_text}')
+    option_text = ', and '.join(option_texts)
+    return dict(
+        id=product['asin'],
+        contents=' '.join([
+            product['Title'],
+            product['Description'],
+            product['BulletPoints'][0],
+            option_text,
+        ]).lower(),
+    )
+
+
+def get_goal_queries(goals):
+    """
+    Search queries agents derive from `goals`: each goal's product query, the
+    query prefixed with each goal attribute, and the instruction itself
+    (see `WebEnv.get_search_texts` in `baseline_models`), without duplicates
+    """
+    queries = dict()
+    for goal in goals:
+        queries[goal['query']] = None
+        for attribute in goal['attributes']:
+            queries[f'{attribute} {goal["query"]}'] = None
+        queries[goal['instruction_text'].lower()] = None
+    return list(queries)
+
+
+def warm_up_search_cache(search_engine, queries, k):
+    """
+    Fill the cache of a `CachedSearcher` with the results of `queries`, up
+    to the cache's size. Returns the number of searches run.
+    """
+    cache = search_engine.cache
+    count = 0
+    for query in queries:
+        if len(cache) >= cache.maxsize:
+            break
+        key = (normalize_keywords([query]), k)
+        if key[0] and key not in cache:
+            # Bypasses `get`, so that warming up is not counted as misses
+            cache.put(key, tuple(_search_asins(search_engine.searcher, query, k)))
+            count += 1
+    return count
@@ -0,0 +1,468 @@
+"""
+Search daemon shared by the processes of a machine.
+
+Every `SimServer`, app process and training worker otherwise opens its own
+search backend (for Lucene, a JVM each). `SearchServer` opens an index once
+and answers the searches of all of them over a Unix socket; `SearchClient`
+is the search backend (see `search.SearchBackend`) of these processes, and
+keeps a pool of open connections to the server.
+
+Messages, both ways, are frames: a 4-byte length (big endian) and a body.
+A request body starts with its type:
+
+    SEARCH: k (4 bytes), number of queries (4 bytes), then for each query its
+            length (4 bytes) and UTF-8 text
+    INFO:   nothing else
+
+and a response body with a status byte (OK, or ERROR followed by a UTF-8
+message). The body of an OK response to SEARCH is, for each query, its
+number of hits (4 bytes) and for each hit the length of its docid (2 bytes),
+the UTF-8 docid and its score (float32); to INFO, a JSON object describing
+the index (backend, num_products, num_docs).
+
+The server runs searches on a single thread. The queries of all requests
+received together are searched as one batch (`batch_search`, when the
+backend has it, runs them on several threads), so clients that send many
+queries at once, or many clients at once, are served in fewer round trips.
+Sockets are never blocked on: responses a client does not take at once are
+buffered and written as it reads them, so a slow client delays no other.
+
+Start a server with:
+
+    python -m web_agent_site.engine.search_server --backend bm25 --num_products 1000
+"""
+import json
+import os
+import queue
+import selectors
+import socket
+import struct
+import tempfile
+import threading
+from collections import defaultdict
+
+from web_agent_site.engine.search import SearchBackend, SearchHit
+
+DEFAULT_SEARCH_SOCKET = os.path.join(tempfile.gettempdir(), 'webshop_search.sock')
+DEFAULT_POOL_SIZE = 8
+
+# Largest frame either side accepts
+MAX_FRAME_SIZE = 1 << 28
+
+SEARCH = 1
+INFO = 2
+
+OK = 0
+ERROR = 1
+
+_FRAME = struct.Struct('!I')
+_SEARCH = struct.Struct('!BII')
+_COUNT = struct.Struct('!I')
+_DOCID = struct.Struct('!H')
+_SCORE = struct.Struct('!f')
+
+
+def encode_frame(body):
+    return _FRAME.pack(len(body)) + body
+
+
+def recv_frame(sock):
+    """Body of the next frame from `sock`. Raises ConnectionError if it is closed."""
+    size = _FRAME.unpack(_recv_exactly(sock, _FRAME.size))[0]
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f'Frame of {size} bytes exceeds the limit of {MAX_FRAME_SIZE}.')
+    return _recv_exactly(sock, size)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('Search server connection closed.')
+        received += n
+    return bytes(data)
+
+
+def encode_search_request(queries, k):
+    parts = [_SEARCH.pack(SEARCH, k, len(queries))]
+    for query in queries:
+        text = query.encode('utf-8')
+        parts.append(_COUNT.pack(len(text)))
+        parts.append(text)
+    return b''.join(parts)
+
+
+def decode_search_request(body):
+    """`(queries, k)` of the body of a SEARCH request"""
+    _, k, num_queries = _SEARCH.unpack_from(body)
+    offset = _SEARCH.size
+    queries = []
+    for _ in range(num_queries):
+        size = _COUNT.unpack_from(body, offset)[0]
+        offset += _COUNT.size
+        queries.append(body[offset:offset + size].decode('utf-8'))
+        offset += size
+    return queries, k
+
+
+def encode_search_response(results):
+    parts = [bytes([OK])]
+    for hits in results:
+        parts.append(_COUNT.pack(len(hits)))
+        for hit in hits:
+            docid = hit.docid.encode('utf-8')
+            parts.append(_DOCID.pack(len(docid)))
+            parts.append(docid)
+            parts.append(_SCORE.pack(hit.score))
+    return b''.join(parts)
+
+
+def decode_search_response(body, num_queries):
+    """Hits (`search.SearchHit`s) of each query, from the body of an OK response"""
+    offset = 1
+    results = []
+    for _ in range(num_queries):
+        num_hits = _COUNT.unpack_from(body, offset)[0]
+        offset += _COUNT.size
+        hits = []
+        for _ in range(num_hits):
+            size = _DOCID.unpack_from(body, offset)[0]
+            offset += _DOCID.size
+            docid = body[offset:offset + size].decode('utf-8')
+            offset += size
+            hits.append(SearchHit(docid, _SCORE.unpack_from(body, offset)[0]))
+            offset += _SCORE.size
+        results.append(hits)
+    return results
+
+
+def encode_error(message):
+    return bytes([ERROR]) + str(message).encode('utf-8')
+
+
+def check_response(body):
+    if body[0] == ERROR:
+        raise RuntimeError(f'Search server error: {body[1:].decode("utf-8")}')
+
+
+class SearchServer:
+    """
+    Serves the searches of `searcher` on the Unix socket at `path`. `info`
+    describes the index to clients (see `SearchClient`); `threads` is passed
+    to the `batch_search` of backends that have one.
+    """
+    def __init__(self, searcher, path=DEFAULT_SEARCH_SOCKET, info=None, threads=1):
+        _remove_stale_socket(path)
+        self.searcher = searcher
+        self.path = path
+        self.info = dict(info or {})
+        self.info.setdefault('num_docs', getattr(searcher, 'num_docs', None))
+        self.threads = threads
+        self._closed = False
+        # Bytes received and not yet parsed, and bytes to send, of each connection
+        self._buffers = dict()
+        self._outgoing = dict()
+        self._selector = selectors.DefaultSelector()
+        self._stopped = threading.Event()
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen(128)
+        self._socket.setblocking(False)
+        self._selector.register(self._socket, selectors.EVENT_READ)
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            while not self._stopped.is_set():
+                requests = []
+                for key, events in self._selector.select(poll_interval):
+                    if key.fileobj is self._socket:
+                        self._accept()
+                        continue
+                    if events & selectors.EVENT_WRITE:
+                        self._flush(key.fileobj)
+                    if events & selectors.EVENT_READ and key.fileobj in self._buffers:
+                        requests.extend(self._read(key.fileobj))
+                if requests:
+                    self.handle(requests)
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """Stop `serve_forever` (from another thread), within its `poll_interval`"""
+        self._stopped.set()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for conn in list(self._buffers):
+            self._disconnect(conn)
+        self._selector.unregister(self._socket)
+        self._selector.close()
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        try:
+            conn, _ = self._socket.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self._buffers[conn] = bytearray()
+        self._outgoing[conn] = bytearray()
+        self._selector.register(conn, selectors.EVENT_READ)
+
+    def _disconnect(self, conn):
+        self._buffers.pop(conn, None)
+        self._outgoing.pop(conn, None)
+        self._selector.unregister(conn)
+        conn.close()
+
+    def _read(self, conn):
+        """Complete requests received on `conn`, as `(conn, body)` pairs"""
+        try:
+            data = conn.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b''
+        if not data:
+            self._disconnect(conn)
+            return []
+        buffer = self._buffers[conn]
+        buffer += data
+        requests = []
+        while len(buffer) >= _FRAME.size:
+            size = _FRAME.unpack_from(buffer)[0]
+            if size > MAX_FRAME_SIZE:
+                self._disconnect(conn)
+                return []
+            if len(buffer) < _FRAME.size + size:
+                break
+            requests.append((conn, bytes(buffer[_FRAME.size:_FRAME.size + size])))
+            del buffer[:_FRAME.size + size]
+        return requests
+
+    def handle(self, requests):
+        """Answer `(conn, body)` requests, searching the queries of those with the same `k` together"""
+        responses = dict()
+        searches = defaultdict(list)
+        for i, (_, body) in enumerate(requests):
+            try:
+                if body[0] == SEARCH:
+                    queries, k = decode_search_request(body)
+                    searches[k].append((i, queries))
+                elif body[0] == INFO:
+                    responses[i] = bytes([OK]) + json.dumps(self.info).encode('utf-8')
+                else:
+                    responses[i] = encode_error(f'Request type {body[0]} not recognized.')
+            except (IndexError, struct.error, UnicodeDecodeError) as e:
+                responses[i] = encode_error(f'Malformed request: {e}')
+
+        for k, batch in searches.items():
+            queries = [query for _, request_queries in batch for query in request_queries]
+            try:
+                results = self.batch_search(queries, k)
+            except Exception as e:
+                for i, _ in batch:
+                    responses[i] = encode_error(e)
+                continue
+            start = 0
+            for i, request_queries in batch:
+                end = start + len(request_queries)
+                responses[i] = encode_search_response(results[start:end])
+                start = end
+
+        for i, (conn, _) in enumerate(requests):
+            self._send(conn, encode_frame(responses[i]))
+
+    def batch_search(self, queries, k):
+        """Hits of each of `queries`"""
+        batch_search = getattr(self.searcher, 'batch_search', None)
+        if batch_search is None or len(queries) == 1:
+            return [self.searcher.search(query, k=k) for query in queries]
+        qids = [str(i) for i in range(len(queries))]
+        results = batch_search(queries, qids, k=k, threads=self.threads)
+        return [results.get(qid, []) for qid in qids]
+
+    def _send(self, conn, data):
+        """Queue `data` to `conn`, and write as much of it as the socket takes now"""
+        if conn not in self._outgoing:
+            return
+        outgoing = self._outgoing[conn]
+        pending = bool(outgoing)
+        outgoing += data
+        if not pending:
+            self._flush(conn)
+
+    def _flush(self, conn):
+        """Write the bytes queued to `conn`; wait for it to be writable if some are left"""
+        outgoing = self._outgoing.get(conn)
+        if outgoing is None:
+            return
+        try:
+            while outgoing:
+                sent = conn.send(outgoing)
+                del outgoing[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._disconnect(conn)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outgoing else 0)
+        if self._selector.get_key(conn).events != events:
+            self._selector.modify(conn, events)
+
+
+def _remove_stale_socket(path):
+    """Remove the socket file at `path` unless a server is listening on it"""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise ValueError(f'A search server is already listening on {path}.')
+    finally:
+        probe.close()
+
+
+class SearchClient(SearchBackend):
+    """
+    Search backend of the index served by a `SearchServer` at `path`. Idle
+    connections are kept for reuse, up to `pool_size`; a request on a
+    connection the server has closed (e.g. after a restart) is retried once
+    on a new one. Safe to share between threads.
+
+    `backend`, `num_products` and `num_docs` describe the served index.
+    """
+    def __init__(self, path=DEFAULT_SEARCH_SOCKET, pool_size=DEFAULT_POOL_SIZE, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        info = self.get_info()
+        self.backend = info.get('backend')
+        self.num_products = info.get('num_products')
+        self.num_docs = info.get('num_docs')
+
+    def get_info(self):
+        body = self._request(bytes([INFO]))
+        return json.loads(body[1:].decode('utf-8'))
+
+    def search(self, query, k=10):
+        return self._search([query], k)[0]
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        """Hits of each of `queries` by qid, searched in one request (as pyserini's `batch_search`)"""
+        return dict(zip(qids, self._search(list(queries), k)))
+
+    def _search(self, queries, k):
+        if not queries:
+            return []
+        body = self._request(encode_search_request(queries, k))
+        return decode_search_response(body, len(queries))
+
+    def _request(self, body):
+        frame = encode_frame(body)
+        for attempt in range(2):
+            conn, pooled = self._acquire()
+            try:
+                conn.sendall(frame)
+                response = recv_frame(conn)
+            except ConnectionError:
+                conn.close()
+                if pooled and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            self._release(conn)
+            check_response(response)
+            return response
+
+    def _acquire(self):
+        """An open connection, and whether it was pooled"""
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            pass
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        try:
+            conn.connect(self.path)
+        except OSError:
+            conn.close()
+            raise
+        return conn, False
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __getstate__(self):
+        # Connections are not inherited by other processes
+        state = self.__dict__.copy()
+        state['_pool'] = self._pool.maxsize
+        return state
+
+    def __setstate__(self, state):
+        state['_pool'] = queue.LifoQueue(maxsize=state['_pool'])
+        self.__dict__.update(state)
+
+
+def main():
+    import argparse
+    import signal
+
+    from web_agent_site.engine.engine import INDEX_SIZES, open_search_index
+    from web_agent_site.engine.search import DEFAULT_SEARCH_BACKEND, SEARCH_BACKENDS
+
+    def num_products_type(value):
+        return None if value == 'all' else int(value)
+
+    parser = argparse.ArgumentParser(description='Serve searches of a product index over a Unix socket')
+    parser.add_argument('--socket', default=DEFAULT_SEARCH_SOCKET, help='Path of the Unix socket')
+    parser.add_argument('--backend', choices=SEARCH_BACKENDS, default=DEFAULT_SEARCH_BACKEND)
+    parser.add_argument('--num_products', type=num_products_type, default=None,
+                        help=f'Catalog size of the index: {", ".join(str(n) for n in INDEX_SIZES if n)} or all')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads of batched searches (default: one per CPU for lucene, 1 for other backends)')
+    args = parser.parse_args()
+    if args.threads is None:
+        # In-process backends mostly run Python code, which does not search faster on more threads
+        args.threads = (os.cpu_count() or 1) if args.backend == 'lucene' else 1
+
+    server = SearchServer(
+        open_search_index(args.num_products, args.backend),
+        args.socket,
+        info=dict(backend=args.backend, num_products=args.num_products),
+        threads=args.threads,
+    )
+    # Remove the socket on `kill` too
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    print(f'Serving the {args.backend} index of {args.num_products or "all"} products on {args.socket}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
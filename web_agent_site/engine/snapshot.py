@@ -0,0 +1,179 @@
+"""
+Binary snapshots of the product catalog built by `engine.load_products`.
+
+Building the catalog from the scraped JSON files (parsing, price and option
+normalization, key cleaning) takes a while on the full catalog. A snapshot
+stores its result once, so that later loads skip all of it:
+
+    <snapshot>/products.pkl      -- all products (`Product` records) and attribute_to_asins
+    <snapshot>/price_ranges.npy  -- (low, high) price of every product, memory-mapped on load
+    <snapshot>/meta.json         -- format version and the source files it was built from
+    <snapshot>/name_nouns.pkl    -- nouns of product and goal names (see `goal.NounCache`),
+                                    written by the first `SimServer` or app loading the catalog
+
+A snapshot is only used while it is fresh, i.e. its format version and the
+size and modification time of every source file match. Snapshots are pickles;
+only load snapshots you built yourself.
+
+Build (and time) a snapshot with:
+
+    python -m web_agent_site.engine.snapshot [--file_path ...] [--num_products ...] [--human_goals]
+"""
+import gc
+import json
+import os
+import pickle
+import random
+from os.path import abspath, basename, join, splitext
+
+import numpy as np
+
+from web_agent_site.utils import BASE_DIR
+
+SNAPSHOT_VERSION = 2
+DEFAULT_SNAPSHOT_DIR = join(BASE_DIR, '../data/snapshots')
+
+
+def get_snapshot_path(filepath, num_products=None, human_goals=True, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """Directory of the snapshot for the catalog loaded with these arguments"""
+    name = splitext(basename(filepath))[0]
+    num_products = 'all' if num_products is None else num_products
+    goals = 'human' if human_goals else 'synthetic'
+    return join(snapshot_dir, f'{name}-{num_products}-{goals}')
+
+
+def get_name_nouns_path(filepath, num_products=None, human_goals=True, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    File caching the nouns of product and goal names of a catalog (see
+    `goal.precompute_name_nouns`), or None if the catalog has no snapshot
+    """
+    path = get_snapshot_path(filepath, num_products, human_goals, snapshot_dir)
+    return join(path, 'name_nouns.pkl') if os.path.isdir(path) else None
+
+
+def _get_meta(source_paths, num_products, human_goals):
+    sources = []
+    for path in source_paths:
+        stat = os.stat(path)
+        sources.append(dict(path=abspath(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns))
+    return dict(
+        version=SNAPSHOT_VERSION,
+        num_products=num_products,
+        human_goals=bool(human_goals),
+        sources=sources,
+    )
+
+
+def is_snapshot_fresh(path, source_paths, num_products=None, human_goals=True):
+    """Whether the snapshot at `path` exists and was built from the current `source_paths`"""
+    try:
+        with open(join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return meta == _get_meta(source_paths, num_products, human_goals)
+    except (OSError, ValueError):
+        return False
+
+
+def get_price_ranges(all_products):
+    """
+    (low, high) price range of every product as a float array, with `high`
+    set to NaN for products with a single price
+    """
+    price_ranges = np.full((len(all_products), 2), np.nan)
+    for i, product in enumerate(all_products):
+        pricing = product['pricing']
+        if not pricing:
+            price_ranges[i, 0] = 100.0
+        else:
+            price_ranges[i, :len(pricing[:2])] = pricing[:2]
+    return price_ranges
+
+
+def generate_product_prices_from_ranges(all_products, price_ranges):
+    """
+    Same as `engine.generate_product_prices`, from precomputed price ranges.
+
+    Draws from `random` exactly as `generate_product_prices` does (one
+    `random.uniform` per product with a price range, in catalog order), so
+    both produce the same prices and leave `random` in the same state.
+    """
+    low, high = price_ranges[:, 0], price_ranges[:, 1]
+    is_range = ~np.isnan(high)
+    # `random.uniform(a, b)` is `a + (b - a) * random.random()`
+    draws = np.array([random.random() for _ in range(int(is_range.sum()))])
+    prices = np.array(low)
+    prices[is_range] = low[is_range] + (high[is_range] - low[is_range]) * draws
+    return dict(zip((p['asin'] for p in all_products), prices.tolist()))
+
+
+def write_snapshot(path, all_products, attribute_to_asins, source_paths, num_products=None, human_goals=True):
+    """Write a snapshot of a catalog built from `source_paths` to `path`"""
+    os.makedirs(path, exist_ok=True)
+    # `meta.json` is written last, so an interrupted write leaves a stale snapshot
+    meta_path = join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    with open(join(path, 'products.pkl'), 'wb') as f:
+        pickle.dump((all_products, attribute_to_asins), f, protocol=pickle.HIGHEST_PROTOCOL)
+    np.save(join(path, 'price_ranges.npy'), get_price_ranges(all_products))
+    with open(meta_path, 'w') as f:
+        json.dump(_get_meta(source_paths, num_products, human_goals), f, indent=2)
+
+
+def read_snapshot(path):
+    """Returns all products, attribute_to_asins and the (memory-mapped) price ranges of a snapshot"""
+    # Unpickling allocates millions of containers, none of them garbage;
+    # pausing the collector avoids repeatedly scanning them while they are created
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(join(path, 'products.pkl'), 'rb') as f:
+            all_products, attribute_to_asins = pickle.load(f)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    price_ranges = np.load(join(path, 'price_ranges.npy'), mmap_mode='r')
+    return all_products, attribute_to_asins, price_ranges
+
+
+def main():
+    import argparse
+    import time
+    from web_agent_site.engine import engine
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Build a binary snapshot of the product catalog')
+    parser.add_argument('--file_path', default=DEFAULT_FILE_PATH)
+    parser.add_argument('--num_products', type=int, default=None)
+    parser.add_argument('--human_goals', action='store_true')
+    parser.add_argument('--snapshot_dir', default=DEFAULT_SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    old_time = time.time()
+    all_products, _, _, attribute_to_asins = engine.load_products(
+        args.file_path, args.num_products, args.human_goals, use_snapshot=False
+    )
+    json_time = time.time() - old_time
+
+    path = get_snapshot_path(args.file_path, args.num_products, args.human_goals, args.snapshot_dir)
+    write_snapshot(
+        path,
+        all_products,
+        attribute_to_asins,
+        engine.get_source_paths(args.file_path),
+        args.num_products,
+        args.human_goals,
+    )
+    del all_products, attribute_to_asins
+
+    old_time = time.time()
+    engine.load_products(
+        args.file_path, args.num_products, args.human_goals, snapshot_dir=args.snapshot_dir
+    )
+    snapshot_time = time.time() - old_time
+    print(f'Snapshot written to {path}')
+    print(f'Startup time from JSON: {json_time:.2f}s, from snapshot: {snapshot_time:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Registry of compiled Jinja templates for each WebShop theme.
+"""
+import os
+import time
+from collections import defaultdict
+
+from jinja2 import Environment, FileSystemLoader
+
+from web_agent_site.utils import BASE_DIR
+
+
+def is_dev_mode():
+    """Templates are checked for changes on disk only when running in dev mode"""
+    return os.environ.get('FLASK_ENV') == 'development'
+
+
+def _flask_url_for(endpoint, **values):
+    """Resolve URLs through the active Flask app (requires an app/request context)"""
+    from flask import url_for
+    return url_for(endpoint, **values)
+
+
+class TemplateRegistry:
+    """
+    Loads and compiles the templates of a single theme once, keyed by page name.
+
+    `url_for` is exposed to the templates as a global; it defaults to Flask's,
+    which needs an active app/request context. Renderers outside of Flask
+    (i.e. `SimServer`) pass a standalone URL builder instead.
+    """
+    def __init__(self, theme, auto_reload=None, url_for=None):
+        self.theme = theme
+        self.template_dir = os.path.join(BASE_DIR, 'themes', theme, 'templates')
+        self.auto_reload = is_dev_mode() if auto_reload is None else auto_reload
+        # `cache_size=-1` keeps every compiled template; with `auto_reload`,
+        # Jinja compares the file's mtime on lookup and recompiles on change
+        self.env = Environment(
+            loader=FileSystemLoader(self.template_dir),
+            autoescape=True,
+            auto_reload=self.auto_reload,
+            cache_size=-1,
+        )
+        self.env.globals['url_for'] = _flask_url_for if url_for is None else url_for
+        self.render_count = defaultdict(int)
+        self.render_time = defaultdict(float)
+
+    def get_template(self, name):
+        """Return the compiled template `name` (e.g. 'item_page.html')"""
+        return self.env.get_template(name)
+
+    def render(self, name, **context):
+        """Render template `name` with `context` and record how long it took"""
+        old_time = time.perf_counter()
+        html = self.get_template(name).render(**context)
+        self.render_time[name] += time.perf_counter() - old_time
+        self.render_count[name] += 1
+        return html
+
+    def reset_stats(self):
+        self.render_count.clear()
+        self.render_time.clear()
+
+
+_registries = dict()
+
+
+def get_template_registry(theme, url_for=None):
+    """Return the (shared) template registry for `theme` and `url_for`, creating it on first use"""
+    key = (theme, url_for)
+    registry = _registries.get(key)
+    if registry is None:
+        registry = _registries[key] = TemplateRegistry(theme, url_for=url_for)
+    return registry
+
+
+def get_render_stats():
+    """Render count, total and mean latency (seconds) per (theme, template name)"""
+    stats = dict()
+    for registry in _registries.values():
+        for name, count in registry.render_count.items():
+            total = registry.render_time[name]
+            key = (registry.theme, name)
+            if key in stats:
+                count += stats[key]['count']
+                total += stats[key]['total_time']
+            stats[key] = dict(
+                count=count,
+                total_time=total,
+                mean_time=total / count,
+            )
+    return stats
+
+
+def reset_render_stats():
+    for registry in _registries.values():
+        registry.reset_stats()
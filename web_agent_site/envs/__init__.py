@@ -2,6 +2,10 @@ from gym.envs.registration import register
 
 from web_agent_site.envs.web_agent_site_env import WebAgentSiteEnv
 from web_agent_site.envs.web_agent_text_env import WebAgentTextEnv
+from web_agent_site.envs.web_agent_text_vec_env import (
+  WebAgentTextVecEnv,
+  WebAgentTextSubprocVecEnv,
+)
 
 register(
   id='WebAgentSiteEnv-v0',
@@ -0,0 +1,187 @@
+"""
+Structured (HTML-free) page models for the text environment.
+
+`map_action_to_page` is a drop-in replacement for `map_action_to_html` that
+builds, straight from the values a page would be rendered with, what the
+text environment would otherwise recover by parsing the page's HTML: the
+visible texts (with the tag they sit in), the clickables, the search bar,
+the instruction and the product image. It mirrors the `classic` theme
+templates, so observations and available actions are identical to parsing
+the rendered pages.
+
+Pages whose content cannot be reproduced faithfully without a parser are
+still rendered as HTML (a string is returned instead of a page model): the
+done page, and features pages whose bullet points (rendered with `| safe`)
+contain markup or character references.
+"""
+from collections import namedtuple
+
+from web_agent_site.engine.engine import (
+    map_action_to_html,
+    parse_action,
+    ACTION_TO_TEMPLATE,
+    END_BUTTON,
+)
+
+STRUCTURED_THEMES = ('classic',)
+
+# Whitespace that BeautifulSoup collapses when a string contains nothing else
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+# A visible string of a page, with the name and `class` of its parent tag
+VisibleText = namedtuple('VisibleText', ['text', 'tag', 'cls'])
+
+BUTTON = {'class': ['btn']}
+PRODUCT_LINK = {'class': ['product-link']}
+
+
+class StructuredPage:
+    """Page model with the same fields as a parsed HTML page, built without HTML"""
+    html = None
+
+    def __init__(
+            self,
+            visible_texts,
+            text_to_clickable,
+            has_search_bar=False,
+            instruction_text=None,
+            image_url=None,
+        ):
+        self.visible_texts = visible_texts
+        self.text_to_clickable = text_to_clickable
+        self.has_search_bar = has_search_bar
+        self.instruction_text = instruction_text
+        self.image_url = image_url
+
+
+class _PageBuilder:
+    """Collects visible texts and clickables in document order"""
+    def __init__(self):
+        self.visible_texts = []
+        self.text_to_clickable = dict()
+
+    def text(self, text, tag, cls=None):
+        """Add the string between two tags, as BeautifulSoup would store it"""
+        if text == '':
+            return
+        if all(c in ASCII_SPACES for c in text):
+            text = '\n' if '\n' in text else ' '
+        self.visible_texts.append(VisibleText(text, tag, cls))
+
+    def button(self, text):
+        self.text(text, 'button')
+        self.text_to_clickable[text.lower()] = BUTTON
+
+    def build(self, **kwargs):
+        return StructuredPage(
+            self.visible_texts, self.text_to_clickable, **kwargs
+        )
+
+
+def _field(obj, key):
+    """String a template renders for `obj.key` (missing fields render empty)"""
+    return str(obj[key]) if key in obj else ''
+
+
+def _search_page():
+    page = _PageBuilder()
+    page.text('WebShop', 'h2')
+    page.button('Search')
+    return page.build()
+
+
+def _results_page(products, page_num, total):
+    page = _PageBuilder()
+    page.button('Back to Search')
+    page.text(f'Page {page_num} (Total results: {total})', 'h3')
+    if page_num > 1:
+        page.button('< Prev')
+    page.button('Next >')
+    for item in products:
+        asin = _field(item, 'asin')
+        page.text(asin, 'a', ['product-link'])
+        page.text(_field(item, 'Title'), 'h4', ['mt-0', 'font-weight-bold', 'mb-2', 'product-title'])
+        page.text(_field(item, 'Price'), 'h5', ['font-weight-bold', 'my-2', 'product-price'])
+    # Product links come after the buttons in the list of clickables
+    for item in products:
+        page.text_to_clickable[_field(item, 'asin').lower()] = PRODUCT_LINK
+    return page.build()
+
+
+def _item_page(product_info, show_attrs):
+    page = _PageBuilder()
+    page.button('Back to Search')
+    page.button('< Prev')
+    radios = []
+    for option_name, option_contents in product_info['options'].items():
+        option_name = str(option_name)
+        page.text(option_name, 'h4')
+        for option_content in option_contents:
+            option_content = str(option_content)
+            page.text(option_content, 'label')
+            radios.append((option_content, {'name': option_name}))
+    page.text(_field(product_info, 'Title'), 'h2')
+    page.text(f"Price: {_field(product_info, 'Price')}", 'h4')
+    page.text(f"Rating: {_field(product_info, 'Rating')}", 'h4')
+    page.button('Description')
+    page.button('Features')
+    page.button('Reviews')
+    if show_attrs:
+        page.button('Attributes')
+    page.button('Buy Now')
+    # Options come after the buttons in the list of clickables
+    for option_content, radio in radios:
+        page.text_to_clickable[option_content] = radio
+    return page.build(image_url=_field(product_info, 'MainImage'))
+
+
+def _sub_page(sub_page, product_info):
+    page = _PageBuilder()
+    page.button('Back to Search')
+    page.button('< Prev')
+    if sub_page == 'Description':
+        page.text(_field(product_info, 'Description'), 'p', ['product-info'])
+    elif sub_page == 'Features':
+        for bulletpoint in product_info['BulletPoints']:
+            bulletpoint = str(bulletpoint)
+            if '<' in bulletpoint or '&' in bulletpoint:
+                return None
+            page.text(bulletpoint, 'p', ['product-info'])
+    elif sub_page == 'Reviews':
+        for review in product_info['Reviews']:
+            title = _field(review, 'title')
+            page.text(f'"{title}"', 'h4', ['blue-text', 'mt-3'])
+            page.text(_field(review, 'score'), 'span')
+            page.text(_field(review, 'body'), 'p', ['content'])
+    elif sub_page == 'Attributes':
+        for attribute in product_info['Attributes']:
+            page.text(f' {str(attribute)}', 'p', ['attribute'])
+        page.text(_field(product_info, 'category'), 'h5', ['font-weight-bold', 'my-2', 'product-category'])
+        page.text(_field(product_info, 'query'), 'h5', ['font-weight-bold', 'my-2', 'product-query'])
+        page.text(_field(product_info, 'product_category'), 'h5', ['font-weight-bold', 'my-2', 'product-product_category'])
+    return page.build()
+
+
+def map_action_to_page(action, url_for=None, **kwargs):
+    """
+    Build the page model reached by `action` without rendering HTML.
+
+    Takes the same arguments as `map_action_to_html`, and falls back to it
+    (returning an HTML string) for pages that are not built structurally.
+    """
+    action_name, action_arg = parse_action(action)
+    if action_name == 'start':
+        page = _search_page()
+    elif action_name == 'search':
+        page = _results_page(kwargs['products'], kwargs['page'], kwargs['total'])
+    elif action_name == 'click' and action_arg == END_BUTTON:
+        page = None
+    elif action_name == 'click' and action_arg in ACTION_TO_TEMPLATE:
+        page = _sub_page(action_arg, kwargs['product_info'])
+    elif action_name == 'click':
+        page = _item_page(kwargs['product_info'], kwargs['show_attrs'])
+    else:
+        raise ValueError('Action name not recognized.')
+    if page is None:
+        return map_action_to_html(action, url_for=url_for, **kwargs)
+    return page
@@ -3,25 +3,44 @@ import json
 import random
 import string
 import time
-import torch
 
 import numpy as np
 
 from bs4 import BeautifulSoup
 from bs4.element import Comment
-from collections import defaultdict
-from flask import Flask
+from collections import defaultdict, namedtuple
+from werkzeug.routing import Map, Rule
 from web_agent_site.engine.engine import (
     load_products,
     init_search_engine,
+    build_document_fields,
+    build_product_index,
     get_top_n_product_from_keywords,
+    get_top_n_product_from_keywords_batch,
     map_action_to_html,
     parse_action,
     get_product_per_page,
+    get_session_search_results,
+    get_theme,
     ACTION_TO_TEMPLATE,
+    INDEX_SIZES,
+    SEARCH_RETURN_N,
     END_BUTTON, NEXT_PAGE, PREV_PAGE, BACK_TO_SEARCH,
 )
-from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.goal import get_reward, get_goals, precompute_name_nouns
+from web_agent_site.engine.search import (
+    DEFAULT_SEARCH_BACKEND,
+    DEFAULT_SEARCH_CACHE_SIZE,
+    get_goal_queries,
+    warm_up_search_cache as fill_search_cache,
+)
+from web_agent_site.engine.snapshot import get_name_nouns_path
+from web_agent_site.envs.structured_pages import (
+    StructuredPage,
+    VisibleText,
+    map_action_to_page,
+    STRUCTURED_THEMES,
+)
 from web_agent_site.utils import (
     DEFAULT_FILE_PATH,
     FEAT_CONV,
@@ -29,7 +48,6 @@ from web_agent_site.utils import (
     random_idx
 )
 
-app = Flask(__name__)
 class WebAgentTextEnv(gym.Env):
     """Gym environment for Text mode of WebShop environment"""
     def __init__(
@@ -43,7 +61,12 @@ class WebAgentTextEnv(gym.Env):
         Constructor for text environment
 
         Arguments:
-        observation_mode (`str`) -- ['html' | 'text'] (default 'html')
+        observation_mode (`str`) -- ['html' | 'text' | 'text_rich' | 'url'] (default 'html')
+        observation_backend (`str`) -- ['html' | 'structured'] (default 'html'),
+            see `SimServer`; ignored if `server` is given
+        search_cache_size, warm_up_search_cache, search_backend, asins, search_socket,
+            search_threads, search_filters -- see
+            `SimServer`; ignored if `server` is given
         get_image
         filter_goals
         limit_goals
@@ -68,12 +91,28 @@ class WebAgentTextEnv(gym.Env):
             self.kwargs.get('num_products'),
             self.kwargs.get('human_goals'),
             self.kwargs.get('show_attrs', False),
+            self.kwargs.get('observation_backend', 'html'),
+            search_cache_size=self.kwargs.get('search_cache_size', DEFAULT_SEARCH_CACHE_SIZE),
+            warm_up_search_cache=self.kwargs.get('warm_up_search_cache', False),
+            search_backend=self.kwargs.get('search_backend', DEFAULT_SEARCH_BACKEND),
+            asins=self.kwargs.get('asins'),
+            search_socket=self.kwargs.get('search_socket'),
+            search_threads=self.kwargs.get('search_threads', 1),
+            search_filters=self.kwargs.get('search_filters', False),
         ) if server is None else server
+        if (self.server.observation_backend == 'structured' and
+            self.observation_mode == 'html'):
+            raise ValueError(
+                'Observation mode html requires the html observation backend.'
+            )
         self.browser = SimBrowser(self.server)
+        self._page = None
 
         self.session = self.kwargs.get('session')
         self.session_prefix = self.kwargs.get('session_prefix')
         if self.kwargs.get('get_image', 0):
+            # Imported here, as only image features need torch
+            import torch
             self.feats = torch.load(FEAT_CONV)
             self.ids = torch.load(FEAT_IDS)
             self.ids = {url: idx for idx, url in enumerate(self.ids)}
@@ -126,33 +165,18 @@ class WebAgentTextEnv(gym.Env):
 
     def get_available_actions(self):
         """Returns list of available actions at the current step"""
-        html_obj = self._parse_html()
-
-        # Collect search bar, buttons, links, and options as clickables
-        search_bar = html_obj.find(id='search_input')
-        has_search_bar = True if search_bar is not None else False
-        buttons = html_obj.find_all(class_='btn')
-        product_links  = html_obj.find_all(class_='product-link')
-        buying_options = html_obj.select('input[type="radio"]')
-
-        self.text_to_clickable = {
-            f'{b.get_text()}'.lower(): b
-            for b in buttons + product_links
-        }
-        for opt in buying_options:
-            opt_value = opt.get('value')
-            self.text_to_clickable[f'{opt_value}'] = opt
+        page = self._get_page()
+        self.text_to_clickable = page.text_to_clickable
         return dict(
-            has_search_bar=has_search_bar,
+            has_search_bar=page.has_search_bar,
             clickables=list(self.text_to_clickable.keys()),
         )
     
     def get_image(self):
         """Scrape image from page HTML and return as a list of pixel values"""
-        html_obj = self._parse_html(self.browser.page_source)
-        image_url = html_obj.find(id='product-image')
+        import torch
+        image_url = self._get_page().image_url
         if image_url is not None:
-            image_url = image_url['src']
             if image_url in self.ids:
                 image_idx = self.ids[image_url]
                 image = self.feats[image_idx]
@@ -161,9 +185,23 @@ class WebAgentTextEnv(gym.Env):
 
     def get_instruction_text(self):
         """Get corresponding instruction text for current environment session"""
-        html_obj = self._parse_html(self.browser.page_source)
-        instruction_text = html_obj.find(id='instruction-text').h4.text
-        return instruction_text
+        return self._get_page().instruction_text
+
+    def _get_page(self, html=None):
+        """
+        Returns the parsed model of a page, parsing it only when it changes
+
+        Arguments:
+        html (`str`): If no html is provided, use the current page source.
+            Structured pages (see `structured_pages`) are returned as is.
+        """
+        if html is None:
+            html = self.browser.page_source
+        if isinstance(html, StructuredPage):
+            return html
+        if self._page is None or self._page.html != html:
+            self._page = ParsedPage(html)
+        return self._page
 
     def _parse_html(self, html=None):
         """
@@ -173,10 +211,7 @@ class WebAgentTextEnv(gym.Env):
         url (`str`): If no url or html is provided, use the current
             observation (HTML) for parsing.
         """
-        if html is None:
-            html = self.state['html']
-        html_obj = BeautifulSoup(html, 'html.parser')
-        return html_obj
+        return self._get_page(html).soup
     
     @property
     def observation(self):
@@ -209,33 +244,15 @@ class WebAgentTextEnv(gym.Env):
     
     def convert_html_to_text(self, html, simple=False):
         """Strip HTML of tags and add separators to convert observation into simple mode"""
-        texts = self._parse_html(html).findAll(text=True)
-        visible_texts = filter(tag_visible, texts)
+        visible_texts = self._get_page(html).visible_texts
         if simple:
-            # For `simple` mode, return just [SEP] separators
-            return ' [SEP] '.join(t.strip() for t in visible_texts if t != '\n')
-        else:
-            # Otherwise, return an observation with tags mapped to specific, unique separators
-            observation = ''
-            for t in visible_texts:
-                if t == '\n': continue
-                if t.parent.name == 'button':  # button
-                    processed_t = f'[button] {t} [button_]'
-                elif t.parent.name == 'label':  # options
-                    if f'"{t}"' in self.state['url']:
-                        processed_t = f'  [clicked button] {t} [clicked button_]'
-                        observation = f'You have clicked {t}.\n' + observation
-                    else:
-                        processed_t = f'  [button] {t} [button_]'
-                elif t.parent.get('class') == ["product-link"]: # product asins
-                    if f'{t}' in self.server.user_sessions[self.session]['asins']:
-                        processed_t = f'\n[clicked button] {t} [clicked button_]'
-                    else:
-                        processed_t = f'\n[button] {t} [button_]'
-                else: # regular, unclickable text
-                    processed_t =  str(t)
-                observation += processed_t + '\n'
-            return observation
+            return convert_visible_texts_to_text(visible_texts, simple=True)
+        return convert_visible_texts_to_text(
+            visible_texts,
+            simple=False,
+            url=self.state['url'],
+            clicked_asins=self.server.user_sessions[self.session]['asins'],
+        )
     
     def reset(self, session=None, instruction_text=None):
         """Create a new session and reset environment variables"""
@@ -273,6 +290,113 @@ def tag_visible(element):
     )
 
 
+def convert_visible_texts_to_text(visible_texts, simple=False, url='', clicked_asins=()):
+    """Join the visible texts of a page into a `text` (simple) or `text_rich` observation"""
+    if simple:
+        # For `simple` mode, return just [SEP] separators
+        return ' [SEP] '.join(t.strip() for t, _, _ in visible_texts if t != '\n')
+    else:
+        # Otherwise, return an observation with tags mapped to specific, unique separators
+        observation = ''
+        for t, tag, cls in visible_texts:
+            if t == '\n': continue
+            if tag == 'button':  # button
+                processed_t = f'[button] {t} [button_]'
+            elif tag == 'label':  # options
+                if f'"{t}"' in url:
+                    processed_t = f'  [clicked button] {t} [clicked button_]'
+                    observation = f'You have clicked {t}.\n' + observation
+                else:
+                    processed_t = f'  [button] {t} [button_]'
+            elif cls == ["product-link"]: # product asins
+                if f'{t}' in clicked_asins:
+                    processed_t = f'\n[clicked button] {t} [clicked button_]'
+                else:
+                    processed_t = f'\n[button] {t} [button_]'
+            else: # regular, unclickable text
+                processed_t =  str(t)
+            observation += processed_t + '\n'
+        return observation
+
+
+class ParsedPage:
+    """Everything the text environment reads from one HTML page, parsed once"""
+    def __init__(self, html):
+        self.html = html
+        self.soup = BeautifulSoup(html, 'html.parser')
+
+        # Collect search bar, buttons, links, and options as clickables
+        self.has_search_bar = self.soup.find(id='search_input') is not None
+        buttons = self.soup.find_all(class_='btn')
+        product_links = self.soup.find_all(class_='product-link')
+        buying_options = self.soup.select('input[type="radio"]')
+        self.text_to_clickable = {
+            f'{b.get_text()}'.lower(): b
+            for b in buttons + product_links
+        }
+        for opt in buying_options:
+            opt_value = opt.get('value')
+            self.text_to_clickable[f'{opt_value}'] = opt
+
+        self.visible_texts = [
+            VisibleText(str(t), t.parent.name, t.parent.get('class'))
+            for t in self.soup.find_all(string=True) if tag_visible(t)
+        ]
+
+        instruction = self.soup.find(id='instruction-text')
+        self.instruction_text = \
+            instruction.h4.text if instruction is not None else None
+        image = self.soup.find(id='product-image')
+        self.image_url = image['src'] if image is not None else None
+
+
+# URL rules of the pages `SimServer` stands in for. Every page is served from
+# '/', so links only carry their values as a query string.
+SIM_URL_ADAPTER = Map(
+    [
+        Rule('/', endpoint=endpoint)
+        for endpoint in ('index', 'search_results', 'item_page', 'item_sub_page', 'done')
+    ] + [Rule('/static/<path:filename>', endpoint='static')]
+).bind('localhost')
+
+
+def sim_url_for(endpoint, **values):
+    """Build template links for `SimServer` pages without a Flask app or request context"""
+    return SIM_URL_ADAPTER.build(endpoint, values)
+
+
+# Products, goals and product indexes served by `SimServer`; read-only once
+# loaded, so a single copy can back several servers (see `WebAgentTextSubprocVecEnv`)
+Catalog = namedtuple(
+    'Catalog',
+    ['all_products', 'product_item_dict', 'product_prices', 'goals', 'product_index',
+     'document_fields'],
+)
+
+
+def load_catalog(file_path, num_products=None, human_goals=0, asins=None, search_filters=False):
+    """
+    Load the products and goals for a `SimServer`, keeping only the products
+    of `asins` if given. If `search_filters`, the fields searches can be
+    filtered on (see `build_document_fields`) are built too.
+    """
+    all_products, product_item_dict, product_prices, _ = \
+        load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
+    if asins is not None:
+        asins = set(asins)
+        all_products = [p for p in all_products if p['asin'] in asins]
+        product_item_dict = {asin: p for asin, p in product_item_dict.items() if asin in asins}
+        product_prices = {asin: price for asin, price in product_prices.items() if asin in asins}
+    goals = get_goals(all_products, product_prices, human_goals)
+    # Type rewards compare the nouns of product and goal names, parsed once here
+    precompute_name_nouns(
+        all_products, goals, get_name_nouns_path(file_path, num_products, human_goals)
+    )
+    product_index = build_product_index(all_products)
+    document_fields = build_document_fields(all_products, product_prices) if search_filters else None
+    return Catalog(all_products, product_item_dict, product_prices, goals, product_index, document_fields)
+
+
 class SimServer:
     """Lightweight simulator of WebShop Flask application for generating HTML observations"""
     def __init__(
@@ -284,6 +408,15 @@ class SimServer:
         num_products=None,
         human_goals=0,
         show_attrs=False,
+        observation_backend='html',
+        catalog=None,
+        search_cache_size=DEFAULT_SEARCH_CACHE_SIZE,
+        warm_up_search_cache=False,
+        search_backend=DEFAULT_SEARCH_BACKEND,
+        asins=None,
+        search_socket=None,
+        search_threads=1,
+        search_filters=False,
     ):
         """
         Constructor for simulated server serving WebShop application
@@ -291,15 +424,67 @@ class SimServer:
         Arguments:
         filter_goals (`func`) -- Select specific goal(s) for consideration based on criteria of custom function
         limit_goals (`int`) -- Limit to number of goals available
-        num_products (`int`) -- Number of products to search across
+        num_products (`int`) -- Number of products to search across; sizes without an index of
+            their own (see `init_search_engine`) are searched in the index of all products
         human_goals (`bool`) -- If true, load human goals; otherwise, load synthetic goals
+        observation_backend (`str`) -- 'html' renders every page from the theme's templates;
+            'structured' builds page models straight from session state instead
+            (no HTML rendering or parsing, `classic` theme only)
+        catalog (`Catalog`) -- Products and goals loaded beforehand (see `load_catalog`);
+            loaded from `file_path` if not given
+        search_cache_size (`int`) -- Number of queries whose results are cached (0 disables caching)
+        warm_up_search_cache (`bool`) -- If true, fill the search cache with the queries
+            derived from the goals (see `search.get_goal_queries`) on startup
+        search_backend (`str`) -- ['lucene' | 'bm25' | 'dense' | 'hybrid'] (default 'lucene'),
+            see `init_search_engine`; 'bm25' searches in-process, without Java
+        asins (`list`) -- If given, only the products with these ASINs (among the first
+            `num_products`) are loaded and searched
+        search_socket (`str`) -- If given, search through the search server listening on this
+            Unix socket (see `search_server`) instead of opening the index
+        search_threads (`int`) -- Number of threads of the batched searches of
+            `prefetch_search_results`
+        search_filters (`bool`) -- If true, searches can be filtered by price, category
+            and query (see `search.FieldSearcher`); a `catalog` must then have been
+            loaded with `search_filters`
         """
+        if observation_backend == 'structured':
+            if get_theme() not in STRUCTURED_THEMES:
+                raise ValueError(
+                    f'Structured observations are not supported for theme {get_theme()}.'
+                )
+            self.render_page = map_action_to_page
+        elif observation_backend == 'html':
+            self.render_page = map_action_to_html
+        else:
+            raise ValueError(
+                f'Observation backend {observation_backend} not supported.'
+            )
+        self.observation_backend = observation_backend
+
         # Load all products, goals, and search engine
         self.base_url = base_url
-        self.all_products, self.product_item_dict, self.product_prices, _ = \
-            load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
-        self.search_engine = init_search_engine(num_products=num_products)
-        self.goals = get_goals(self.all_products, self.product_prices, human_goals)
+        if catalog is None:
+            catalog = load_catalog(file_path, num_products, human_goals, asins, search_filters)
+        if search_filters and catalog.document_fields is None:
+            raise ValueError('Search filters need a catalog loaded with search_filters.')
+        self.all_products = catalog.all_products
+        self.product_item_dict = catalog.product_item_dict
+        self.product_prices = catalog.product_prices
+        self.product_index = catalog.product_index
+        self.search_engine = init_search_engine(
+            num_products=num_products,
+            cache_size=search_cache_size,
+            backend=search_backend,
+            # Catalogs without an index of their own are searched in the full index
+            asins=(
+                list(self.product_item_dict)
+                if asins is not None or num_products not in INDEX_SIZES else None
+            ),
+            search_socket=search_socket,
+            fields=catalog.document_fields if search_filters else None,
+        )
+        self.search_threads = search_threads
+        self.goals = list(catalog.goals)
         self.show_attrs = show_attrs
 
         # Fix outcome for random shuffling of goals
@@ -324,6 +509,11 @@ class SimServer:
                     idxs.append(idx)
             self.goals = [self.goals[i] for i in idxs]
         print(f'Loaded {len(self.goals)} goals.')
+        if warm_up_search_cache:
+            count = fill_search_cache(
+                self.search_engine, get_goal_queries(self.goals), SEARCH_RETURN_N
+            )
+            print(f'Warmed up search cache with {count} queries.')
 
         # Set extraneous housekeeping variables
         self.weights = [goal['weight'] for goal in self.goals]
@@ -332,20 +522,61 @@ class SimServer:
         self.search_time = 0
         self.render_time = 0
         self.sample_time = 0
+        self.prefetched_search_results = dict()
         self.assigned_instruction_text = None  # TODO: very hacky, should remove
+
+    def prefetch_search_results(self, keywords_list):
+        """
+        Run the searches several sessions are about to make, once per distinct
+        keywords and in one batch (see `get_top_n_product_from_keywords_batch`),
+        so that sessions searching for the same keywords share the results
+        (see `WebAgentTextVecEnv`). Random (`<r>`) searches are still sampled
+        per session.
+        """
+        old_time = time.time()
+        keys = list(dict.fromkeys(
+            tuple(keywords) for keywords in keywords_list
+            if keywords[0] != '<r>' and tuple(keywords) not in self.prefetched_search_results
+        ))
+        results = get_top_n_product_from_keywords_batch(
+            [list(key) for key in keys],
+            self.search_engine,
+            self.all_products,
+            self.product_item_dict,
+            product_index=self.product_index,
+            threads=self.search_threads,
+        )
+        self.prefetched_search_results.update(zip(keys, results))
+        self.search_time += time.time() - old_time
+
+    def _search(self, keywords):
+        top_n_products = self.prefetched_search_results.get(tuple(keywords))
+        if top_n_products is None:
+            old_time = time.time()
+            top_n_products = get_top_n_product_from_keywords(
+                keywords,
+                self.search_engine,
+                self.all_products,
+                self.product_item_dict,
+                product_index=self.product_index,
+            )
+            self.search_time += time.time() - old_time
+        return top_n_products
+
+    def clear_prefetched_search_results(self):
+        self.prefetched_search_results.clear()
         
-    @app.route('/', methods=['GET', 'POST'])
     def index(self, session_id, **kwargs):
         """Redirect to the search page with the given session ID"""
-        html = map_action_to_html(
+        html = self.render_page(
             'start',
+            url_for=sim_url_for,
             session_id=session_id,
             instruction_text=kwargs['instruction_text'],
         )
         url = f'{self.base_url}/{session_id}'
         return html, url
     
-    @app.route('/', methods=['GET', 'POST'])
     def search_results(self, session_id, **kwargs):
         """Initialize session and return the search results page"""
         session = self.user_sessions[session_id]
@@ -358,15 +589,9 @@ class SimServer:
         session["asin"] = None
         session["options"] = {}
 
-        # Perform search on keywords from items and record amount of time it takes
-        old_time = time.time()
-        top_n_products = get_top_n_product_from_keywords(
-            keywords,
-            self.search_engine,
-            self.all_products,
-            self.product_item_dict,
-        )
-        self.search_time += time.time() - old_time
+        # Perform search on keywords from items and record amount of time it takes;
+        # pages of the same keywords reuse the session's results
+        top_n_products = get_session_search_results(session, keywords, self._search)
         
         # Get product list from search result asins and get list of corresponding URLs
         products = get_product_per_page(top_n_products, page)
@@ -379,8 +604,9 @@ class SimServer:
 
         # Render HTML search page and record amount of time taken
         old_time = time.time()
-        html = map_action_to_html(
+        html = self.render_page(
             'search',
+            url_for=sim_url_for,
             session_id=session_id,
             products=products,
             keywords=session["keywords"],
@@ -391,7 +617,6 @@ class SimServer:
         self.render_time += time.time() - old_time
         return html, url
     
-    @app.route('/', methods=['GET', 'POST'])
     def item_page(self, session_id, **kwargs):
         """Render and return the HTML for a product item page"""
         session = self.user_sessions[session_id]
@@ -421,8 +646,9 @@ class SimServer:
             f'{session["page"]}/{option_string}'
         )
 
-        html = map_action_to_html(
+        html = self.render_page(
             'click',
+            url_for=sim_url_for,
             session_id=session_id,
             product_info=product_info,
             keywords=session["keywords"],
@@ -434,7 +660,6 @@ class SimServer:
         )
         return html, url
 
-    @app.route('/', methods=['GET', 'POST'])
     def item_sub_page(self, session_id, **kwargs):
         """Render and return the HTML for a product's sub page (i.e. description, features)"""
         session = self.user_sessions[session_id]
@@ -453,8 +678,9 @@ class SimServer:
             f'{session["asin"]}/{keywords_url_string}/{session["page"]}/'
             f'{clickable_name}/{session["options"]}'
         )
-        html = map_action_to_html(
+        html = self.render_page(
             f'click[{clickable_name}]',
+            url_for=sim_url_for,
             session_id=session_id,
             product_info=product_info,
             keywords=session["keywords"],
@@ -465,7 +691,6 @@ class SimServer:
         )
         return html, url
 
-    @app.route('/', methods=['GET', 'POST'])
     def done(self, session_id, **kwargs):
         """Render and return HTML for done page"""
         session = self.user_sessions[session_id]
@@ -491,8 +716,9 @@ class SimServer:
             f'{self.base_url}/done/{session_id}/'
             f'{session["asin"]}/{session["options"]}'
         )
-        html = map_action_to_html(
+        html = self.render_page(
             f'click[{END_BUTTON}]',
+            url_for=sim_url_for,
             session_id=session_id,
             reward=reward,
             asin=session["asin"],
@@ -505,86 +731,86 @@ class SimServer:
         """Map action to the corresponding page"""
         status = dict(reward=0.0, done=False)
 
-        with app.app_context(), app.test_request_context():
-            # Create/determine goal, instruction_text from current session
-            if session_id not in self.user_sessions:
-                idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights) 
-                goal = self.goals[idx]
-                instruction_text = goal['instruction_text']
-                self.user_sessions[session_id] = {'goal': goal, 'done': False}
-            else:
-                instruction_text = \
-                    self.user_sessions[session_id]['goal']['instruction_text']
-            if self.assigned_instruction_text is not None:
-                instruction_text = self.assigned_instruction_text  # TODO: very hacky, should remove
-                self.user_sessions[session_id]['goal']['instruction_text'] = instruction_text
-            session = self.user_sessions[session_id]
-
-            if not kwargs:
-                # If no action, reset the session variables
-                kwargs['instruction_text'] = instruction_text
-                html, url = self.index(session_id, **kwargs)
-                self.user_sessions[session_id].update(
-                    {
-                        'keywords': None,
-                        'page': None,
-                        'asin': None,
-                        'asins': set(),
-                        'options': dict(),
-                        'actions': defaultdict(int)
-                    }
+        # Create/determine goal, instruction_text from current session
+        if session_id not in self.user_sessions:
+            idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights) 
+            goal = self.goals[idx]
+            instruction_text = goal['instruction_text']
+            self.user_sessions[session_id] = {'goal': goal, 'done': False}
+        else:
+            instruction_text = \
+                self.user_sessions[session_id]['goal']['instruction_text']
+        if self.assigned_instruction_text is not None:
+            instruction_text = self.assigned_instruction_text  # TODO: very hacky, should remove
+            self.user_sessions[session_id]['goal']['instruction_text'] = instruction_text
+        session = self.user_sessions[session_id]
+
+        if not kwargs:
+            # If no action, reset the session variables
+            kwargs['instruction_text'] = instruction_text
+            html, url = self.index(session_id, **kwargs)
+            self.user_sessions[session_id].update(
+                {
+                    'keywords': None,
+                    'search_results': None,
+                    'page': None,
+                    'asin': None,
+                    'asins': set(),
+                    'options': dict(),
+                    'actions': defaultdict(int)
+                }
+            )
+        elif 'keywords' in kwargs:
+            # If search keywords are available, run a search
+            html, url = self.search_results(session_id, **kwargs)
+        elif 'clickable_name' in kwargs:
+            clickable_name = kwargs['clickable_name'].lower()
+            if clickable_name == END_BUTTON.lower():
+                # If "buy now" clicked, calculate reward and flag session as terminated
+                html, url, reward = self.done(session_id, **kwargs)
+                status['reward'] = reward
+                status['done'] = True
+            elif clickable_name == BACK_TO_SEARCH.lower():
+                # If "back to search" clicked, recursively reset the session back to search page
+                html, url, status = self.receive(session_id, current_url)
+            elif (clickable_name == NEXT_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'search_results'):
+                # If "next page" clicked from search results, re-render with `page` enumerated
+                html, url, status = self.receive(
+                    session_id,
+                    current_url,
+                    keywords=session["keywords"],
+                    page=session["page"] + 1,
                 )
-            elif 'keywords' in kwargs:
-                # If search keywords are available, run a search
-                html, url = self.search_results(session_id, **kwargs)
-            elif 'clickable_name' in kwargs:
-                clickable_name = kwargs['clickable_name'].lower()
-                if clickable_name == END_BUTTON.lower():
-                    # If "buy now" clicked, calculate reward and flag session as terminated
-                    html, url, reward = self.done(session_id, **kwargs)
-                    status['reward'] = reward
-                    status['done'] = True
-                elif clickable_name == BACK_TO_SEARCH.lower():
-                    # If "back to search" clicked, recursively reset the session back to search page
-                    html, url, status = self.receive(session_id, current_url)
-                elif (clickable_name == NEXT_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'search_results'):
-                    # If "next page" clicked from search results, re-render with `page` enumerated
-                    html, url, status = self.receive(
-                        session_id,
-                        current_url,
-                        keywords=session["keywords"],
-                        page=session["page"] + 1,
-                    )
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'search_results'):
-                    # If "prev page" clicked from search results, re-render with `page` denumerated
-                    html, url, status = self.receive(
-                        session_id,
-                        current_url,
-                        keywords=session["keywords"],
-                        page=session["page"] - 1,
-                    )
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'item_sub_page'):
-                    # If "prev page" clicked from sub page, return to corresponding item page
-                    html, url = self.item_page(session_id, **kwargs)
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'item_page'):
-                    # If "prev page" clicked from item page, return to search results page
-                    html, url = self.search_results(
-                        session_id,
-                        keywords=session["keywords"],
-                        page=session["page"],
-                        **kwargs
-                    )
-                elif clickable_name in [k.lower() for k in ACTION_TO_TEMPLATE]:
-                    # Render item_sub_page if clickable is description, features, or reviews
-                    html, url = self.item_sub_page(session_id, **kwargs)
-                else:
-                    # Otherwise, render current item page
-                    html, url = self.item_page(session_id, **kwargs)
-            return html, url, status
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'search_results'):
+                # If "prev page" clicked from search results, re-render with `page` denumerated
+                html, url, status = self.receive(
+                    session_id,
+                    current_url,
+                    keywords=session["keywords"],
+                    page=session["page"] - 1,
+                )
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'item_sub_page'):
+                # If "prev page" clicked from sub page, return to corresponding item page
+                html, url = self.item_page(session_id, **kwargs)
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'item_page'):
+                # If "prev page" clicked from item page, return to search results page
+                html, url = self.search_results(
+                    session_id,
+                    keywords=session["keywords"],
+                    page=session["page"],
+                    **kwargs
+                )
+            elif clickable_name in [k.lower() for k in ACTION_TO_TEMPLATE]:
+                # Render item_sub_page if clickable is description, features, or reviews
+                html, url = self.item_sub_page(session_id, **kwargs)
+            else:
+                # Otherwise, render current item page
+                html, url = self.item_page(session_id, **kwargs)
+        return html, url, status
     
     def get_page_name(self, url):
         """Determine which page (i.e. item_page, search_results) the given URL is pointing at"""
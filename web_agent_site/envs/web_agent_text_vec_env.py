@@ -0,0 +1,390 @@
+import gc
+import multiprocessing
+import os
+import random
+import traceback
+import numpy as np
+
+from web_agent_site.engine.engine import parse_action
+from web_agent_site.engine.search import DEFAULT_SEARCH_BACKEND, DEFAULT_SEARCH_CACHE_SIZE
+from web_agent_site.envs.web_agent_text_env import (
+    WebAgentTextEnv,
+    SimServer,
+    load_catalog,
+)
+from web_agent_site.utils import DEFAULT_FILE_PATH
+
+
+def get_search_keywords(action):
+    """
+    Keywords `WebAgentTextEnv.step` would search for when taking `action`,
+    or None if the action does not run a search
+    """
+    action_name, action_arg = parse_action(action)
+    if action_name != 'search' or action_arg is None:
+        return None
+    action_arg = action_arg.lower()
+    if action_arg == '':
+        return None
+    return action_arg.split(' ')
+
+
+class WebAgentTextVecEnv:
+    """Batch of text environment sessions served by a single `SimServer`"""
+    def __init__(
+            self,
+            num_envs,
+            observation_mode='html',
+            file_path=DEFAULT_FILE_PATH,
+            server=None,
+            **kwargs
+        ):
+        """
+        Constructor for vectorized text environment
+
+        Arguments:
+        num_envs (`int`) -- Number of sessions stepped together
+        observation_mode, file_path, server, **kwargs -- see `WebAgentTextEnv`;
+            the catalog, search engine and goals are loaded once and shared
+            by all sessions
+        """
+        self.num_envs = num_envs
+        self.observation_mode = observation_mode
+        self.server = SimServer(
+            'http://127.0.0.1:3000',
+            file_path,
+            kwargs.get('filter_goals'),
+            kwargs.get('limit_goals', -1),
+            kwargs.get('num_products'),
+            kwargs.get('human_goals'),
+            kwargs.get('show_attrs', False),
+            kwargs.get('observation_backend', 'html'),
+            search_cache_size=kwargs.get('search_cache_size', DEFAULT_SEARCH_CACHE_SIZE),
+            warm_up_search_cache=kwargs.get('warm_up_search_cache', False),
+            search_backend=kwargs.get('search_backend', DEFAULT_SEARCH_BACKEND),
+            asins=kwargs.get('asins'),
+            search_socket=kwargs.get('search_socket'),
+            search_threads=kwargs.get('search_threads', 1),
+            search_filters=kwargs.get('search_filters', False),
+        ) if server is None else server
+
+        # Distinct session prefixes keep sessions apart when two of them are
+        # reset to the same goal index
+        session_prefix = kwargs.pop('session_prefix', None) or ''
+        self.envs = [
+            WebAgentTextEnv(
+                observation_mode,
+                file_path,
+                server=self.server,
+                session_prefix=f'{session_prefix}{i}_',
+                **kwargs
+            )
+            for i in range(num_envs)
+        ]
+
+    def reset(self, idxs=None, sessions=None):
+        """
+        Start new sessions for the environments at `idxs` (default: all)
+
+        Arguments:
+        idxs (`list`) -- Indices of the environments to reset
+        sessions (`list`) -- Session (goal index or name) to reset each of them
+            to, as passed to `WebAgentTextEnv.reset`; random if not given
+
+        Returns the observations and available actions of the reset environments
+        """
+        if idxs is None:
+            idxs = range(self.num_envs)
+        if sessions is None:
+            sessions = [None] * len(idxs)
+        if len(sessions) != len(idxs):
+            raise ValueError('Expected one session per environment to reset.')
+        obs = [self.envs[i].reset(session)[0] for i, session in zip(idxs, sessions)]
+        return obs, [self.envs[i].get_available_actions() for i in idxs]
+
+    def step(self, actions):
+        """
+        Take one action in every environment
+
+        Searches issued in the same step run once per distinct keywords and
+        are shared by the sessions that issued them. Environments that are
+        done should be reset (see `reset`) before they are stepped again.
+
+        Returns (observations, rewards, dones, available actions), with one
+        entry per environment
+        """
+        if len(actions) != self.num_envs:
+            raise ValueError(
+                f'Expected {self.num_envs} actions, got {len(actions)}.'
+            )
+        keywords = [get_search_keywords(action) for action in actions]
+        self.server.prefetch_search_results(
+            [k for k in keywords if k is not None]
+        )
+        try:
+            results = [env.step(action) for env, action in zip(self.envs, actions)]
+        finally:
+            self.server.clear_prefetched_search_results()
+
+        obs, rewards, dones, _ = zip(*results)
+        return (
+            list(obs),
+            np.array(rewards, dtype=float),
+            np.array(dones, dtype=bool),
+            self.get_available_actions(),
+        )
+
+    def get_available_actions(self):
+        """Available actions of every environment at the current step"""
+        return [env.get_available_actions() for env in self.envs]
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+# Commands sent from `WebAgentTextSubprocVecEnv` to its workers
+CMD_STEP, CMD_RESET, CMD_CLOSE = range(3)
+
+
+def _pack_available_actions(available_actions):
+    return [(a['has_search_bar'], a['clickables']) for a in available_actions]
+
+
+def _unpack_available_actions(packed):
+    return [
+        dict(has_search_bar=has_search_bar, clickables=clickables)
+        for has_search_bar, clickables in packed
+    ]
+
+
+def _worker(conn, parent_conn, worker_id, num_envs, catalog, seed, observation_mode, file_path, kwargs):
+    """
+    Serve a `WebAgentTextVecEnv` of `num_envs` sessions over `conn`
+
+    Messages are tuples: (CMD_STEP, actions) and (CMD_RESET, idxs, sessions)
+    are answered with (ok, payload), where payload is the result (available
+    actions packed as (has_search_bar, clickables) pairs) or a traceback.
+    """
+    parent_conn.close()
+    try:
+        # The search engine (a JVM for pyserini) cannot be shared across a fork,
+        # so every worker opens its own; the catalog is inherited from the parent
+        server = SimServer(
+            'http://127.0.0.1:3000',
+            file_path,
+            kwargs.get('filter_goals'),
+            kwargs.get('limit_goals', -1),
+            kwargs.get('num_products'),
+            kwargs.get('human_goals'),
+            kwargs.get('show_attrs', False),
+            kwargs.get('observation_backend', 'html'),
+            catalog=catalog,
+            search_cache_size=kwargs.get('search_cache_size', DEFAULT_SEARCH_CACHE_SIZE),
+            warm_up_search_cache=kwargs.get('warm_up_search_cache', False),
+            search_backend=kwargs.get('search_backend', DEFAULT_SEARCH_BACKEND),
+            asins=kwargs.get('asins'),
+            search_socket=kwargs.get('search_socket'),
+            search_threads=kwargs.get('search_threads', 1),
+            search_filters=kwargs.get('search_filters', False),
+        )
+        # Forked workers start from the same random state
+        random.seed(None if seed is None else seed + worker_id)
+        envs = WebAgentTextVecEnv(
+            num_envs, observation_mode, file_path, server=server, **kwargs
+        )
+        conn.send((True, None))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+        conn.close()
+        return
+
+    while True:
+        try:
+            cmd, *args = conn.recv()
+        except EOFError:
+            break
+        if cmd == CMD_CLOSE:
+            envs.close()
+            break
+        try:
+            if cmd == CMD_STEP:
+                obs, rewards, dones, available_actions = envs.step(args[0])
+                payload = (obs, rewards.tolist(), dones.tolist(),
+                           _pack_available_actions(available_actions))
+            elif cmd == CMD_RESET:
+                obs, available_actions = envs.reset(*args)
+                payload = (obs, _pack_available_actions(available_actions))
+            else:
+                raise ValueError(f'Command {cmd} not recognized.')
+            conn.send((True, payload))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+class WebAgentTextSubprocVecEnv:
+    """
+    Batch of text environment sessions stepped in parallel worker processes
+
+    The catalog (products, goals and the indexes derived from them, see
+    `load_catalog`) is loaded once in the parent and the workers are forked
+    afterwards, so they share it copy-on-write instead of
+    each loading its own copy. Each worker serves a contiguous slice of the
+    sessions with a `WebAgentTextVecEnv` and its own search engine.
+    Requires the `fork` start method (i.e. Linux or macOS).
+    """
+    def __init__(
+            self,
+            num_envs,
+            num_workers=None,
+            observation_mode='html',
+            file_path=DEFAULT_FILE_PATH,
+            seed=None,
+            **kwargs
+        ):
+        """
+        Constructor for multiprocess vectorized text environment
+
+        Arguments:
+        num_envs (`int`) -- Number of sessions stepped together
+        num_workers (`int`) -- Number of worker processes (default: one per
+            CPU, at most `num_envs`)
+        seed (`int`) -- Seed for the random state of the workers (goal
+            sampling, session names); worker `i` is seeded with `seed + i`
+        observation_mode, file_path, **kwargs -- see `WebAgentTextEnv`
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = max(1, min(num_workers, num_envs))
+        self.num_envs = num_envs
+        self.num_workers = num_workers
+        self.observation_mode = observation_mode
+
+        # Assign sessions to workers in contiguous slices
+        sizes = [
+            num_envs // num_workers + (1 if w < num_envs % num_workers else 0)
+            for w in range(num_workers)
+        ]
+        self.worker_sizes = sizes
+        self.env_to_worker = [
+            (w, i) for w, size in enumerate(sizes) for i in range(size)
+        ]
+
+        catalog = load_catalog(
+            file_path,
+            kwargs.get('num_products'),
+            kwargs.get('human_goals'),
+            kwargs.get('asins'),
+            kwargs.get('search_filters', False),
+        )
+        session_prefix = kwargs.pop('session_prefix', None) or ''
+
+        # Move everything allocated so far out of the garbage collector's
+        # reach, so that collections in the workers do not touch (and copy)
+        # the pages holding the catalog
+        ctx = multiprocessing.get_context('fork')
+        gc.collect()
+        gc.freeze()
+        self.conns, self.processes = [], []
+        try:
+            for w, size in enumerate(sizes):
+                parent_conn, child_conn = ctx.Pipe()
+                process = ctx.Process(
+                    target=_worker,
+                    args=(
+                        child_conn, parent_conn, w, size, catalog, seed,
+                        observation_mode, file_path,
+                        dict(kwargs, session_prefix=f'{session_prefix}{w}-'),
+                    ),
+                    daemon=True,
+                )
+                process.start()
+                child_conn.close()
+                self.conns.append(parent_conn)
+                self.processes.append(process)
+        finally:
+            gc.unfreeze()
+        # The workers hold the catalog from here on
+        del catalog
+        self.closed = False
+        for conn in self.conns:
+            self._receive(conn)
+
+    def _receive(self, conn):
+        ok, payload = conn.recv()
+        if not ok:
+            raise RuntimeError(f'Error in environment worker:\n{payload}')
+        return payload
+
+    def reset(self, idxs=None, sessions=None):
+        """
+        Start new sessions for the environments at `idxs` (default: all),
+        see `WebAgentTextVecEnv.reset`
+        """
+        if idxs is None:
+            idxs = range(self.num_envs)
+        if sessions is None:
+            sessions = [None] * len(idxs)
+        if len(sessions) != len(idxs):
+            raise ValueError('Expected one session per environment to reset.')
+
+        # Group the environments to reset by worker, then put results back in order
+        requests = dict()
+        for i, session in zip(idxs, sessions):
+            w, local_idx = self.env_to_worker[i]
+            worker_idxs, worker_sessions = requests.setdefault(w, ([], []))
+            worker_idxs.append(local_idx)
+            worker_sessions.append(session)
+        for w, (worker_idxs, worker_sessions) in requests.items():
+            self.conns[w].send((CMD_RESET, worker_idxs, worker_sessions))
+        results = dict()
+        for w, (worker_idxs, _) in requests.items():
+            obs, packed = self._receive(self.conns[w])
+            available_actions = _unpack_available_actions(packed)
+            for local_idx, ob, available in zip(worker_idxs, obs, available_actions):
+                results[(w, local_idx)] = (ob, available)
+        obs, available_actions = [], []
+        for i in idxs:
+            ob, available = results[self.env_to_worker[i]]
+            obs.append(ob)
+            available_actions.append(available)
+        return obs, available_actions
+
+    def step(self, actions):
+        """Take one action in every environment, see `WebAgentTextVecEnv.step`"""
+        if len(actions) != self.num_envs:
+            raise ValueError(
+                f'Expected {self.num_envs} actions, got {len(actions)}.'
+            )
+        start = 0
+        for conn, size in zip(self.conns, self.worker_sizes):
+            conn.send((CMD_STEP, list(actions[start:start + size])))
+            start += size
+        obs, rewards, dones, available_actions = [], [], [], []
+        for conn in self.conns:
+            worker_obs, worker_rewards, worker_dones, packed = self._receive(conn)
+            obs.extend(worker_obs)
+            rewards.extend(worker_rewards)
+            dones.extend(worker_dones)
+            available_actions.extend(_unpack_available_actions(packed))
+        return (
+            obs,
+            np.array(rewards, dtype=float),
+            np.array(dones, dtype=bool),
+            available_actions,
+        )
+
+    def close(self):
+        if self.closed:
+            return
+        for conn in self.conns:
+            try:
+                conn.send((CMD_CLOSE,))
+            except (BrokenPipeError, EOFError):
+                pass
+        for process in self.processes:
+            process.join()
+        for conn in self.conns:
+            conn.close()
+        self.closed = True
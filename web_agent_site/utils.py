@@ -18,6 +18,62 @@ FEAT_IDS = join(BASE_DIR, '../data/feat_ids.pt')
 HUMAN_ATTR_PATH = join(BASE_DIR, '../data/items_human_ins.json')
 HUMAN_ATTR_PATH = join(BASE_DIR, '../data/items_human_ins.json')
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+JSON_CHUNK_SIZE = 1 << 20
+
+def iter_json_array(filepath, chunk_size=JSON_CHUNK_SIZE):
+    """Yield the items of the JSON array in `filepath` one at a time, without
+    loading the whole file. Uses `ijson` when it is installed, and otherwise
+    decodes items from a buffer of `chunk_size` characters
+    """
+    if ijson is not None:
+        with open(filepath, 'rb') as f:
+            yield from ijson.items(f, 'item', use_float=True)
+        return
+
+    decoder = json.JSONDecoder()
+    with open(filepath) as f:
+        buffer = f.read(chunk_size)
+        eof = not buffer
+        pos = 0
+        started = False
+        while True:
+            # Skip whitespace and the separators around items
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n' + (',]' if started else '['):
+                    if buffer[pos] == '[':
+                        started = True
+                    elif buffer[pos] == ']':
+                        return
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    break
+                buffer, pos = f.read(chunk_size), 0
+                eof = not buffer
+            if pos >= len(buffer):
+                raise ValueError(f'Unexpected end of JSON array in {filepath}')
+            if not started:
+                raise ValueError(f'Expected a JSON array in {filepath}')
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                # An item ending with the buffer (e.g. a number) may continue
+                complete = end < len(buffer) or eof
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                chunk = f.read(chunk_size)
+                buffer, pos = buffer[pos:] + chunk, 0
+                eof = not chunk
+                continue
+            yield item
+            pos = end
+
 def random_idx(cum_weights):
     """Generate random index by sampling uniformly from sum of all weights, then
     selecting the `min` between the position to keep the list sorted (via bisect)